@@ -0,0 +1,564 @@
+######################################################################
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Asynchronous Data Model that uses Redis
+
+AsyncData is the asyncio version of Data used by the ASGI server in
+aserver.py. It stores Datas in exactly the same layout as Data (codec,
+secondary indexes, versions and cache invalidation channel), so the
+synchronous and the asynchronous servers can share one Redis.
+
+This module needs Python 3 and redis-py 5.0.1 or later for redis.asyncio.
+"""
+
+import os
+import json
+import asyncio
+from time import time
+from functools import wraps
+from collections import OrderedDict
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.exceptions import ConnectionError, WatchError
+from models import Data, DataCache, DataConflictError, DataValidationError, DataVersionError, \
+    CHANGES_KEY, COUNTER_KEY, DEFAULT_BATCH_SIZE, DEFAULT_CHANGES_LENGTH, DEFAULT_CODEC, \
+    DEFAULT_KEY_PREFIX, INDEX_PREFIX, INDEXED_ATTRIBUTES, INVALIDATION_CHANNEL, INVALIDATE_ALL, \
+    PURCHASE_SCRIPT, RECORD_PATTERN, STATS_KEY, VERSION_KEY, get_codec
+from metrics import DATA_LATENCY, command_name, observe_redis
+
+
+def timed(operation):
+    """ Decorator that records the latency of an asynchronous Data operation """
+    def decorator(function):
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            with DATA_LATENCY.time(operation=operation):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_redis(client):
+    """ Times every command and pipeline of an asyncio Redis client
+
+    This is metrics.instrument_redis for redis.asyncio clients.
+    """
+    if getattr(client, 'instrumented', False):
+        return client
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    async def timed_execute_command(*args, **options):
+        started = time()
+        try:
+            result = await execute_command(*args, **options)
+        except Exception:
+            observe_redis(command_name(args), started, failed=True)
+            raise
+        observe_redis(command_name(args), started)
+        return result
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        immediate_execute_command = pipe.immediate_execute_command
+
+        async def timed_execute(*args, **kwargs):
+            command = 'MULTI' if pipe.is_transaction else 'PIPELINE'
+            size = len(pipe.command_stack)
+            started = time()
+            try:
+                result = await execute(*args, **kwargs)
+            except Exception:
+                observe_redis(command, started, failed=True, pipelined=size)
+                raise
+            observe_redis(command, started, pipelined=size)
+            return result
+
+        async def timed_immediate_execute_command(*args, **options):
+            started = time()
+            try:
+                result = await immediate_execute_command(*args, **options)
+            except Exception:
+                observe_redis(command_name(args), started, failed=True)
+                raise
+            observe_redis(command_name(args), started)
+            return result
+
+        pipe.execute = timed_execute
+        pipe.immediate_execute_command = timed_immediate_execute_command
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+    client.instrumented = True
+    return client
+
+
+class AsyncData(Data):
+    """ Data interface to database for asyncio code """
+
+    redis = None
+    changes_redis = None
+    scripts = {}
+    cache_listener = None
+
+    async def save(self, expected_versions=None):
+        """ Saves a Data in the database and keeps its indexes up to date """
+        if expected_versions is None:
+            await AsyncData.save_many([self])
+        else:
+            await AsyncData.save_many([self], {self.id: expected_versions})
+
+    async def delete(self, expected_versions=None):
+        """ Deletes a Data from the database along with its index entries """
+        if expected_versions is None:
+            await AsyncData.delete_many([self.id])
+        else:
+            await AsyncData.delete_many([self.id], {self.id: expected_versions})
+
+
+######################################################################
+#  S T A T I C   D A T A B S E   M E T H O D S
+######################################################################
+
+    @staticmethod
+    async def __next_index(count=1):
+        """ Increments the index by count and returns the first reserved id """
+        return await AsyncData.redis.incrby(Data._key(COUNTER_KEY), count) - count + 1
+
+    @staticmethod
+    @timed('save_many')
+    async def save_many(datas, expected_versions=None):
+        """ Saves many Datas in a single transaction, see Data.save_many """
+        for data in datas:
+            if data.name is None:   # name is the only required field
+                raise DataValidationError('name attribute is not set')
+        # each id once, so a repeated id is unindexed once like it is indexed once
+        old_ids = list(OrderedDict.fromkeys(data.id for data in datas if data.id != 0))
+        new_datas = [data for data in datas if data.id == 0]
+        if new_datas:
+            first_id = await AsyncData.__next_index(len(new_datas))
+            for offset, data in enumerate(new_datas):
+                data.id = first_id + offset
+        records = OrderedDict((data.id, data.serialize()) for data in datas)
+        async with AsyncData.redis.pipeline() as pipe:
+            while True:
+                try:
+                    await AsyncData.__watch_versions(pipe, old_ids, expected_versions)
+                    olds = await AsyncData.__fetch(old_ids, INDEXED_ATTRIBUTES)
+                    pipe.multi()
+                    for old in olds:
+                        if old:
+                            Data._unindex(pipe, old)
+                    for data_id, record in records.items():
+                        Data.codec.write(pipe, Data._key(data_id), record)
+                        Data._index(pipe, record)
+                    updated = set(old['id'] for old in olds if old)
+                    Data._record_changes(pipe, [('update' if data_id in updated else 'create',
+                                                 data_id) for data_id in records])
+                    Data._invalidate(pipe, list(records))
+                    Data._bump_versions(pipe, list(records))
+                    versions = (await pipe.execute())[-len(records) - 1:-1]
+                    break
+                except WatchError:
+                    Data._on_version_race(old_ids, expected_versions)
+        versions = dict(zip(records, versions))
+        for data in datas:
+            data.version = versions[data.id]
+
+    @staticmethod
+    @timed('delete_many')
+    async def delete_many(data_ids, expected_versions=None):
+        """ Deletes many Datas in a single transaction, see Data.delete_many """
+        data_ids = list(OrderedDict.fromkeys(data_ids))
+        async with AsyncData.redis.pipeline() as pipe:
+            while True:
+                try:
+                    await AsyncData.__watch_versions(pipe, data_ids, expected_versions)
+                    olds = await AsyncData.__fetch(data_ids, INDEXED_ATTRIBUTES)
+                    pipe.multi()
+                    deleted = []
+                    for old in olds:
+                        if old:
+                            Data._unindex(pipe, old)
+                            deleted.append(old['id'])
+                    if data_ids:
+                        pipe.delete(*[Data._key(data_id) for data_id in data_ids])
+                        Data._bump_versions(pipe, deleted)
+                        Data._record_changes(pipe, [('delete', data_id) for data_id in deleted])
+                        Data._invalidate(pipe, data_ids)
+                    await pipe.execute()
+                    return deleted
+                except WatchError:
+                    Data._on_version_race(data_ids, expected_versions)
+
+    @staticmethod
+    async def remove_all(batch_size=1000):
+        """ Removes all Datas from the database, see Data.remove_all """
+        pipe = AsyncData.redis.pipeline(transaction=False)
+        async for key in AsyncData.redis.scan_iter(Data._key_pattern('*'), count=batch_size):
+            Data._reset_key(pipe, key)
+            if len(pipe) >= batch_size:
+                await pipe.execute()
+        Data._record_changes(pipe, [('reset', None)])
+        await pipe.execute()
+        Data.cache.clear()
+        await AsyncData.redis.publish(Data._key(INVALIDATION_CHANNEL), INVALIDATE_ALL)
+
+    @staticmethod
+    @timed('all')
+    async def all():
+        """ Query that returns all Datas """
+        return [data async for data in AsyncData.iter_all()]
+
+    @staticmethod
+    async def iter_all(batch_size=DEFAULT_BATCH_SIZE):
+        """ Asynchronous generator that streams all Datas using SCAN and MGET """
+        cursor = 0
+        while True:
+            cursor, datas = await AsyncData.page(cursor, batch_size)
+            for data in datas:
+                yield data
+            if not cursor:
+                break
+
+    @staticmethod
+    @timed('page')
+    async def page(cursor=0, limit=DEFAULT_BATCH_SIZE):
+        """ Query that returns one page of Datas, see Data.page """
+        ids = []
+        while True:
+            cursor, batch = await AsyncData.redis.scan(
+                cursor, match=Data._key_pattern(RECORD_PATTERN), count=limit)
+            cursor = int(cursor)
+            ids.extend(Data._id_of(key) for key in batch)
+            if len(ids) >= limit or not cursor:
+                break
+        return cursor, await AsyncData.__load(ids)
+
+    @staticmethod
+    @timed('purchase')
+    async def purchase(data_id, expected_versions=None):
+        """ Atomically marks an available Data as sold, see Data.purchase """
+        data_id = int(data_id)
+        if Data.codec.partial_reads:
+            keys, args = Data._purchase_script_args(data_id, expected_versions)
+            reply = await AsyncData.__script(PURCHASE_SCRIPT)(keys=keys, args=args)
+            Data.cache.invalidate([data_id])
+            record, version = Data._purchase_result(data_id, reply)
+            if not record:
+                return None
+            data = AsyncData(record['id']).deserialize(record)
+            data.version = version
+            return data
+
+        expected = None if expected_versions is None else {data_id: expected_versions}
+        async with AsyncData.redis.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(Data._key(data_id))
+                    await AsyncData.__watch_versions(pipe, [data_id], expected)
+                    record = (await AsyncData.__fetch([data_id]))[0]
+                    if not record:
+                        return None
+                    if not record['available']:
+                        raise DataConflictError("Data with id '{}' is not available.".format(data_id))
+                    pipe.multi()
+                    Data._unindex(pipe, record)
+                    record['available'] = False
+                    Data.codec.write(pipe, Data._key(data_id), record)
+                    Data._index(pipe, record)
+                    Data._record_changes(pipe, [('purchase', data_id)])
+                    Data._invalidate(pipe, [data_id])
+                    Data._bump_versions(pipe, [data_id])
+                    data = AsyncData(record['id']).deserialize(record)
+                    data.version = (await pipe.execute())[-2]
+                    return data
+                except WatchError:
+                    Data._on_version_race([data_id], expected)
+
+    @staticmethod
+    def __script(source):
+        """ Returns a Lua script registered with the current Redis client """
+        script = AsyncData.scripts.get(source)
+        if script is None or script.registered_client is not AsyncData.redis:
+            script = AsyncData.redis.register_script(source)
+            AsyncData.scripts[source] = script
+        return script
+
+######################################################################
+#  V E R S I O N   M E T H O D S
+######################################################################
+
+    @staticmethod
+    async def version_of(data_id):
+        """ Returns the version of a Data, 0 if it was never versioned """
+        return int(await AsyncData.redis.get(Data._version_key(data_id)) or 0)
+
+    @staticmethod
+    async def collection_version():
+        """ Returns a version that changes whenever any Data changes """
+        return int(await AsyncData.redis.get(Data._key(VERSION_KEY)) or 0)
+
+    @staticmethod
+    async def __watch_versions(pipe, data_ids, expected_versions=None):
+        """ Watches the versions of data_ids and checks the expected ones """
+        if not data_ids:
+            return
+        keys = [Data._version_key(data_id) for data_id in data_ids]
+        await pipe.watch(*keys)
+        if not expected_versions:
+            return
+        for data_id, version in zip(data_ids, await pipe.mget(keys)):
+            if data_id in expected_versions and \
+                    int(version or 0) not in expected_versions[data_id]:
+                raise DataVersionError("Data with id '{}' has changed.".format(data_id))
+
+######################################################################
+#  F I N D E R   M E T H O D S
+######################################################################
+
+    @staticmethod
+    @timed('find')
+    async def find(data_id):
+        """ Query that finds Datas by their id, through the cache if enabled """
+        if not Data.cache.enabled:
+            record = (await AsyncData.__fetch([data_id]))[0]
+        else:
+            data_id = int(data_id)
+            record = Data.cache.get(data_id)
+            if record is None:
+                generation = Data.cache.generation
+                record = (await AsyncData.__fetch([data_id]))[0]
+                if record:
+                    Data.cache.put(data_id, record, generation)
+        if record:
+            return AsyncData(record['id']).deserialize(record)
+        return None
+
+    @staticmethod
+    @timed('find_many')
+    async def find_many(data_ids):
+        """ Query that finds many Datas by id in a single round-trip """
+        return [AsyncData(record['id']).deserialize(record) if record else None
+                for record in await AsyncData.__fetch(data_ids)]
+
+    @staticmethod
+    @timed('find_by')
+    async def __find_by(attribute, value):
+        """ Generic Query that finds Datas through a secondary index """
+        AsyncData.logger.info('Processing %s query for %s', attribute, value)
+        ids = await AsyncData.redis.smembers(Data._index_key(attribute, value))
+        return await AsyncData.__load(sorted(ids, key=int))
+
+    @staticmethod
+    async def __load(data_ids):
+        """ Fetches the Datas with data_ids in a single round-trip """
+        return [AsyncData(record['id']).deserialize(record)
+                for record in await AsyncData.__fetch(data_ids)
+                if record is not None]  # deleted since its id was read
+
+    @staticmethod
+    async def __fetch(data_ids, fields=None):
+        """ Reads the records of data_ids through the codec """
+        if not data_ids:
+            return []
+        pipe = AsyncData.redis.pipeline(transaction=False)
+        Data.codec.queue_read(pipe, [Data._key(data_id) for data_id in data_ids], fields)
+        return Data.codec.decode_read(await pipe.execute(), fields)
+
+    @staticmethod
+    @timed('search')
+    async def search(query, offset=0, limit=DEFAULT_BATCH_SIZE):
+        """ Query that finds Datas by the words of their name and category, see Data.search """
+        words = Data._search_words(query)
+        if not words:
+            return 0, []
+        pipe = AsyncData.redis.pipeline(transaction=False)
+        Data._queue_search(pipe, words)
+        ranked = Data._rank_search(words, await pipe.execute())
+        return len(ranked), await AsyncData.__load(ranked[offset:offset + limit])
+
+    @staticmethod
+    async def counts():
+        """ Returns the number of Datas and of available ones, see Data.counts """
+        return Data._counts_result(
+            await AsyncData.redis.hgetall(Data._key(INDEX_PREFIX, STATS_KEY)))
+
+    @staticmethod
+    @timed('query')
+    async def query(filters, sort=None):
+        """ Query that finds the Datas matching all of filters, see Data.query """
+        keys = Data._filter_keys(filters)
+        if not keys:
+            return Data._sort_datas(await AsyncData.all(), sort)
+        if len(keys) == 1:
+            ids = await AsyncData.redis.smembers(keys[0])
+        else:
+            pipe = AsyncData.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.scard(key)
+            sizes = await pipe.execute()
+            AsyncData.logger.debug('Query plan %s', sorted(zip(sizes, keys)))
+            if not min(sizes):
+                return []
+            ids = await AsyncData.redis.sinter([key for _, key in sorted(zip(sizes, keys))])
+        return Data._sort_datas(await AsyncData.__load(sorted(ids, key=int)), sort)
+
+    @staticmethod
+    async def find_by_name(name):
+        """ Query that finds Datas by their name """
+        return await AsyncData.__find_by('name', name)
+
+    @staticmethod
+    async def find_by_category(category):
+        """ Query that finds Datas by their category """
+        return await AsyncData.__find_by('category', category)
+
+    @staticmethod
+    async def find_by_availability(available=True):
+        """ Query that finds Datas by their availability """
+        if not isinstance(available, bool):
+            available = str(available).lower() in ['true', '1', 't']
+        return await AsyncData.__find_by('available', available)
+
+######################################################################
+#  C H A N G E   F E E D   M E T H O D S
+######################################################################
+
+    @staticmethod
+    @timed('changes')
+    async def changes(since='0', count=DEFAULT_BATCH_SIZE, block_ms=0):
+        """ Returns up to count change events recorded after since, see Data.changes """
+        key = Data._key(CHANGES_KEY)
+        pipe = AsyncData.redis.pipeline(transaction=False)
+        Data._queue_changes(pipe, since, count)
+        length, first, reply = await pipe.execute()
+        Data._check_since(since, length, first)
+        events = Data._changes_result(reply)
+        if not events and block_ms:
+            redis = AsyncData.changes_redis or AsyncData.redis
+            events = Data._changes_result(
+                await redis.xread({key: since}, count=count, block=block_ms))
+        return events
+
+    @staticmethod
+    async def last_change_id():
+        """ Returns the id of the latest change event, '0' when there is none """
+        entries = await AsyncData.redis.xrevrange(Data._key(CHANGES_KEY), count=1)
+        return Data._changes_result([(CHANGES_KEY, entries)])[0]['event'] if entries else '0'
+
+######################################################################
+#  C A C H E   M E T H O D S
+######################################################################
+
+    @staticmethod
+    async def init_cache(max_size=0, ttl=0):
+        """ Replaces the read-through cache, see Data.init_cache
+
+        The cache object is shared with Data, and the invalidation listener
+        runs as a task on the event loop instead of a thread.
+        """
+        if AsyncData.cache_listener:
+            AsyncData.cache_listener.cancel()
+            AsyncData.cache_listener = None
+        Data.cache = DataCache(max_size, ttl)
+        if Data.cache.enabled and AsyncData.redis:
+            pubsub = AsyncData.redis.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(Data._key(INVALIDATION_CHANNEL))
+            AsyncData.cache_listener = asyncio.ensure_future(AsyncData.__listen(pubsub))
+        AsyncData.logger.info('Data cache size %d ttl %d', max_size, ttl)
+
+    @staticmethod
+    async def __listen(pubsub):
+        """ Evicts the ids published by writers until cancelled """
+        try:
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    Data._on_invalidate(message)
+        finally:
+            await pubsub.aclose()
+
+######################################################################
+#  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def pool_stats(pool=None):
+        """ Reports how many connections of the Redis pool are in use """
+        return Data.pool_stats(pool or AsyncData.redis.connection_pool)
+
+    @staticmethod
+    async def connect_to_redis(hostname, port, password):
+        """ Connects to Redis through a configured pool and tests the connection """
+        AsyncData.logger.info("Testing Connection to: %s:%s", hostname, port)
+        pool = BlockingConnectionPool(host=hostname, port=port, password=password,
+                                      **Data.pool_options())
+        AsyncData.redis = Redis(connection_pool=pool)
+        pool = BlockingConnectionPool(host=hostname, port=port, password=password,
+                                      **Data.changes_pool_options())
+        AsyncData.changes_redis = Redis(connection_pool=pool)
+        try:
+            await AsyncData.redis.ping()
+            AsyncData.logger.info("Connection established")
+        except ConnectionError:
+            AsyncData.logger.info("Connection Error from: %s:%s", hostname, port)
+            AsyncData.redis = None
+            AsyncData.changes_redis = None
+        return AsyncData.redis
+
+    @staticmethod
+    async def init_db(redis=None):
+        """
+        Initialized Redis database connection, see Data.init_db
+
+        Exception:
+        ----------
+          redis.ConnectionError - if ping() test fails
+        """
+        Data.codec = get_codec(os.getenv('DATA_CODEC') or DEFAULT_CODEC)
+        Data.key_prefix = os.getenv('DATA_KEY_PREFIX', DEFAULT_KEY_PREFIX)
+        Data.changes_length = int(os.getenv('DATA_CHANGES_LENGTH', DEFAULT_CHANGES_LENGTH))
+        AsyncData.changes_redis = None
+        AsyncData.scripts.clear()
+        if redis:
+            AsyncData.logger.info("Using client connection...")
+            AsyncData.redis = redis
+            try:
+                await AsyncData.redis.ping()
+                AsyncData.logger.info("Connection established")
+            except ConnectionError:
+                AsyncData.logger.error("Client Connection Error!")
+                AsyncData.redis = None
+                raise ConnectionError('Could not connect to the Redis Service')
+        elif 'VCAP_SERVICES' in os.environ:
+            # Get the credentials from the Bluemix environment
+            AsyncData.logger.info("Using VCAP_SERVICES...")
+            services = json.loads(os.environ['VCAP_SERVICES'])
+            creds = services['rediscloud'][0]['credentials']
+            await AsyncData.connect_to_redis(creds['hostname'], creds['port'], creds['password'])
+        else:
+            AsyncData.logger.info("VCAP_SERVICES not found, checking localhost for Redis")
+            await AsyncData.connect_to_redis(os.environ['REDIS_ADDR'], os.environ['REDIS_PORT'], None)
+            if not AsyncData.redis:
+                AsyncData.logger.info("No Redis on localhost, looking for redis host")
+                await AsyncData.connect_to_redis('redis', 6379, None)
+        if not AsyncData.redis:
+            # if you end up here, redis instance is down.
+            AsyncData.logger.fatal('*** FATAL ERROR: Could not connect to the Redis Service')
+            raise ConnectionError('Could not connect to the Redis Service')
+        instrument_redis(AsyncData.redis)
+        await AsyncData.init_cache(int(os.getenv('DATA_CACHE_SIZE', '0')),
+                                   int(os.getenv('DATA_CACHE_TTL', '30')))
@@ -0,0 +1,832 @@
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asynchronous Data API Controller
+
+This module provides the same REST API as server.py as an ASGI application
+built on Starlette and the asyncio Data model in amodels.py. A worker keeps
+serving other requests while one is waiting on Redis or on the functions
+proxy, so fewer workers are needed for the same number of connections.
+
+Run it with an ASGI server, for example:
+uvicorn aserver:app --host 0.0.0.0 --port 5000 --workers 4
+
+The paths, status codes and ETags are the ones documented in server.py.
+This module needs Python 3.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+from time import time
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from redis.exceptions import ConnectionError, TimeoutError
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Match, Mount, Route
+from starlette.staticfiles import StaticFiles
+from models import Data, DataValidationError, DataConflictError, DataVersionError, \
+    DataChangesExpiredError, CHANGE_ID_PATTERN, INDEXED_ATTRIBUTES, RATE_LIMIT_KEY, \
+    SORT_ATTRIBUTES
+from amodels import AsyncData
+from proxy import FunctionsProxy, CircuitOpenError, UpstreamConnectionError, \
+    UpstreamTimeoutError, proxy_options
+from ratelimit import AdmissionControl, admission_options
+import metrics
+
+# Pull options from environment
+DEBUG = (os.getenv('DEBUG', 'False') == 'True')
+PORT = os.getenv('PORT', '5000')
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+MAX_BULK_SIZE = int(os.getenv('MAX_BULK_SIZE', '1000'))
+CHANGES_POLL_MS = int(os.getenv('CHANGES_POLL_MS', '2000'))
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# Status Codes
+HTTP_200_OK = 200
+HTTP_201_CREATED = 201
+HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
+HTTP_400_BAD_REQUEST = 400
+HTTP_404_NOT_FOUND = 404
+HTTP_409_CONFLICT = 409
+HTTP_410_GONE = 410
+HTTP_412_PRECONDITION_FAILED = 412
+HTTP_429_TOO_MANY_REQUESTS = 429
+HTTP_502_BAD_GATEWAY = 502
+HTTP_503_SERVICE_UNAVAILABLE = 503
+HTTP_504_GATEWAY_TIMEOUT = 504
+
+# Media Types
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+EVENT_STREAM = 'text/event-stream'
+FORM = 'application/x-www-form-urlencoded'
+
+logger = logging.getLogger('aserver')
+
+# Pooled client for the calls of the /functions endpoint
+proxy = FunctionsProxy(**proxy_options())
+
+# Report the cache, pool and proxy counters with the other metrics
+metrics.REGISTRY.add_collector(lambda: metrics.cache_metrics(Data.cache.stats()))
+metrics.REGISTRY.add_collector(lambda: metrics.pool_metrics(AsyncData.pool_stats())
+                               if AsyncData.redis else [])
+metrics.REGISTRY.add_collector(lambda: metrics.proxy_metrics(proxy.stats()))
+
+# Rate limits and concurrency cap, see ratelimit.py
+admission = AdmissionControl(**admission_options())
+metrics.REGISTRY.add_collector(lambda: metrics.admission_metrics(admission.stats()))
+
+######################################################################
+# Error Handlers
+######################################################################
+async def http_error(request, error):
+    """ Handles every HTTP error with a JSON body like server.py """
+    message = error.detail or HTTPStatus(error.status_code).description
+    logger.info(message)
+    return JSONResponse({'status': error.status_code,
+                         'error': HTTPStatus(error.status_code).phrase,
+                         'message': message},
+                        status_code=error.status_code, headers=error.headers)
+
+async def request_validation_error(request, error):
+    """ Handles Value Errors from bad data """
+    return await http_error(request, HTTPException(HTTP_400_BAD_REQUEST, str(error)))
+
+async def changes_expired(request, error):
+    """ Handles change feed reads from before the oldest event kept """
+    return await http_error(request, HTTPException(HTTP_410_GONE, str(error)))
+
+
+######################################################################
+# GET INDEX
+######################################################################
+async def index(request):
+    """ Send back the home page """
+    return FileResponse(os.path.join(STATIC, 'index.html'))
+
+async def functions(request):
+    """ Calls a cloud function, or sends back the functions page """
+    if request.method == 'POST':
+        params = await json_body(request) or await request.form()
+
+        # api_key is used as a Basic authentication (already in the form of user:pass)
+        # and the proxy is blocking, so keep it off the event loop
+        try:
+            _, text = await run_in_threadpool(
+                proxy.call, params['url'], params['name'], params['api_key'])
+        except CircuitOpenError as error:
+            raise HTTPException(HTTP_503_SERVICE_UNAVAILABLE, str(error),
+                                headers={'Retry-After': str(error.retry_after)})
+        except UpstreamTimeoutError as error:
+            raise HTTPException(HTTP_504_GATEWAY_TIMEOUT, str(error))
+        except UpstreamConnectionError as error:
+            raise HTTPException(HTTP_502_BAD_GATEWAY, str(error))
+
+        return JSONResponse({'message': text}, status_code=HTTP_200_OK)
+
+    return FileResponse(os.path.join(STATIC, 'functions.html'))
+
+async def functions_stats(request):
+    """ Returns the upstream latencies, circuit states and cache counters of the proxy """
+    return JSONResponse(proxy.stats(), status_code=HTTP_200_OK)
+
+######################################################################
+# HEALTH CHECK
+######################################################################
+async def health(request):
+    """ Reports whether Redis answers and how busy the connection pool is """
+    try:
+        await AsyncData.redis.ping()
+    except (ConnectionError, TimeoutError) as error:
+        logger.error('Health check failed: %s', error)
+        return JSONResponse({'status': 'DOWN', 'message': str(error)},
+                            status_code=HTTP_503_SERVICE_UNAVAILABLE)
+    return JSONResponse({'status': 'OK', 'pool': AsyncData.pool_stats()},
+                        status_code=HTTP_200_OK)
+
+######################################################################
+# CACHE STATISTICS
+######################################################################
+async def cache_stats(request):
+    """ Returns the counters of the Data cache """
+    return JSONResponse(Data.cache.stats(), status_code=HTTP_200_OK)
+
+######################################################################
+# METRICS
+######################################################################
+async def metrics_text(request):
+    """ Returns the service metrics in the Prometheus text format """
+    return Response(metrics.REGISTRY.render(), status_code=HTTP_200_OK,
+                    headers={'Content-Type': metrics.CONTENT_TYPE})
+
+class MetricsMiddleware(object):
+    """ Records the count, latency and in flight requests by route """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time()
+        status = [500]
+
+        async def send_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        metrics.HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            metrics.HTTP_IN_FLIGHT.dec()
+            # the router stores the matched endpoint in the scope
+            route = ROUTE_PATHS.get(scope.get('endpoint'), 'unmatched')
+            metrics.observe_request(scope['method'], route, status[0], started)
+
+class AdmissionMiddleware(object):
+    """ Refuses requests over the concurrency cap or rate limit, see server.admit_request """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        endpoint = self.endpoint_of(scope)
+        # a stream of changes holds its slot for as long as it is open
+        counted = not (endpoint == 'list_changes' and wants_event_stream(Request(scope)))
+        if counted and not admission.enter():
+            response = await http_error(None, HTTPException(
+                HTTP_503_SERVICE_UNAVAILABLE, 'The server is busy, retry shortly',
+                headers={'Retry-After': '1'}))
+            await response(scope, receive, send)
+            return
+        try:
+            retry_after = await self.rate_limit(scope, endpoint)
+            if retry_after:
+                message = 'Too many requests to {}, retry in {} seconds'.format(
+                    endpoint, retry_after)
+                response = await http_error(None, HTTPException(
+                    HTTP_429_TOO_MANY_REQUESTS, message,
+                    headers={'Retry-After': str(retry_after)}))
+                await response(scope, receive, send)
+                return
+            await self.app(scope, receive, send)
+        finally:
+            if counted:
+                admission.leave()
+
+    @staticmethod
+    def endpoint_of(scope):
+        """ Returns the name of the route a request goes to
+
+        The router has not run yet, so the route is matched here and its
+        endpoint noted in the scope for the metrics of refused requests.
+        """
+        for route in routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                if 'endpoint' in child_scope:
+                    scope['endpoint'] = child_scope['endpoint']
+                return route.name
+        return 'unmatched'
+
+    @staticmethod
+    async def rate_limit(scope, endpoint):
+        """ Takes a token from the client's bucket and returns the seconds to wait """
+        args = admission.bucket_args(endpoint)
+        if args is None or AsyncData.redis is None:
+            return 0
+        headers = dict(scope['headers'])
+        forwarded_for = headers.get(b'x-forwarded-for', b'').decode('latin-1')
+        client = admission.client_of((scope.get('client') or [None])[0], forwarded_for)
+        try:
+            reply = await admission.bucket_script(AsyncData.redis)(
+                keys=[Data._key(RATE_LIMIT_KEY, endpoint, client)], args=args)
+        except (ConnectionError, TimeoutError) as error:
+            logger.warning('Rate limit of %s not checked: %s', endpoint, error)
+            return 0
+        return admission.retry_after(endpoint, reply)
+
+######################################################################
+# LIST ALL DATA
+######################################################################
+async def list_data(request):
+    """ Returns all of the Datas, see server.list_data """
+    etag = await collection_etag(request)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return not_modified(etag)
+    filters = dict((attribute, request.query_params[attribute])
+                   for attribute in INDEXED_ATTRIBUTES if request.query_params.get(attribute))
+    sort = request.query_params.get('sort')
+    if sort and sort.lstrip('-') not in SORT_ATTRIBUTES:
+        raise HTTPException(HTTP_400_BAD_REQUEST,
+                            'sort must be one of {}'.format(', '.join(SORT_ATTRIBUTES)))
+    if filters or sort:
+        datas = await AsyncData.query(filters, sort)
+    elif 'limit' in request.query_params or 'cursor' in request.query_params:
+        return await list_data_page(request, etag)
+    else:
+        datas = AsyncData.iter_all()
+
+    if request.query_params.get('stream') or wants_ndjson(request):
+        response = stream_data(request, datas)
+    else:
+        if isinstance(datas, list):
+            results = [data.serialize() for data in datas]
+        else:
+            results = [data.serialize() async for data in datas]
+        response = JSONResponse(results, status_code=HTTP_200_OK)
+    set_etag(response, etag)
+    return response
+
+def wants_ndjson(request):
+    """ Checks if the client prefers newline delimited JSON """
+    accept = parse_accept(request.headers.get('Accept', '*/*'))
+    return accept_quality(accept, NDJSON) > accept_quality(accept, JSON)
+
+def stream_data(request, datas):
+    """ Streams Datas one record at a time instead of building the whole body
+
+    The body is NDJSON when the client accepts it, otherwise a JSON array
+    that is written out incrementally.
+    """
+    async def records():
+        if isinstance(datas, list):
+            for data in datas:
+                yield data
+        else:
+            async for data in datas:
+                yield data
+
+    if wants_ndjson(request):
+        async def generate():
+            async for data in records():
+                yield json.dumps(data.serialize()) + '\n'
+        return StreamingResponse(generate(), status_code=HTTP_200_OK, media_type=NDJSON)
+
+    async def generate():
+        separator = '['
+        async for data in records():
+            yield separator + json.dumps(data.serialize())
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+    return StreamingResponse(generate(), status_code=HTTP_200_OK, media_type=JSON)
+
+async def list_data_page(request, etag):
+    """ Returns one page of Datas with a link to the next page """
+    try:
+        limit = int(request.query_params.get('limit', MAX_PAGE_SIZE))
+        cursor = int(request.query_params.get('cursor', 0))
+    except ValueError:
+        raise HTTPException(HTTP_400_BAD_REQUEST, 'limit and cursor must be integers')
+    if limit < 1 or cursor < 0:
+        raise HTTPException(HTTP_400_BAD_REQUEST,
+                            'limit must be positive and cursor must not be negative')
+    cursor, datas = await AsyncData.page(cursor, min(limit, MAX_PAGE_SIZE))
+    results = [data.serialize() for data in datas]
+    headers = {'X-Next-Cursor': str(cursor)}
+    if cursor:
+        next_url = request.url_for('list_data').include_query_params(limit=limit, cursor=cursor)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    response = JSONResponse(results, status_code=HTTP_200_OK, headers=headers)
+    set_etag(response, etag)
+    return response
+
+######################################################################
+# SEARCH DATA
+######################################################################
+async def search_data(request):
+    """
+    Searches the Datas by name and category, see server.search_data
+    """
+    query = request.query_params.get('q', '')
+    try:
+        limit = int(request.query_params.get('limit', MAX_PAGE_SIZE))
+        offset = int(request.query_params.get('offset', 0))
+    except ValueError:
+        raise HTTPException(HTTP_400_BAD_REQUEST, 'limit and offset must be integers')
+    if limit < 1 or offset < 0:
+        raise HTTPException(HTTP_400_BAD_REQUEST,
+                            'limit must be positive and offset must not be negative')
+    if not AsyncData._search_words(query):
+        raise HTTPException(HTTP_400_BAD_REQUEST, 'q must contain a word to search for')
+    limit = min(limit, MAX_PAGE_SIZE)
+    total, datas = await AsyncData.search(query, offset, limit)
+    results = [data.serialize() for data in datas]
+    headers = {'X-Total-Count': str(total)}
+    if offset + limit < total:
+        next_url = request.url_for('search_data').include_query_params(
+            q=query, limit=limit, offset=offset + limit)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return JSONResponse(results, status_code=HTTP_200_OK, headers=headers)
+
+######################################################################
+# COUNT DATA
+######################################################################
+async def data_stats(request):
+    """ Returns the number of Datas and of available ones, overall and by category """
+    return JSONResponse(await AsyncData.counts(), status_code=HTTP_200_OK)
+
+######################################################################
+# FOLLOW DATA CHANGES
+######################################################################
+async def list_changes(request):
+    """
+    Returns the changes made to the Datas after an event, see server.list_changes
+    """
+    since = request.query_params.get('since') or request.headers.get('Last-Event-ID')
+    if since and not CHANGE_ID_PATTERN.match(since):
+        raise HTTPException(HTTP_400_BAD_REQUEST, 'since must be the id of an event')
+    try:
+        limit = int(request.query_params.get('limit', MAX_PAGE_SIZE))
+    except ValueError:
+        raise HTTPException(HTTP_400_BAD_REQUEST, 'limit must be an integer')
+    if limit < 1:
+        raise HTTPException(HTTP_400_BAD_REQUEST, 'limit must be positive')
+    limit = min(limit, MAX_PAGE_SIZE)
+    if wants_event_stream(request):
+        return await stream_changes(since or await AsyncData.last_change_id(), limit)
+    events = await AsyncData.changes(since or '0', limit)
+    last = events[-1]['event'] if events else since or '0'
+    headers = {'X-Last-Event-ID': last}
+    if len(events) == limit:
+        next_url = request.url_for('list_changes').include_query_params(since=last, limit=limit)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return JSONResponse(events, status_code=HTTP_200_OK, headers=headers)
+
+def wants_event_stream(request):
+    """ Checks if the client asks for server-sent events """
+    accept = parse_accept(request.headers.get('Accept', '*/*'))
+    return accept_quality(accept, EVENT_STREAM) > accept_quality(accept, JSON)
+
+async def stream_changes(since, limit):
+    """ Streams the changes after since as server-sent events, see server.stream_changes """
+    events = await AsyncData.changes(since, limit)  # a 410 must be sent before the stream
+
+    async def generate(events, since):
+        while True:
+            if not events:
+                yield ': keep-alive\n\n'
+            for event in events:
+                since = event['event']
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                    since, event['op'], json.dumps(event))
+            try:
+                events = await AsyncData.changes(since, limit, CHANGES_POLL_MS)
+            except DataChangesExpiredError as error:
+                yield 'event: expired\ndata: {}\n\n'.format(json.dumps({'message': str(error)}))
+                return
+    return StreamingResponse(generate(events, since), status_code=HTTP_200_OK,
+                             media_type=EVENT_STREAM, headers={'Cache-Control': 'no-cache'})
+
+######################################################################
+# RETRIEVE A DATA
+######################################################################
+async def get_data(request):
+    """
+    Retrieve a single Data
+
+    This endpoint will return a Data based on it's id
+    """
+    data_id = request.path_params['data_id']
+    version = await AsyncData.version_of(data_id)
+    etag = data_etag(data_id, version)
+    if version and etag_matches(request.headers.get('If-None-Match'), etag):
+        return not_modified(etag)
+    data = await AsyncData.find(data_id)
+    if not data:
+        raise HTTPException(HTTP_404_NOT_FOUND, "Data with id '{}' was not found.".format(data_id))
+    response = JSONResponse(data.serialize(), status_code=HTTP_200_OK)
+    set_etag(response, etag)
+    return response
+
+######################################################################
+# ADD A NEW DATA
+######################################################################
+async def create_data(request):
+    """
+    Creates a Data
+
+    This endpoint will create a Data based the data in the body that is posted
+    or data that is sent via an html form post.
+    """
+    if request.headers.get('Content-Type') == FORM:
+        logger.info('Processing FORM data')
+        form = await request.form()
+        item = {
+            'name': form['name'],
+            'category': form['category'],
+            'available': form['available'].lower() in ['true', '1', 't']
+        }
+    else:
+        logger.info('Processing JSON data')
+        item = await json_body(request)
+
+    data = AsyncData()
+    data.deserialize(item)
+    await data.save()
+    location = request.url_for('get_data', data_id=data.id)
+    response = JSONResponse(data.serialize(), status_code=HTTP_201_CREATED,
+                            headers={'Location': str(location)})
+    set_etag(response, data_etag(data.id, data.version))
+    return response
+
+######################################################################
+# UPDATE AN EXISTING DATA
+######################################################################
+async def update_data(request):
+    """
+    Update a Data
+
+    This endpoint will update a Data based the body that is posted
+    """
+    data_id = request.path_params['data_id']
+    data = await AsyncData.find(data_id)
+    if not data:
+        raise HTTPException(HTTP_404_NOT_FOUND, "Data with id '{}' was not found.".format(data_id))
+    data.deserialize(await json_body(request))
+    data.id = data_id
+    try:
+        await data.save(if_match_versions(request, data_id))
+    except DataVersionError as error:
+        raise HTTPException(HTTP_412_PRECONDITION_FAILED, str(error))
+    response = JSONResponse(data.serialize(), status_code=HTTP_200_OK)
+    set_etag(response, data_etag(data.id, data.version))
+    return response
+
+######################################################################
+# DELETE A DATA
+######################################################################
+async def delete_data(request):
+    """
+    Delete a Data
+
+    This endpoint will delete a Data based the id specified in the path
+    """
+    data_id = request.path_params['data_id']
+    data = await AsyncData.find(data_id)
+    if data:
+        try:
+            await data.delete(if_match_versions(request, data_id))
+        except DataVersionError as error:
+            raise HTTPException(HTTP_412_PRECONDITION_FAILED, str(error))
+    elif request.headers.get('If-Match'):
+        raise HTTPException(HTTP_412_PRECONDITION_FAILED,
+                            "Data with id '{}' was not found.".format(data_id))
+    return Response(status_code=HTTP_204_NO_CONTENT)
+
+######################################################################
+# BULK CREATE, UPDATE AND DELETE
+######################################################################
+async def create_data_bulk(request):
+    """
+    Creates many Datas
+
+    The body is a list of Datas. Every valid Data is created in a single
+    transaction and the response reports a status for each item in order.
+    """
+    items = await get_bulk_items(request)
+    results = [None] * len(items)
+    datas = []
+    for position, item in enumerate(items):
+        try:
+            datas.append((position, bulk_data(AsyncData(), item)))
+        except DataValidationError as error:
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, error)
+    await save_bulk(datas, results, HTTP_201_CREATED)
+    return JSONResponse({'results': results}, status_code=HTTP_200_OK)
+
+async def update_data_bulk(request):
+    """
+    Updates many Datas
+
+    The body is a list of Datas that each carry the id to update. Every
+    Data that exists and is valid is updated in a single transaction.
+    """
+    items = await get_bulk_items(request)
+    results = [None] * len(items)
+    ids = []
+    for position, item in enumerate(items):
+        try:
+            ids.append((position, int(item['id'])))
+        except (KeyError, TypeError, ValueError):
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, 'Invalid data: missing or bad id')
+    datas = []
+    found = await AsyncData.find_many([data_id for _, data_id in ids])
+    for (position, data_id), data in zip(ids, found):
+        if not data:
+            message = "Data with id '{}' was not found.".format(data_id)
+            results[position] = bulk_error(HTTP_404_NOT_FOUND, message)
+            continue
+        try:
+            datas.append((position, bulk_data(data, items[position])))
+        except DataValidationError as error:
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, error)
+    await save_bulk(datas, results, HTTP_200_OK)
+    return JSONResponse({'results': results}, status_code=HTTP_200_OK)
+
+async def delete_data_bulk(request):
+    """
+    Deletes many Datas
+
+    The body is a list of ids. Like DELETE /data/{id}, ids that do not
+    exist are reported as deleted.
+    """
+    items = await get_bulk_items(request)
+    results = [None] * len(items)
+    ids = []
+    for position, item in enumerate(items):
+        try:
+            ids.append(int(item))
+            results[position] = {'id': ids[-1], 'status': HTTP_204_NO_CONTENT}
+        except (TypeError, ValueError):
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, 'Invalid id: {}'.format(item))
+    await AsyncData.delete_many(ids)
+    return JSONResponse({'results': results}, status_code=HTTP_200_OK)
+
+async def get_bulk_items(request):
+    """ Returns the list of items in the body of a bulk request """
+    items = await json_body(request)
+    if not isinstance(items, list):
+        raise HTTPException(HTTP_400_BAD_REQUEST, 'The body of a bulk request must be a JSON list')
+    if len(items) > MAX_BULK_SIZE:
+        raise HTTPException(HTTP_400_BAD_REQUEST,
+                            'A bulk request is limited to {} items'.format(MAX_BULK_SIZE))
+    return items
+
+async def save_bulk(datas, results, status):
+    """ Saves the (position, Data) pairs and records their results """
+    await AsyncData.save_many([data for _, data in datas])
+    for position, data in datas:
+        results[position] = {'id': data.id, 'status': status, 'data': data.serialize()}
+
+def bulk_data(data, item):
+    """ Deserializes a bulk item into data and checks the fields save_many requires
+
+    save_many refuses the whole batch over one invalid Data, so each item
+    is checked here and reported on its own instead.
+    """
+    data.deserialize(item)
+    if data.name is None:
+        raise DataValidationError('name attribute is not set')
+    return data
+
+def bulk_error(status, error):
+    """ Builds the result of a bulk item that failed """
+    return {'status': status, 'error': str(error)}
+
+######################################################################
+# PURCHASE A DATA
+######################################################################
+async def purchase_data(request):
+    """ Purchase a Data """
+    data_id = request.path_params['data_id']
+    try:
+        data = await AsyncData.purchase(data_id, if_match_versions(request, data_id))
+    except DataConflictError as error:
+        raise HTTPException(HTTP_409_CONFLICT, str(error))
+    except DataVersionError as error:
+        raise HTTPException(HTTP_412_PRECONDITION_FAILED, str(error))
+    if not data:
+        raise HTTPException(HTTP_404_NOT_FOUND, "Data with id '{}' was not found.".format(data_id))
+    response = JSONResponse(data.serialize(), status_code=HTTP_200_OK)
+    set_etag(response, data_etag(data.id, data.version))
+    return response
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+async def json_body(request):
+    """ Returns the JSON body of a request, None if it has none """
+    if request.headers.get('Content-Type', '').split(';')[0].strip() != JSON:
+        return None
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        return None
+
+def parse_accept(header):
+    """ Parses an Accept header into a dictionary of media type to quality """
+    accept = {}
+    for part in header.split(','):
+        media, _, params = part.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media:
+            accept[media.strip().lower()] = quality
+    return accept
+
+def accept_quality(accept, media):
+    """ Returns the quality of a media type, falling back to the wildcards """
+    for candidate in (media, media.split('/')[0] + '/*', '*/*'):
+        if candidate in accept:
+            return accept[candidate]
+    return 0.0
+
+def parse_etags(header):
+    """ Returns the unquoted tags of an If-Match or If-None-Match header """
+    tags = []
+    for tag in (header or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag.strip('"'))
+    return tags
+
+def etag_matches(header, etag):
+    """ Checks if an If-None-Match header contains etag """
+    tags = parse_etags(header)
+    return etag in tags or '*' in tags
+
+def set_etag(response, etag):
+    """ Sets the strong ETag of a response """
+    response.headers['ETag'] = '"{}"'.format(etag)
+
+def data_etag(data_id, version):
+    """ Returns the strong ETag of a Data at a version """
+    return '{}-{}'.format(data_id, version)
+
+async def collection_etag(request):
+    """ Returns the strong ETag of a list query at the current collection version
+
+    The query string and the media type are part of the tag so that every
+    distinct representation of the collection has its own.
+    """
+    query = request.scope['query_string'] + (b'|ndjson' if wants_ndjson(request) else b'')
+    digest = hashlib.sha1(query).hexdigest()[:16]
+    return 'c{}-{}'.format(await AsyncData.collection_version(), digest)
+
+def if_match_versions(request, data_id):
+    """ Returns the versions of a Data accepted by If-Match, None for any """
+    tags = parse_etags(request.headers.get('If-Match'))
+    if not tags or '*' in tags:
+        return None
+    versions = set()
+    for tag in tags:
+        tag_id, _, version = tag.partition('-')
+        if tag_id == str(data_id) and version.isdigit():
+            versions.add(int(version))
+    return versions
+
+def not_modified(etag):
+    """ Builds a 304 response without serializing anything """
+    response = Response(status_code=HTTP_304_NOT_MODIFIED)
+    set_etag(response, etag)
+    return response
+
+async def init_db(redis=None):
+    """ Initlaize the model """
+    await AsyncData.init_db(redis)
+
+# load sample data
+async def data_load(payload):
+    """ Loads a Data into the database """
+    data = AsyncData(0, payload['name'], payload['category'])
+    await data.save()
+
+async def data_reset():
+    """ Removes all Datas from the database """
+    await AsyncData.remove_all()
+
+def initialize_logging(log_level):
+    """ Initialized the default logging to STDOUT """
+    fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+    logging.basicConfig(stream=sys.stdout, level=log_level, format=fmt)
+    logger.setLevel(log_level)
+    logger.info('Logging handler established')
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Connects to Redis when the server starts and stops the cache listener """
+    await init_db()
+    yield
+    if AsyncData.cache_listener:
+        AsyncData.cache_listener.cancel()
+        AsyncData.cache_listener = None
+
+
+######################################################################
+#  R O U T E S
+######################################################################
+routes = [
+    Route('/', index),
+    Route('/functions', functions, methods=['GET', 'POST']),
+    Route('/functions/stats', functions_stats, methods=['GET']),
+    Route('/health', health, methods=['GET']),
+    Route('/cache', cache_stats, methods=['GET']),
+    Route('/metrics', metrics_text, methods=['GET']),
+    Route('/data', list_data, methods=['GET']),
+    Route('/data', create_data, methods=['POST']),
+    Route('/data/_bulk', create_data_bulk, methods=['POST']),
+    Route('/data/_bulk', update_data_bulk, methods=['PUT']),
+    Route('/data/_bulk', delete_data_bulk, methods=['DELETE']),
+    Route('/data/search', search_data, methods=['GET']),
+    Route('/data/stats', data_stats, methods=['GET']),
+    Route('/data/changes', list_changes, methods=['GET']),
+    Route('/data/{data_id:int}', get_data, methods=['GET']),
+    Route('/data/{data_id:int}', update_data, methods=['PUT']),
+    Route('/data/{data_id:int}', delete_data, methods=['DELETE']),
+    Route('/data/{data_id:int}/purchase', purchase_data, methods=['PUT']),
+    Mount('/static', StaticFiles(directory=STATIC), name='static'),
+]
+
+# Route templates by endpoint, the labels of the request metrics
+ROUTE_PATHS = dict((route.endpoint, route.path) for route in routes if isinstance(route, Route))
+
+exception_handlers = {
+    HTTPException: http_error,
+    DataValidationError: request_validation_error,
+    DataChangesExpiredError: changes_expired,
+}
+
+# Create Starlette application
+app = Starlette(debug=DEBUG, routes=routes, exception_handlers=exception_handlers,
+                middleware=[Middleware(MetricsMiddleware), Middleware(AdmissionMiddleware)],
+                lifespan=lifespan)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    import uvicorn
+    print("************************************************************")
+    print("   A S Y N C   R E S T   A P I   S E R V I C E ")
+    print("************************************************************")
+    initialize_logging(logging.INFO)
+    uvicorn.run(app, host='0.0.0.0', port=int(PORT))
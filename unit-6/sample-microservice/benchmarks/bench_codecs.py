@@ -0,0 +1,97 @@
+"""
+Record Codec Benchmark
+
+Compares the bytes stored per record and the encode/decode time of every
+available codec against the original pickle format. No Redis server is
+needed; the hash codec is measured as the field names and values that
+Redis has to store.
+
+Run it from the sample-microservice directory with:
+python benchmarks/bench_codecs.py --records 100000
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from codec import CODECS, HashCodec, get_codec  # pylint: disable=wrong-import-position
+
+CATEGORIES = ['dog', 'cat', 'fish', 'bird', None]
+
+
+def make_records(count):
+    """ Builds count sample records shaped like the ones the API stores """
+    return [{
+        'id': i + 1,
+        'name': u'pet-{}'.format(i),
+        'category': CATEGORIES[i % len(CATEGORIES)],
+        'available': i % 3 != 0
+    } for i in range(count)]
+
+
+def stored_size(codec, encoded):
+    """ Returns the number of payload bytes Redis stores for one record """
+    if isinstance(codec, HashCodec):
+        return sum(len(str(field)) + len(str(value)) for field, value in encoded.items())
+    return len(encoded)
+
+
+def hmget_reply(encoded):
+    """ Converts a hash mapping into the value list HMGET would return """
+    return [str(encoded[field]).encode('utf-8') if field in encoded else None
+            for field in ('id', 'name', 'category', 'available')]
+
+
+def bench(codec, records, repeat):
+    """ Measures one codec and returns its results as a dictionary """
+    encoded = [codec.encode(record) for record in records]
+    if isinstance(codec, HashCodec):
+        replies = [hmget_reply(value) for value in encoded]
+    else:
+        replies = encoded
+    assert [codec.decode(value) for value in replies] == records
+    encode = min(timeit.repeat(lambda: [codec.encode(r) for r in records], number=1, repeat=repeat))
+    decode = min(timeit.repeat(lambda: [codec.decode(v) for v in replies], number=1, repeat=repeat))
+    total = sum(stored_size(codec, value) for value in encoded)
+    return {
+        'codec': codec.name,
+        'bytes_per_record': float(total) / len(records),
+        'encode_us_per_record': encode * 1e6 / len(records),
+        'decode_us_per_record': decode * 1e6 / len(records)
+    }
+
+
+def main():
+    """ Runs the benchmark for every codec that can be loaded """
+    parser = ArgumentParser(description='Benchmark the Data record codecs')
+    parser.add_argument('-n', '--records', type=int, default=10000, help='records to encode')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='timing repetitions')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    results = []
+    for name in sorted(CODECS):
+        try:
+            codec = get_codec(name)
+        except ValueError as error:
+            print('skipping {}: {}'.format(name, error), file=sys.stderr)
+            continue
+        results.append(bench(codec, records, args.repeat))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{:<8} {:>12} {:>12} {:>12}'.format('codec', 'bytes/rec', 'encode us', 'decode us'))
+    for result in results:
+        print('{codec:<8} {bytes_per_record:>12.1f} {encode_us_per_record:>12.2f} '
+              '{decode_us_per_record:>12.2f}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Sync versus Async Server Benchmark
+
+Sends the same mixed workload to the Flask server (server.py) and to the
+ASGI server (aserver.py) and reports requests per second and latency
+percentiles for each. Start both servers with the same number of workers
+against the same Redis, for example:
+
+gunicorn -w 4 -k gthread --threads 8 -b :5000 server:app
+uvicorn aserver:app --workers 4 --port 5001
+
+Then run it from the sample-microservice directory with:
+python benchmarks/compare_servers.py --sync-url http://localhost:5000 \
+    --async-url http://localhost:5001 --concurrency 64 --requests 5000
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import random
+import threading
+from argparse import ArgumentParser
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:     # Python 2
+    from urllib2 import Request, urlopen, HTTPError
+
+CATEGORIES = ['dog', 'cat', 'fish', 'bird']
+
+
+def call(method, url, body=None):
+    """ Sends one request and returns its status and body """
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    request = Request(url, data=data, headers={'Content-Type': 'application/json'})
+    request.get_method = lambda: method
+    try:
+        response = urlopen(request, timeout=30)
+        return response.getcode(), response.read()
+    except HTTPError as error:
+        return error.code, error.read()
+
+
+def seed(base_url, count):
+    """ Creates count Datas through the bulk endpoint and returns their ids """
+    ids = []
+    for start in range(0, count, 1000):
+        items = [{'name': 'pet{}'.format(i), 'category': CATEGORIES[i % len(CATEGORIES)],
+                  'available': True} for i in range(start, min(count, start + 1000))]
+        status, body = call('POST', base_url + '/data/_bulk', items)
+        if status != 200:
+            raise SystemExit('seeding {} failed with {}'.format(base_url, status))
+        ids.extend(result['id'] for result in json.loads(body)['results'])
+    return ids
+
+
+def workload(base_url, ids, rng):
+    """ Picks the next request of the mix: mostly reads, some writes """
+    roll = rng.random()
+    if roll < 0.6:
+        return 'get', 'GET', '{}/data/{}'.format(base_url, rng.choice(ids)), None
+    if roll < 0.8:
+        url = '{}/data?category={}'.format(base_url, rng.choice(CATEGORIES))
+        return 'query', 'GET', url, None
+    if roll < 0.9:
+        body = {'name': 'pet', 'category': rng.choice(CATEGORIES), 'available': True}
+        return 'create', 'POST', base_url + '/data', body
+    return 'purchase', 'PUT', '{}/data/{}/purchase'.format(base_url, rng.choice(ids)), None
+
+
+def percentile(values, fraction):
+    """ Returns the value below which fraction of the sorted values fall """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(base_url, ids, total, concurrency, seed_value):
+    """ Runs the workload with concurrency threads and returns the results """
+    latencies = {}
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker(number):
+        rng = random.Random(seed_value + number)
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            name, method, url, body = workload(base_url, ids, rng)
+            started = time.time()
+            status, _ = call(method, url, body)
+            elapsed = time.time() - started
+            with lock:
+                latencies.setdefault(name, []).append(elapsed)
+                if status >= 500:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    everything = sorted(sum(latencies.values(), []))
+    results = {'url': base_url, 'requests': total, 'errors': errors[0],
+               'seconds': elapsed, 'requests_per_second': total / elapsed, 'endpoints': {}}
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        results['endpoints'][name] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000
+        }
+    results['p50_ms'] = percentile(everything, 0.50) * 1000
+    results['p99_ms'] = percentile(everything, 0.99) * 1000
+    return results
+
+
+def main():
+    """ Benchmarks every server given on the command line """
+    parser = ArgumentParser(description='Compare the sync and async Data servers')
+    parser.add_argument('--sync-url', help='base URL of server.py')
+    parser.add_argument('--async-url', help='base URL of aserver.py')
+    parser.add_argument('-n', '--requests', type=int, default=2000, help='requests per server')
+    parser.add_argument('-c', '--concurrency', type=int, default=32, help='concurrent clients')
+    parser.add_argument('--records', type=int, default=1000, help='Datas to seed')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the workload')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    urls = [url.rstrip('/') for url in (args.sync_url, args.async_url) if url]
+    if not urls:
+        parser.error('give --sync-url, --async-url or both')
+    results = []
+    for url in urls:
+        ids = seed(url, args.records)
+        results.append(run(url, ids, args.requests, args.concurrency, args.seed))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print('{url}: {requests_per_second:.0f} req/s, p50 {p50_ms:.1f} ms, '
+              'p99 {p99_ms:.1f} ms, {errors} errors'.format(**result))
+        for name, stats in sorted(result['endpoints'].items()):
+            print('  {:<9} {count:>6} p50 {p50_ms:>7.1f} p95 {p95_ms:>7.1f} '
+                  'p99 {p99_ms:>7.1f} ms'.format(name, **stats))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Load Test Harness
+
+Seeds N Datas, drives a mixed workload against the Data service and
+writes throughput and p50/p95/p99 latency per endpoint as a JSON artefact
+so that branches can be compared. The workload runs against server.app
+in process through the Flask test client, or against a running server
+with --url. Redis is fakeredis unless --redis gives a server to use.
+
+Run it from the sample-microservice directory, for example:
+python benchmarks/load_test.py --records 1000,10000,100000 --requests 2000 \
+    --concurrency 8 --output results.json
+python benchmarks/load_test.py --redis redis://localhost:6379/0 --records 1000000 \
+    --mix get=60,query=20,page=10,create=5,purchase=5 --seed-batch 1000
+
+The mix is a list of endpoint=weight pairs. The endpoints are:
+  get       GET /data/{id}
+  list      GET /data (every record, the O(N) path)
+  page      GET /data?limit=100
+  query     GET /data?category=...
+  search    GET /data/search?q=... (a prefix of a category)
+  create    POST /data
+  update    PUT /data/{id}
+  purchase  PUT /data/{id}/purchase
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import platform
+import threading
+import subprocess
+from argparse import ArgumentParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+os.environ.setdefault('REDIS_ADDR', 'localhost')
+os.environ.setdefault('REDIS_PORT', '6379')
+import server  # pylint: disable=wrong-import-position
+from models import Data  # pylint: disable=wrong-import-position
+from compare_servers import call, percentile  # pylint: disable=wrong-import-position
+
+CATEGORIES = ['dog', 'cat', 'fish', 'bird', 'snake', 'hamster', 'ferret', 'parrot']
+DEFAULT_MIX = 'get=50,query=15,page=10,list=1,create=10,update=7,purchase=7'
+PAGE_SIZE = 100
+
+
+def connect(redis_url):
+    """ Connects the Data model to Redis, or to fakeredis without a URL """
+    if redis_url:
+        from redis import Redis
+        client = Redis.from_url(redis_url)
+    else:
+        import fakeredis
+        client = fakeredis.FakeStrictRedis()
+    server.init_db(client)
+    # the model is connected already, so the app must not reconnect it
+    # to REDIS_ADDR when it serves its first request
+    server.app.before_first_request_funcs.remove(server.init_db)
+    return 'redis' if redis_url else 'fakeredis'
+
+
+def seed(count, batch):
+    """ Loads count Datas and returns the seconds it took
+
+    Each Data goes through server.data_load unless batch is set, in which
+    case batch Datas are saved per transaction with Data.save_many.
+    """
+    server.data_reset()
+    started = time.time()
+    if not batch:
+        for i in range(count):
+            server.data_load({'name': 'pet{}'.format(i),
+                              'category': CATEGORIES[i % len(CATEGORIES)]})
+    else:
+        for start in range(0, count, batch):
+            Data.save_many([Data(0, 'pet{}'.format(i), CATEGORIES[i % len(CATEGORIES)])
+                            for i in range(start, min(count, start + batch))])
+    return time.time() - started
+
+
+def parse_mix(mix):
+    """ Parses endpoint=weight pairs into a list of (endpoint, cumulative weight) """
+    total, cumulative = 0, []
+    for pair in mix.split(','):
+        name, _, weight = pair.partition('=')
+        if name not in REQUESTS:
+            raise SystemExit('unknown endpoint in the mix: {}'.format(name))
+        total += float(weight or 1)
+        cumulative.append((name, total))
+    return [(name, weight / total) for name, weight in cumulative]
+
+
+def pick(mix, rng):
+    """ Picks an endpoint of the mix """
+    roll = rng.random()
+    for name, weight in mix:
+        if roll < weight:
+            return name
+    return mix[-1][0]
+
+
+REQUESTS = {
+    'get': lambda rng, ids: ('GET', '/data/{}'.format(rng.choice(ids)), None),
+    'list': lambda rng, ids: ('GET', '/data', None),
+    'page': lambda rng, ids: ('GET', '/data?limit={}'.format(PAGE_SIZE), None),
+    'query': lambda rng, ids: ('GET', '/data?category={}'.format(rng.choice(CATEGORIES)), None),
+    'search': lambda rng, ids: ('GET', '/data/search?q={}'.format(rng.choice(CATEGORIES)[:2]),
+                                None),
+    'create': lambda rng, ids: ('POST', '/data', {'name': 'new', 'available': True,
+                                                  'category': rng.choice(CATEGORIES)}),
+    'update': lambda rng, ids: ('PUT', '/data/{}'.format(rng.choice(ids)),
+                                {'name': 'upd', 'category': rng.choice(CATEGORIES),
+                                 'available': True}),
+    'purchase': lambda rng, ids: ('PUT', '/data/{}/purchase'.format(rng.choice(ids)), None),
+}
+
+
+def in_process():
+    """ Returns a function that sends a request to server.app """
+    local = threading.local()
+
+    def send(method, path, body):
+        if not hasattr(local, 'client'):
+            local.client = server.app.test_client()
+        data = None if body is None else json.dumps(body)
+        resp = local.client.open(path, method=method, data=data,
+                                 content_type='application/json')
+        resp.get_data()     # read streamed bodies to the end
+        return resp.status_code
+    return send
+
+
+def remote(base_url):
+    """ Returns a function that sends a request to a running server """
+    def send(method, path, body):
+        return call(method, base_url + path, body)[0]
+    return send
+
+
+def run(send, ids, mix, total, concurrency, seed_value):
+    """ Runs total requests with concurrency threads and returns the results """
+    latencies = dict((name, []) for name, _ in mix)
+    errors = dict((name, 0) for name, _ in mix)
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker(number):
+        rng = random.Random(seed_value + number)
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            name = pick(mix, rng)
+            method, path, body = REQUESTS[name](rng, ids)
+            started = time.time()
+            status = send(method, path, body)
+            elapsed = time.time() - started
+            with lock:
+                latencies[name].append(elapsed)
+                if status >= 500:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    endpoints = {}
+    for name, values in sorted(latencies.items()):
+        if not values:
+            continue
+        values.sort()
+        endpoints[name] = {
+            'count': len(values),
+            'errors': errors[name],
+            'requests_per_second': len(values) / elapsed,
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000
+        }
+    return {'requests': total, 'seconds': elapsed,
+            'requests_per_second': total / elapsed, 'endpoints': endpoints}
+
+
+def git_revision():
+    """ Returns the commit being benchmarked, if it can be found """
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE)
+        return output.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """ Seeds and benchmarks the service for every record count given """
+    parser = ArgumentParser(description='Load test the Data service')
+    parser.add_argument('--records', default='1000',
+                        help='comma separated record counts to benchmark, e.g. 1000,100000')
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='requests per run')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='endpoint=weight pairs')
+    parser.add_argument('--redis', help='Redis URL, fakeredis is used without it')
+    parser.add_argument('--url', help='base URL of a running server instead of server.app')
+    parser.add_argument('--seed-batch', type=int, default=0,
+                        help='seed with Data.save_many in batches of this size')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the workload')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    if args.url and not args.redis:
+        parser.error('--url needs --redis, the Redis the server at --url uses')
+    logging.disable(logging.INFO)
+    mix = parse_mix(args.mix)
+    backend = connect(args.redis)
+    send = remote(args.url.rstrip('/')) if args.url else in_process()
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'codec': Data.codec.name,
+        'backend': backend,
+        'target': args.url or 'server.app',
+        'concurrency': args.concurrency,
+        'mix': args.mix,
+        'runs': []
+    }
+    for count in [int(value) for value in args.records.split(',')]:
+        seed_seconds = seed(count, args.seed_batch)
+        ids = list(range(1, count + 1))
+        result = run(send, ids, mix, args.requests, args.concurrency, args.seed)
+        result.update({'records': count, 'seed_seconds': seed_seconds})
+        results['runs'].append(result)
+        print('{records:>9} records: {requests_per_second:>8.0f} req/s '
+              '(seeded in {seed_seconds:.1f} s)'.format(**result), file=sys.stderr)
+        for name, stats in sorted(result['endpoints'].items()):
+            print('  {:<9} {count:>6} p50 {p50_ms:>8.2f} p95 {p95_ms:>8.2f} '
+                  'p99 {p99_ms:>8.2f} ms'.format(name, **stats), file=sys.stderr)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+######################################################################
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Record Codecs for the Data Model
+
+A codec decides how a serialized Data (a dictionary with id, name,
+category and available) is laid out in Redis. Every codec queues its
+commands onto a pipeline instead of calling Redis directly, so the model
+can batch reads and writes for many records into a single round-trip.
+
+  pickle  - a pickled dictionary in a Redis string (the original format)
+  struct  - a packed binary record in a Redis string
+  msgpack - a msgpack array in a Redis string (needs the msgpack package)
+  hash    - a Redis hash per record, so single fields can be read with HMGET
+"""
+
+import pickle
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FIELDS = ('id', 'name', 'category', 'available')
+
+
+def _text(value):
+    """ Converts a value read from Redis into a unicode string """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class StringCodec(object):
+    """ Base class for codecs that store each record as one Redis string """
+
+    name = None
+    partial_reads = False
+
+    def encode(self, record):
+        """ Encodes a record dictionary into a byte string """
+        raise NotImplementedError
+
+    def decode(self, value):
+        """ Decodes a byte string back into a record dictionary """
+        raise NotImplementedError
+
+    def write(self, pipe, key, record):
+        """ Queues the commands that store a record under key """
+        pipe.set(key, self.encode(record))
+
+    def queue_read(self, pipe, keys, fields=None):
+        """ Queues the commands that read the records under keys
+
+        Returns the number of replies the queued commands will produce.
+        Strings cannot be read partially, so fields is ignored.
+        """
+        pipe.mget(keys)
+        return 1
+
+    def decode_read(self, replies, fields=None):
+        """ Decodes the replies of queue_read into records (None if missing) """
+        return [None if value is None else self.decode(value) for value in replies[0]]
+
+
+class PickleCodec(StringCodec):
+    """ Stores each record as a pickled dictionary """
+
+    name = 'pickle'
+
+    def encode(self, record):
+        return pickle.dumps(record)
+
+    def decode(self, value):
+        return pickle.loads(value)
+
+
+class StructCodec(StringCodec):
+    """ Stores each record as a packed binary structure
+
+    The layout is the id, a flag byte (available, has category) and the
+    lengths of the UTF-8 encoded name and category, followed by the two
+    strings. Field names are never repeated in the stored value.
+    """
+
+    name = 'struct'
+    header = struct.Struct('>QBII')
+    AVAILABLE = 0x01
+    HAS_CATEGORY = 0x02
+
+    def encode(self, record):
+        name = record['name'].encode('utf-8')
+        category = record['category']
+        flags = self.AVAILABLE if record['available'] else 0
+        if category is None:
+            category = b''
+        else:
+            category = category.encode('utf-8')
+            flags |= self.HAS_CATEGORY
+        header = self.header.pack(record['id'], flags, len(name), len(category))
+        return header + name + category
+
+    def decode(self, value):
+        record_id, flags, name_len, category_len = self.header.unpack_from(value)
+        start = self.header.size
+        name = value[start:start + name_len].decode('utf-8')
+        category = None
+        if flags & self.HAS_CATEGORY:
+            start += name_len
+            category = value[start:start + category_len].decode('utf-8')
+        return {
+            'id': record_id,
+            'name': name,
+            'category': category,
+            'available': bool(flags & self.AVAILABLE)
+        }
+
+
+class MsgpackCodec(StringCodec):
+    """ Stores each record as a msgpack array in field order """
+
+    name = 'msgpack'
+
+    def encode(self, record):
+        return msgpack.packb([record[field] for field in FIELDS], use_bin_type=True)
+
+    def decode(self, value):
+        return dict(zip(FIELDS, msgpack.unpackb(value, raw=False)))
+
+
+class HashCodec(object):
+    """ Stores each record as a Redis hash with one field per attribute
+
+    Readers can ask for a subset of the fields and only those are sent
+    back by Redis. A missing category is stored as a missing field.
+    """
+
+    name = 'hash'
+    partial_reads = True
+
+    def encode(self, record):
+        """ Encodes a record dictionary into a hash mapping """
+        mapping = {
+            'id': record['id'],
+            'name': record['name'],
+            'available': 1 if record['available'] else 0
+        }
+        if record['category'] is not None:
+            mapping['category'] = record['category']
+        return mapping
+
+    def decode(self, values, fields=FIELDS):
+        """ Decodes the HMGET values for fields back into a record dictionary """
+        record = dict(zip(fields, values))
+        if record.get('id') is None and record.get('name') is None:
+            return None     # no such hash
+        if 'id' in record:
+            record['id'] = int(record['id'])
+        if 'name' in record:
+            record['name'] = _text(record['name'])
+        if 'category' in record:
+            record['category'] = _text(record['category'])
+        if 'available' in record:
+            record['available'] = _text(record['available']) == '1'
+        return record
+
+    def write(self, pipe, key, record):
+        """ Queues the commands that store a record under key """
+        pipe.delete(key)
+        pipe.hset(key, mapping=self.encode(record))
+
+    def queue_read(self, pipe, keys, fields=None):
+        """ Queues one HMGET per key and returns the number of replies """
+        fields = self.__fields(fields)
+        for key in keys:
+            pipe.hmget(key, fields)
+        return len(keys)
+
+    def decode_read(self, replies, fields=None):
+        """ Decodes the replies of queue_read into records (None if missing) """
+        fields = self.__fields(fields)
+        return [self.decode(values, fields) for values in replies]
+
+    @staticmethod
+    def __fields(fields):
+        """ Always reads the id and name so a missing hash can be detected """
+        if fields is None:
+            return FIELDS
+        return ('id', 'name') + tuple(f for f in fields if f not in ('id', 'name'))
+
+
+CODECS = {
+    PickleCodec.name: PickleCodec,
+    StructCodec.name: StructCodec,
+    MsgpackCodec.name: MsgpackCodec,
+    HashCodec.name: HashCodec,
+}
+
+
+def get_codec(name):
+    """ Returns a new codec by name """
+    if name not in CODECS:
+        raise ValueError('Unknown codec: {}'.format(name))
+    if name == MsgpackCodec.name and msgpack is None:
+        raise ValueError('The msgpack codec needs the msgpack package installed')
+    return CODECS[name]()
@@ -0,0 +1,421 @@
+######################################################################
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Prometheus Metrics for the Data Service
+
+Counters, gauges and histograms that are rendered in the Prometheus text
+exposition format by the /metrics endpoint. The service records:
+
+  http_requests_total              - requests by method, route and status
+  http_request_duration_seconds    - request latency by method and route
+  http_requests_in_flight          - requests being served right now
+  redis_commands_total             - Redis commands and pipelines by command
+  redis_command_errors_total       - Redis commands that raised by command
+  redis_command_duration_seconds   - Redis round-trip latency by command
+  redis_pipeline_commands_total    - commands sent inside pipelines
+  data_operation_duration_seconds  - latency of the Data model operations
+
+Collectors added with REGISTRY.add_collector() report values that are
+kept elsewhere (the Data cache, the Redis pool, the functions proxy and
+the admission control) when the metrics are scraped.
+
+Every process has its own registry, so scrape each worker or run a
+single worker per container.
+"""
+
+import threading
+from time import time
+from functools import wraps
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    """ Escapes a label value for the text format """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    """ Formats a sample value for the text format """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _sample(name, labels, value):
+    """ Formats one sample line """
+    if labels:
+        pairs = ','.join('{}="{}"'.format(key, _escape(val)) for key, val in labels)
+        return '{}{{{}}} {}'.format(name, pairs, _number(value))
+    return '{} {}'.format(name, _number(value))
+
+
+class Metric(object):
+    """ Base class of metrics with a fixed set of label names """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        """ Returns the label values in the order of the label names """
+        if set(labels) != set(self.labels):
+            raise ValueError('{} needs the labels {}'.format(self.name, self.labels))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def reset(self):
+        """ Forgets every recorded value """
+        with self.lock:
+            self.values.clear()
+
+    def samples(self):
+        """ Returns (name, labels, value) for every sample of the metric """
+        raise NotImplementedError
+
+    def render(self):
+        """ Returns the metric in the text exposition format """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(_sample(name, labels, value) for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """ A value that only goes up """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """ Adds amount to the counter """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, list(zip(self.labels, key)), value)
+                    for key, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    """ A value that goes up and down """
+
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        """ Subtracts amount from the gauge """
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        """ Sets the gauge to value """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """ Counts observations in cumulative buckets """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """ Records one observation """
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def load(self, cumulative, total, count, **labels):
+        """ Replaces the observations with cumulative bucket counts kept elsewhere """
+        key = self._key(labels)
+        counts, previous = [], 0
+        for value in cumulative:
+            counts.append(value - previous)
+            previous = value
+        counts.append(count - previous)
+        with self.lock:
+            self.values[key] = (counts, total)
+
+    def time(self, **labels):
+        """ Returns a context manager that observes the time spent inside it """
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + [('le', _number(float(bound)))],
+                                cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class _Timer(object):
+    """ Context manager returned by Histogram.time """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = 0
+
+    def __enter__(self):
+        self.started = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time() - self.started, **self.labels)
+
+
+class Registry(object):
+    """ The metrics and collectors rendered by /metrics """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        """ Adds a metric and returns it """
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """ Adds a function that returns a list of metrics at scrape time """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def reset(self):
+        """ Forgets the values of every registered metric """
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            metric.reset()
+
+    def render(self):
+        """ Returns every metric in the text exposition format """
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        for collector in collectors:
+            metrics.extend(collector())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'http_requests_total', 'HTTP requests by method, route and status',
+    ('method', 'route', 'status')))
+HTTP_LATENCY = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by method and route',
+    ('method', 'route')))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge(
+    'http_requests_in_flight', 'HTTP requests being served'))
+REDIS_COMMANDS = REGISTRY.register(Counter(
+    'redis_commands_total', 'Redis commands and pipelines by command', ('command',)))
+REDIS_ERRORS = REGISTRY.register(Counter(
+    'redis_command_errors_total', 'Redis commands that raised by command', ('command',)))
+REDIS_LATENCY = REGISTRY.register(Histogram(
+    'redis_command_duration_seconds', 'Redis round-trip latency by command', ('command',)))
+REDIS_PIPELINED = REGISTRY.register(Counter(
+    'redis_pipeline_commands_total', 'Redis commands sent inside pipelines'))
+DATA_LATENCY = REGISTRY.register(Histogram(
+    'data_operation_duration_seconds', 'Latency of the Data model operations',
+    ('operation',)))
+
+
+def timed(operation):
+    """ Decorator that records the latency of a Data operation """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with DATA_LATENCY.time(operation=operation):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def observe_redis(command, started, failed=False, pipelined=0):
+    """ Records one Redis round-trip that began at started """
+    REDIS_COMMANDS.inc(command=command)
+    REDIS_LATENCY.observe(time() - started, command=command)
+    if failed:
+        REDIS_ERRORS.inc(command=command)
+    if pipelined:
+        REDIS_PIPELINED.inc(pipelined)
+
+def command_name(args):
+    """ Returns the name of the Redis command in args """
+    name = args[0] if args else 'UNKNOWN'
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    return str(name).split(' ')[0].upper()
+
+def instrument_redis(client):
+    """ Times every command and pipeline the Redis client sends
+
+    The client methods are wrapped in place, so every caller of the client
+    is measured. Calling it again on the same client does nothing.
+    """
+    if getattr(client, 'instrumented', False):
+        return client
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def timed_execute_command(*args, **options):
+        started = time()
+        try:
+            result = execute_command(*args, **options)
+        except Exception:
+            observe_redis(command_name(args), started, failed=True)
+            raise
+        observe_redis(command_name(args), started)
+        return result
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        immediate_execute_command = pipe.immediate_execute_command
+
+        def timed_execute(*args, **kwargs):
+            command = 'MULTI' if pipe.transaction else 'PIPELINE'
+            size = len(pipe.command_stack)
+            started = time()
+            try:
+                result = execute(*args, **kwargs)
+            except Exception:
+                observe_redis(command, started, failed=True, pipelined=size)
+                raise
+            observe_redis(command, started, pipelined=size)
+            return result
+
+        def timed_immediate_execute_command(*args, **options):
+            started = time()
+            try:
+                result = immediate_execute_command(*args, **options)
+            except Exception:
+                observe_redis(command_name(args), started, failed=True)
+                raise
+            observe_redis(command_name(args), started)
+            return result
+
+        pipe.execute = timed_execute
+        pipe.immediate_execute_command = timed_immediate_execute_command
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+    client.instrumented = True
+    return client
+
+def observe_request(method, route, status, started):
+    """ Records one HTTP request that began at started """
+    HTTP_REQUESTS.inc(method=method, route=route, status=status)
+    HTTP_LATENCY.observe(time() - started, method=method, route=route)
+
+
+######################################################################
+#  C O L L E C T O R S
+######################################################################
+
+def cache_metrics(stats, prefix='data_cache'):
+    """ Returns the counters of a DataCache.stats() dictionary as metrics """
+    size = Gauge(prefix + '_size', 'Records held by the cache')
+    size.set(stats['size'])
+    result = [size]
+    for name in ('hits', 'misses', 'evictions', 'invalidations'):
+        counter = Counter('{}_{}_total'.format(prefix, name), 'Cache {}'.format(name))
+        counter.inc(stats[name])
+        result.append(counter)
+    return result
+
+def pool_metrics(stats):
+    """ Returns a Data.pool_stats() dictionary as gauges """
+    result = []
+    for name in ('max_connections', 'created_connections', 'in_use_connections',
+                 'idle_connections', 'saturation'):
+        gauge = Gauge('redis_pool_' + name, 'Redis connection pool ' + name.replace('_', ' '))
+        gauge.set(stats[name])
+        result.append(gauge)
+    return result
+
+def proxy_metrics(stats):
+    """ Returns a FunctionsProxy.stats() dictionary as metrics """
+    buckets = DEFAULT_BUCKETS
+    for host_stats in stats['hosts'].values():   # every host has the same buckets
+        buckets = [bound for bound, _ in host_stats['latency']['buckets']]
+        break
+    latency = Histogram('functions_upstream_duration_seconds',
+                        'Latency of the cloud function calls by host', ('host',), buckets)
+    errors = Counter('functions_upstream_errors_total',
+                     'Cloud function calls that failed by host', ('host',))
+    circuit = Gauge('functions_circuit_open', 'Whether the circuit of a host is open',
+                    ('host',))
+    for host, host_stats in sorted(stats['hosts'].items()):
+        histogram = host_stats['latency']
+        latency.load([count for _, count in histogram['buckets']], histogram['sum'],
+                     histogram['count'], host=host)
+        errors.inc(histogram['errors'], host=host)
+        circuit.set(0 if host_stats['circuit'] == 'closed' else 1, host=host)
+    return [latency, errors, circuit] + cache_metrics(stats['cache'], 'functions_cache')
+
+def write_behind_metrics(stats):
+    """ Returns a WriteBehind.stats() dictionary as metrics """
+    queued = Gauge('data_write_behind_queued', 'Datas waiting in the write-behind queue')
+    queued.set(stats['queued'])
+    result = [queued]
+    for name in ('written', 'batches', 'failures'):
+        counter = Counter('data_write_behind_{}_total'.format(name),
+                          'Write-behind {}'.format(name))
+        counter.inc(stats[name])
+        result.append(counter)
+    return result
+
+def admission_metrics(stats):
+    """ Returns an AdmissionControl.stats() dictionary as metrics """
+    shed = Counter('http_requests_shed_total',
+                   'Requests refused because the process was at its concurrency cap')
+    shed.inc(stats['shed'])
+    limited = Counter('http_requests_rate_limited_total',
+                      'Requests refused by the rate limit of their endpoint', ('endpoint',))
+    for endpoint, count in sorted(stats['limited'].items()):
+        limited.inc(count, endpoint=endpoint)
+    return [shed, limited]
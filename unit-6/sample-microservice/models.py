@@ -24,21 +24,412 @@ for a server name 'redis' to connect to.
 """
 
 import os
+import re
 import json
 import logging
-import pickle
-from redis import Redis
-from redis.exceptions import ConnectionError
+import atexit
+import threading
+from time import time, sleep
+from collections import OrderedDict, deque
+from redis import Redis, BlockingConnectionPool
+from redis.exceptions import ConnectionError, WatchError
+from codec import FIELDS, PickleCodec, get_codec
+from metrics import instrument_redis, timed
+
+try:
+    TEXT_TYPES = (str, unicode)
+except NameError:       # Python 3
+    TEXT_TYPES = (str,)
+
+# Every key and channel is namespaced as <prefix>:<name> so that tenants
+# can share one Redis, the prefix is set with DATA_KEY_PREFIX
+DEFAULT_KEY_PREFIX = 'data'
+DEFAULT_CODEC = PickleCodec.name
+GLOB_SPECIAL = re.compile(r'[\\*?\[\]]')
+
+# Secondary indexes are Redis sets of ids keyed by attribute and value
+INDEX_PREFIX = 'idx'
+INDEXED_ATTRIBUTES = ('name', 'category', 'available')
+SORT_ATTRIBUTES = ('id',) + INDEXED_ATTRIBUTES
+
+# The words of the searchable attributes are kept in one sorted set as
+# word:attribute:id members. They all score 0 so the set is ordered by
+# bytes and ZRANGEBYLEX finds every word that starts with a prefix.
+SEARCH_KEY = 'search'
+SEARCH_WEIGHTS = {'name': 2, 'category': 1}
+SEARCH_CANDIDATES = 10000   # index entries read per query word
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# Counts of Datas are kept in one hash next to the indexes, with the fields
+# total, available, total:<category> and available:<category>
+STATS_KEY = 'stats'
+
+# Datas are stored under their integer id, so this matches only records
+RECORD_PATTERN = '[0-9]*'
+DEFAULT_BATCH_SIZE = 100
+
+# New ids are taken from this counter
+COUNTER_KEY = 'index'
+
+# The token buckets of the rate limiter, see ratelimit.py
+RATE_LIMIT_KEY = 'ratelimit'
+
+# Every write bumps the version of each Data it touches and the collection
+VERSION_KEY = 'version'
+
+# Writers publish the ids they changed here so every process can evict them
+INVALIDATION_CHANNEL = 'invalidate'
+
+# Every write appends create, update, delete, purchase or reset events to
+# this stream, which keeps about DATA_CHANGES_LENGTH of the latest ones
+CHANGES_KEY = 'changes'
+DEFAULT_CHANGES_LENGTH = 10000
+CHANGE_ID_PATTERN = re.compile(r'^[0-9]+(-[0-9]+)?$')
+INVALIDATE_ALL = '*'
+
+# Atomically purchases a Data stored by the hash codec in one round-trip
+#   KEYS: the Data, the available=true index, the available=false index,
+#         the version of the Data, the version of the collection, the
+#         stats hash, the change feed stream
+#   ARGV: the id of the Data, the cache invalidation channel, the comma
+#         separated versions the caller expects (* for any version), the
+#         length the change feed is trimmed to (0 records no event)
+# Returns 0 if the Data does not exist, -1 if it is sold, -2 if it is not
+# at an expected version, else its fields followed by its new version
+PURCHASE_SCRIPT = """
+local available = redis.call('HGET', KEYS[1], 'available')
+if not available then
+    return 0
+end
+if ARGV[3] ~= '*' then
+    local version = redis.call('GET', KEYS[4]) or '0'
+    local matched = false
+    for expected in string.gmatch(ARGV[3], '[^,]+') do
+        if expected == version then
+            matched = true
+        end
+    end
+    if not matched then
+        return -2
+    end
+end
+if available ~= '1' then
+    return -1
+end
+local category = redis.call('HGET', KEYS[1], 'category') or 'None'
+redis.call('HSET', KEYS[1], 'available', '0')
+redis.call('SMOVE', KEYS[2], KEYS[3], ARGV[1])
+redis.call('HINCRBY', KEYS[6], 'available', -1)
+redis.call('HINCRBY', KEYS[6], 'available:' .. category, -1)
+local reply = redis.call('HMGET', KEYS[1], 'id', 'name', 'category', 'available')
+reply[5] = redis.call('INCR', KEYS[4])
+redis.call('INCR', KEYS[5])
+redis.call('PUBLISH', ARGV[2], ARGV[1])
+if ARGV[4] ~= '0' then
+    redis.call('XADD', KEYS[7], 'MAXLEN', '~', ARGV[4], '*', 'op', 'purchase', 'id', ARGV[1])
+end
+return reply
+"""
 
 class DataValidationError(Exception):
     """ Custom Exception with data validation fails """
     pass
 
+class DataConflictError(Exception):
+    """ Custom Exception when a Data is not in the state an action needs """
+    pass
+
+class DataVersionError(Exception):
+    """ Custom Exception when a Data is not at the version the caller expects """
+    pass
+
+class DataChangesExpiredError(Exception):
+    """ Custom Exception when the changes after an event are no longer kept """
+    pass
+
+class DataOverloadError(Exception):
+    """ Custom Exception when the write-behind queue stays full """
+    pass
+
+class DataCache(object):
+    """ Thread safe LRU cache of serialized Datas with an optional TTL
+
+    A max_size of 0 disables the cache and a ttl of 0 never expires entries.
+    """
+
+    def __init__(self, max_size=0, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.records = OrderedDict()
+        self.generation = 0     # bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        """ True when the cache holds any records at all """
+        return self.max_size > 0
+
+    def get(self, key):
+        """ Returns a cached record or None, counting the hit or miss """
+        with self.lock:
+            entry = self.records.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            record, expires = entry
+            if expires and expires < time():
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self.records[key] = entry   # most recently used goes last
+            self.hits += 1
+            return record
+
+    def put(self, key, record, generation):
+        """ Caches a record unless an invalidation happened since generation
+
+        The caller reads generation before fetching the record, so a record
+        that was changed while it was being fetched is never cached.
+        """
+        with self.lock:
+            if not self.enabled or generation != self.generation:
+                return
+            expires = time() + self.ttl if self.ttl else 0
+            self.records.pop(key, None)
+            self.records[key] = (record, expires)
+            while len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """ Removes the records for keys """
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if self.records.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """ Removes every record """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.records)
+            self.records.clear()
+
+    def stats(self):
+        """ Returns the size and counters of the cache """
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self.records),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+class WriteAck(object):
+    """ Lets a writer wait until its queued Data has been written """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+        self.version = 0
+
+    def done(self, error=None, version=0):
+        """ Marks the write as acknowledged at version, or failed with error """
+        self.error = error
+        self.version = version
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """ Waits for the write and returns the version it was written at """
+        if not self.event.wait(timeout):
+            raise DataOverloadError('The write was not acknowledged in time')
+        if self.error is not None:
+            raise self.error
+        return self.version
+
+
+class WriteBehind(object):
+    """ Bounded queue of Datas written to Redis in batches by a background thread
+
+    Queued Datas are written with writer (Data.save_many) once batch_size
+    of them are waiting or interval seconds after the first one arrived,
+    whichever comes first. put() blocks while the queue holds max_size
+    Datas and raises DataOverloadError if it is still full after timeout
+    seconds. A batch that fails is retried retries times before it is
+    given up on; writers that wait for their ack get the error.
+
+    A max_size of 0 disables the queue.
+    """
+
+    def __init__(self, writer=None, max_size=0, batch_size=DEFAULT_BATCH_SIZE, interval=0.05,
+                 wait=False, timeout=5, retries=3):
+        self.writer = writer
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wait = wait
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.queue = deque()
+        self.pending = {}       # id -> (record, sequence) of the last queued save
+        self.sequence = 0
+        self.in_flight = 0
+        self.flushing = False
+        self.stopped = False
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.thread = None
+        if self.enabled:
+            self.thread = threading.Thread(target=self.__run, name='data-write-behind')
+            self.thread.daemon = True
+            self.thread.start()
+
+    @property
+    def enabled(self):
+        """ True when saves are queued instead of written right away """
+        return self.max_size > 0
+
+    def put(self, data):
+        """ Queues a copy of a Data and returns the WriteAck of its write """
+        record = data.serialize()
+        ack = WriteAck()
+        deadline = time() + self.timeout
+        with self.changed:
+            while len(self.queue) >= self.max_size and not self.stopped:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise DataOverloadError('The write-behind queue is full')
+                self.changed.wait(remaining)
+            if self.stopped:
+                raise DataOverloadError('The write-behind queue is closed')
+            self.sequence += 1
+            self.queue.append((record, self.sequence, ack))
+            self.pending[record['id']] = (record, self.sequence)
+            self.changed.notify_all()
+        return ack
+
+    def get(self, data_id):
+        """ Returns the record of a queued Data that is not written yet, or None """
+        with self.lock:
+            entry = self.pending.get(int(data_id))
+        return dict(entry[0]) if entry else None
+
+    def drain(self):
+        """ Waits until every queued Data has been written
+
+        Called by the flusher itself (through the writer) it returns at once.
+        """
+        if not self.enabled or threading.current_thread() is self.thread:
+            return
+        with self.changed:
+            self.flushing = True
+            self.changed.notify_all()
+            while (self.queue or self.in_flight) and self.thread.is_alive():
+                self.changed.wait(self.interval)
+            self.flushing = False
+
+    def close(self):
+        """ Writes everything that is queued and stops the flusher """
+        if not self.enabled:
+            return
+        self.drain()
+        with self.changed:
+            self.stopped = True
+            self.changed.notify_all()
+        self.thread.join(self.timeout)
+
+    def stats(self):
+        """ Returns the size and counters of the queue """
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'queued': len(self.queue),
+                'max_size': self.max_size,
+                'batch_size': self.batch_size,
+                'interval_ms': int(self.interval * 1000),
+                'wait_for_ack': self.wait,
+                'written': self.written,
+                'batches': self.batches,
+                'failures': self.failures
+            }
+
+    def __next_batch(self):
+        """ Waits for a full batch, the interval, a flush or a stop and takes the batch """
+        with self.changed:
+            while not self.queue and not self.stopped:
+                self.changed.wait()
+            if not self.queue:
+                return None
+            deadline = time() + self.interval
+            while len(self.queue) < self.batch_size and not self.flushing and \
+                    not self.stopped and time() < deadline:
+                self.changed.wait(deadline - time())
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            self.in_flight = len(batch)
+            self.changed.notify_all()   # there is room for blocked writers
+            return batch
+
+    def __run(self):
+        """ Writes batches until the queue is stopped and empty """
+        while True:
+            batch = self.__next_batch()
+            if batch is None:
+                return
+            datas = [Data(record['id']).deserialize(record) for record, _, _ in batch]
+            error = None
+            for attempt in range(self.retries + 1):
+                try:
+                    self.writer(datas)
+                    error = None
+                    break
+                except Exception as failure:   # pylint: disable=broad-except
+                    error = failure
+                    Data.logger.error('Write-behind batch failed (attempt %d): %s',
+                                      attempt + 1, failure)
+                    sleep(min(1.0, self.interval * 2 ** attempt))
+            with self.changed:
+                for record, sequence, _ in batch:
+                    entry = self.pending.get(record['id'])
+                    if entry and entry[1] == sequence:
+                        del self.pending[record['id']]
+                self.in_flight = 0
+                self.batches += 1
+                if error is None:
+                    self.written += len(batch)
+                else:
+                    self.failures += len(batch)
+                self.changed.notify_all()
+            for (_, _, ack), data in zip(batch, datas):
+                ack.done(error, data.version)
+
+
 class Data(object):
     """ Data interface to database """
 
     logger = logging.getLogger(__name__)
     redis = None
+    changes_redis = None    # blocking reads of the change feed, off the shared pool
+    codec = PickleCodec()
+    key_prefix = DEFAULT_KEY_PREFIX
+    changes_length = DEFAULT_CHANGES_LENGTH
+    scripts = {}
+    cache = DataCache()
+    cache_listener = None
+    write_behind = WriteBehind()
+    id_lock = threading.Lock()
+    id_block = [1, 0]   # the next and the last id reserved by this process
 
     def __init__(self, id=0, name=None, category=None, available=True):
         """ Constructor """
@@ -46,18 +437,36 @@ class Data(object):
         self.name = name
         self.category = category
         self.available = available
+        self.version = 0
 
-    def save(self):
-        """ Saves a Data in the database """
-        if self.name is None:   # name is the only required field
-            raise DataValidationError('name attribute is not set')
-        if self.id == 0:
-            self.id = Data.__next_index()
-        Data.redis.set(self.id, pickle.dumps(self.serialize()))
+    def save(self, expected_versions=None):
+        """ Saves a Data in the database and keeps its indexes up to date
+
+        If expected_versions is given the Data is only saved while it is
+        at one of those versions, otherwise DataVersionError is raised.
+        In write-behind mode the Data is queued instead (unless versions
+        are expected), and save only waits for it to be written when the
+        queue is configured to wait for acks.
+        """
+        if expected_versions is None and Data.write_behind.enabled:
+            if self.name is None:   # name is the only required field
+                raise DataValidationError('name attribute is not set')
+            if self.id == 0:
+                self.id = Data.__reserve_id()
+            ack = Data.write_behind.put(self)
+            if Data.write_behind.wait:
+                self.version = ack.wait()
+        elif expected_versions is None:
+            Data.save_many([self])
+        else:
+            Data.save_many([self], {self.id: expected_versions})
 
-    def delete(self):
-        """ Deletes a Data from the database """
-        Data.redis.delete(self.id)
+    def delete(self, expected_versions=None):
+        """ Deletes a Data from the database along with its index entries """
+        if expected_versions is None:
+            Data.delete_many([self.id])
+        else:
+            Data.delete_many([self.id], {self.id: expected_versions})
 
     def serialize(self):
         """ serializes a Data into a dictionary """
@@ -78,69 +487,502 @@ class Data(object):
             raise DataValidationError('Invalid data: missing ' + error.args[0])
         except TypeError as error:
             raise DataValidationError('Invalid data: body of request contained bad or no data')
+        # The codecs store name and category as text and available as a flag
+        for attribute in ('name', 'category'):
+            value = getattr(self, attribute)
+            if value is not None and not isinstance(value, TEXT_TYPES):
+                raise DataValidationError('Invalid data: {} must be a string'.format(attribute))
+        if not isinstance(self.available, bool):
+            raise DataValidationError('Invalid data: available must be true or false')
         return self
 
 
 ######################################################################
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
+#  Methods with a single leading underscore only queue commands or
+#  interpret replies, so AsyncData in amodels.py shares them.
+
+    @staticmethod
+    def __next_index(count=1):
+        """ Increments the index by count and returns the first reserved id """
+        return Data.redis.incrby(Data._key(COUNTER_KEY), count) - count + 1
+
+    @staticmethod
+    def __reserve_id():
+        """ Returns a new id from a block of ids reserved with one INCRBY
+
+        Ids of a block that are never used leave gaps in the ids.
+        """
+        with Data.id_lock:
+            if Data.id_block[0] > Data.id_block[1]:
+                size = Data.write_behind.batch_size
+                first = Data.__next_index(size)
+                Data.id_block = [first, first + size - 1]
+            data_id = Data.id_block[0]
+            Data.id_block[0] += 1
+            return data_id
 
     @staticmethod
-    def __next_index():
-        """ Increments the index and returns it """
-        return Data.redis.incr('index')
+    def flush():
+        """ Waits until every Data queued by write-behind saves is written """
+        Data.write_behind.drain()
 
     @staticmethod
-    def remove_all():
-        """ Removes all Datas from the database """
-        Data.redis.flushall()
+    @timed('save_many')
+    def save_many(datas, expected_versions=None):
+        """ Saves many Datas in a single transaction
+
+        New Datas get their ids from one INCRBY, the previous versions of
+        existing Datas are read in one round-trip so their index entries can
+        be replaced, and every write is sent in one MULTI/EXEC pipeline.
+        When the same id is given more than once the last Data wins.
+
+        expected_versions optionally maps ids to the versions the caller is
+        willing to overwrite. If any of those Datas is at another version,
+        or changes while saving, nothing is saved and DataVersionError is
+        raised. Each saved Data gets its new version.
+        """
+        Data.write_behind.drain()
+        for data in datas:
+            if data.name is None:   # name is the only required field
+                raise DataValidationError('name attribute is not set')
+        # each id once, so a repeated id is unindexed once like it is indexed once
+        old_ids = list(OrderedDict.fromkeys(data.id for data in datas if data.id != 0))
+        new_datas = [data for data in datas if data.id == 0]
+        if new_datas:
+            first_id = Data.__next_index(len(new_datas))
+            for offset, data in enumerate(new_datas):
+                data.id = first_id + offset
+        records = OrderedDict((data.id, data.serialize()) for data in datas)
+        with Data.redis.pipeline() as pipe:
+            while True:
+                try:
+                    Data.__watch_versions(pipe, old_ids, expected_versions)
+                    olds = Data.__fetch(old_ids, INDEXED_ATTRIBUTES)
+                    pipe.multi()
+                    for old in olds:
+                        if old:
+                            Data._unindex(pipe, old)
+                    for data_id, record in records.items():
+                        Data.codec.write(pipe, Data._key(data_id), record)
+                        Data._index(pipe, record)
+                    updated = set(old['id'] for old in olds if old)
+                    Data._record_changes(pipe, [('update' if data_id in updated else 'create',
+                                                 data_id) for data_id in records])
+                    Data._invalidate(pipe, list(records))
+                    Data._bump_versions(pipe, list(records))
+                    versions = pipe.execute()[-len(records) - 1:-1]
+                    break
+                except WatchError:
+                    Data._on_version_race(old_ids, expected_versions)
+        versions = dict(zip(records, versions))
+        for data in datas:
+            data.version = versions[data.id]
 
     @staticmethod
+    @timed('delete_many')
+    def delete_many(data_ids, expected_versions=None):
+        """ Deletes many Datas and their index entries in a single transaction
+
+        expected_versions works as it does for save_many. Returns the ids of
+        the Datas that existed and were deleted. Their versions are bumped
+        rather than removed, see remove_all.
+        """
+        Data.write_behind.drain()
+        data_ids = list(OrderedDict.fromkeys(data_ids))
+        with Data.redis.pipeline() as pipe:
+            while True:
+                try:
+                    Data.__watch_versions(pipe, data_ids, expected_versions)
+                    olds = Data.__fetch(data_ids, INDEXED_ATTRIBUTES)
+                    pipe.multi()
+                    deleted = []
+                    for old in olds:
+                        if old:
+                            Data._unindex(pipe, old)
+                            deleted.append(old['id'])
+                    if data_ids:
+                        pipe.delete(*[Data._key(data_id) for data_id in data_ids])
+                        Data._bump_versions(pipe, deleted)
+                        Data._record_changes(pipe, [('delete', data_id) for data_id in deleted])
+                        Data._invalidate(pipe, data_ids)
+                    pipe.execute()
+                    return deleted
+                except WatchError:
+                    Data._on_version_race(data_ids, expected_versions)
+
+    @staticmethod
+    def remove_all(batch_size=1000):
+        """ Removes all Datas from the database
+
+        Only the keys under the key prefix are removed, batch_size at a time
+        with SCAN and UNLINK, so Redis keeps serving other clients (and the
+        other tenants' keys) while a large collection is removed. The version
+        counters are bumped instead, as ids start over: a Data created again
+        under an id must not get a version, and so an ETag, handed out before.
+        """
+        Data.write_behind.drain()
+        pipe = Data.redis.pipeline(transaction=False)
+        for key in Data.redis.scan_iter(Data._key_pattern('*'), count=batch_size):
+            Data._reset_key(pipe, key)
+            if len(pipe) >= batch_size:
+                pipe.execute()
+        Data._record_changes(pipe, [('reset', None)])
+        pipe.execute()
+        with Data.id_lock:
+            Data.id_block = [1, 0]  # the index starts over
+        Data.cache.clear()
+        Data.redis.publish(Data._key(INVALIDATION_CHANNEL), INVALIDATE_ALL)
+
+    @staticmethod
+    @timed('rebuild_indexes')
+    def rebuild_indexes(batch_size=DEFAULT_BATCH_SIZE):
+        """ Rebuilds the secondary indexes for all existing Datas
+
+        Use this once to migrate a database that was populated before the
+        indexes existed, or to repair them. Returns the number of Datas indexed.
+
+        The old index keys are removed and the Datas indexed batch_size at a
+        time on pipelines without MULTI, so Redis keeps serving other clients
+        while a large collection is indexed. Queries made meanwhile may miss
+        Datas, and writes made meanwhile may be counted twice in the stats.
+        """
+        Data.write_behind.drain()
+        pipe = Data.redis.pipeline(transaction=False)
+        for key in Data.redis.scan_iter(Data._key_pattern(INDEX_PREFIX + ':*'),
+                                        count=batch_size):
+            pipe.delete(key)
+            if len(pipe) >= batch_size:
+                pipe.execute()
+        pipe.execute()
+        count = 0
+        for data in Data.iter_all(batch_size):
+            Data._index(pipe, data.serialize())
+            count += 1
+            if count % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+        Data.logger.info('Rebuilt indexes for %d Datas', count)
+        return count
+
+    @staticmethod
+    @timed('all')
     def all():
         """ Query that returns all Datas """
-        # results = [Data.from_dict(redis.hgetall(key)) for key in redis.keys() if key != 'index']
-        results = []
-        for key in Data.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Data.redis.get(key))
-                data = Data(data['id']).deserialize(data)
-                results.append(data)
-        return results
+        return list(Data.iter_all())
+
+    @staticmethod
+    def iter_all(batch_size=DEFAULT_BATCH_SIZE):
+        """ Generator that streams all Datas in batches using SCAN and MGET
+
+        Only one batch of records is held in memory at a time, and each batch
+        costs one SCAN and one MGET no matter how many records are stored.
+        """
+        cursor = 0
+        while True:
+            cursor, datas = Data.page(cursor, batch_size)
+            for data in datas:
+                yield data
+            if not cursor:
+                break
+
+    @staticmethod
+    @timed('page')
+    def page(cursor=0, limit=DEFAULT_BATCH_SIZE):
+        """ Query that returns one page of Datas and the cursor of the next page
+
+        The cursor is a Redis SCAN cursor, so a page holds roughly ``limit``
+        Datas (SCAN treats the count as a hint) and the next cursor is 0 once
+        the whole keyspace has been visited.
+        """
+        ids = []
+        while True:
+            cursor, batch = Data.redis.scan(cursor, match=Data._key_pattern(RECORD_PATTERN),
+                                            count=limit)
+            cursor = int(cursor)
+            ids.extend(Data._id_of(key) for key in batch)
+            if len(ids) >= limit or not cursor:
+                break
+        return cursor, Data.__load(ids)
+
+    @staticmethod
+    @timed('purchase')
+    def purchase(data_id, expected_versions=None):
+        """ Atomically marks an available Data as sold
+
+        Returns the purchased Data, or None if there is no such Data, and
+        raises DataConflictError if it has already been sold. With the hash
+        codec this is a single Lua script call; other codecs cannot be read
+        from Lua, so they use an optimistic WATCH/MULTI loop instead.
+        expected_versions works as it does for save.
+        """
+        Data.write_behind.drain()
+        data_id = int(data_id)
+        if Data.codec.partial_reads:
+            keys, args = Data._purchase_script_args(data_id, expected_versions)
+            reply = Data.__script(PURCHASE_SCRIPT)(keys=keys, args=args)
+            Data.cache.invalidate([data_id])
+            record, version = Data._purchase_result(data_id, reply)
+            if not record:
+                return None
+            data = Data(record['id']).deserialize(record)
+            data.version = version
+            return data
+
+        expected = None if expected_versions is None else {data_id: expected_versions}
+        with Data.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(Data._key(data_id))
+                    Data.__watch_versions(pipe, [data_id], expected)
+                    record = Data.__fetch([data_id])[0]
+                    if not record:
+                        return None
+                    if not record['available']:
+                        raise DataConflictError("Data with id '{}' is not available.".format(data_id))
+                    pipe.multi()
+                    Data._unindex(pipe, record)
+                    record['available'] = False
+                    Data.codec.write(pipe, Data._key(data_id), record)
+                    Data._index(pipe, record)
+                    Data._record_changes(pipe, [('purchase', data_id)])
+                    Data._invalidate(pipe, [data_id])
+                    Data._bump_versions(pipe, [data_id])
+                    data = Data(record['id']).deserialize(record)
+                    data.version = pipe.execute()[-2]
+                    return data
+                except WatchError:
+                    Data._on_version_race([data_id], expected)
+
+    @staticmethod
+    def _purchase_script_args(data_id, expected_versions):
+        """ Returns the keys and arguments of the purchase script """
+        if expected_versions is None:
+            expected = '*'
+        else:
+            expected = ','.join(str(version) for version in expected_versions)
+        keys = [Data._key(data_id),
+                Data._index_key('available', True),
+                Data._index_key('available', False),
+                Data._version_key(data_id),
+                Data._key(VERSION_KEY),
+                Data._key(INDEX_PREFIX, STATS_KEY),
+                Data._key(CHANGES_KEY)]
+        return keys, [data_id, Data._key(INVALIDATION_CHANNEL), expected, Data.changes_length]
+
+    @staticmethod
+    def _purchase_result(data_id, reply):
+        """ Turns the reply of the purchase script into a record and its version """
+        if reply == 0:
+            return None, 0
+        if reply == -1:
+            raise DataConflictError("Data with id '{}' is not available.".format(data_id))
+        if reply == -2:
+            raise DataVersionError("Data with id '{}' has changed.".format(data_id))
+        return Data.codec.decode(reply[:4], FIELDS), reply[4]
+
+    @staticmethod
+    def __script(source):
+        """ Returns a Lua script registered with the current Redis client """
+        script = Data.scripts.get(source)
+        if script is None or script.registered_client is not Data.redis:
+            script = Data.redis.register_script(source)
+            Data.scripts[source] = script
+        return script
+
+######################################################################
+#  V E R S I O N   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def version_of(data_id):
+        """ Returns the version of a Data, 0 if it was never versioned """
+        return int(Data.redis.get(Data._version_key(data_id)) or 0)
+
+    @staticmethod
+    def is_queued(data_id):
+        """ True while a write-behind save of the Data waits to be written
+
+        The version of a queued Data is only bumped once it is written, so
+        version_of does not describe it yet.
+        """
+        return Data.write_behind.enabled and Data.write_behind.get(data_id) is not None
+
+    @staticmethod
+    def collection_version():
+        """ Returns a version that changes whenever any Data changes """
+        return int(Data.redis.get(Data._key(VERSION_KEY)) or 0)
+
+    @staticmethod
+    def _version_key(data_id):
+        """ Returns the key of the version counter of a Data """
+        return Data._key(VERSION_KEY, data_id)
+
+    @staticmethod
+    def _bump_versions(pipe, data_ids):
+        """ Queues the version increments for data_ids and then the collection """
+        for data_id in data_ids:
+            pipe.incr(Data._version_key(data_id))
+        pipe.incr(Data._key(VERSION_KEY))
+
+    @staticmethod
+    def _reset_key(pipe, key):
+        """ Queues the removal of a key by remove_all, a version counter is bumped instead """
+        versions = Data._key(VERSION_KEY)
+        name = key.decode('utf-8') if isinstance(key, bytes) else key
+        if name == versions or name.startswith(versions + ':'):
+            pipe.incr(key)
+        else:
+            pipe.unlink(key)
+
+    @staticmethod
+    def __watch_versions(pipe, data_ids, expected_versions=None):
+        """ Watches the versions of data_ids and checks the expected ones
+
+        Any write to one of those Datas bumps its version, so the transaction
+        queued after this fails with a WatchError if one races with it.
+        """
+        if not data_ids:
+            return
+        keys = [Data._version_key(data_id) for data_id in data_ids]
+        pipe.watch(*keys)
+        if not expected_versions:
+            return
+        for data_id, version in zip(data_ids, pipe.mget(keys)):
+            if data_id in expected_versions and \
+                    int(version or 0) not in expected_versions[data_id]:
+                raise DataVersionError("Data with id '{}' has changed.".format(data_id))
+
+    @staticmethod
+    def _on_version_race(data_ids, expected_versions):
+        """ Decides whether a transaction that lost a WATCH race is retried """
+        if expected_versions:
+            raise DataVersionError("Data with ids {} changed while saving.".format(data_ids))
+        Data.logger.info('Datas %s changed while saving, retrying', data_ids)
 
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
 
     @staticmethod
+    @timed('find')
     def find(data_id):
-        """ Query that finds Datas by their id """
-        if Data.redis.exists(data_id):
-            data = pickle.loads(Data.redis.get(data_id))
-            data = Data(data['id']).deserialize(data)
-            return data 
+        """ Query that finds Datas by their id, through the cache if enabled
+
+        Datas queued by write-behind saves are found before they are written.
+        """
+        record = Data.write_behind.get(data_id) if Data.write_behind.enabled else None
+        if record is None and not Data.cache.enabled:
+            record = Data.__fetch([data_id])[0]
+        elif record is None:
+            data_id = int(data_id)
+            record = Data.cache.get(data_id)
+            if record is None:
+                generation = Data.cache.generation
+                record = Data.__fetch([data_id])[0]
+                if record:
+                    Data.cache.put(data_id, record, generation)
+        if record:
+            return Data(record['id']).deserialize(record)
         return None
 
     @staticmethod
+    @timed('find_many')
+    def find_many(data_ids):
+        """ Query that finds many Datas by id in a single round-trip
+
+        Returns a list in the same order as data_ids with None for the ids
+        that were not found.
+        """
+        records = Data.__fetch(data_ids)
+        if Data.write_behind.enabled:
+            records = [Data.write_behind.get(data_id) or record
+                       for data_id, record in zip(data_ids, records)]
+        return [Data(record['id']).deserialize(record) if record else None
+                for record in records]
+
+    @staticmethod
+    @timed('find_by')
     def __find_by(attribute, value):
-        """ Generic Query that finds a key with a specific value """
-        # return [data for data in Data.__data if data.category == category]
+        """ Generic Query that finds Datas through a secondary index """
         Data.logger.info('Processing %s query for %s', attribute, value)
-        if isinstance(value, str):
-            search_criteria = value.lower() # make case insensitive
+        ids = sorted(Data.redis.smembers(Data._index_key(attribute, value)), key=int)
+        return Data.__load(ids)
+
+    @staticmethod
+    def __load(data_ids):
+        """ Fetches the Datas with data_ids in a single round-trip """
+        return [Data(record['id']).deserialize(record)
+                for record in Data.__fetch(data_ids)
+                if record is not None]  # deleted since its id was read
+
+    @staticmethod
+    def __fetch(data_ids, fields=None):
+        """ Reads the records of data_ids through the codec
+
+        Returns a list of record dictionaries, with None for missing ids.
+        Codecs that support it only send back the requested fields.
+        """
+        if not data_ids:
+            return []
+        pipe = Data.redis.pipeline(transaction=False)
+        Data.codec.queue_read(pipe, [Data._key(data_id) for data_id in data_ids], fields)
+        return Data.codec.decode_read(pipe.execute(), fields)
+
+    @staticmethod
+    @timed('search')
+    def search(query, offset=0, limit=DEFAULT_BATCH_SIZE):
+        """ Query that finds Datas by the words of their name and category
+
+        Every word of the query must start a word of the name or the
+        category, so 'fi' finds 'fido' and 'goldfish fi' needs both. Returns
+        the number of matches and the Datas from offset to offset + limit in
+        rank order, see Data._rank_search.
+        """
+        words = Data._search_words(query)
+        if not words:
+            return 0, []
+        pipe = Data.redis.pipeline(transaction=False)
+        Data._queue_search(pipe, words)
+        ranked = Data._rank_search(words, pipe.execute())
+        return len(ranked), Data.__load(ranked[offset:offset + limit])
+
+    @staticmethod
+    def counts():
+        """ Returns the number of Datas and of available ones, overall and by category
+
+        The counts are kept up to date by every write, so this is a single
+        HGETALL however many Datas are stored.
+        """
+        return Data._counts_result(Data.redis.hgetall(Data._key(INDEX_PREFIX, STATS_KEY)))
+
+    @staticmethod
+    @timed('query')
+    def query(filters, sort=None):
+        """ Query that finds the Datas matching every attribute == value of filters
+
+        The query is planned on the secondary indexes: their sizes are read
+        first, an empty one answers at once, a single one is read whole and
+        several are intersected by Redis with SINTER from the smallest up, so
+        only the matching records are fetched. Without filters every Data
+        is loaded. See Data._sort_datas for sort.
+        """
+        keys = Data._filter_keys(filters)
+        if not keys:
+            return Data._sort_datas(Data.all(), sort)
+        if len(keys) == 1:
+            ids = Data.redis.smembers(keys[0])
         else:
-            search_criteria = value
-        results = []
-        for key in Data.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Data.redis.get(key))
-                # perform case insensitive search on strings
-                if isinstance(data[attribute], str):
-                    test_value = data[attribute].lower()
-                else:
-                    test_value = data[attribute]
-                if test_value == search_criteria:
-                    results.append(Data(data['id']).deserialize(data))
-        return results
+            pipe = Data.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.scard(key)
+            sizes = pipe.execute()
+            Data.logger.debug('Query plan %s', sorted(zip(sizes, keys)))
+            if not min(sizes):
+                return []
+            ids = Data.redis.sinter([key for _, key in sorted(zip(sizes, keys))])
+        return Data._sort_datas(Data.__load(sorted(ids, key=int)), sort)
 
     @staticmethod
     def find_by_name(name):
@@ -155,23 +997,419 @@ class Data(object):
     @staticmethod
     def find_by_availability(available=True):
         """ Query that finds Datas by their availability """
+        if not isinstance(available, bool):
+            available = str(available).lower() in ['true', '1', 't']
         return Data.__find_by('available', available)
 
+######################################################################
+#  K E Y   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def _key(*parts):
+        """ Returns the key of parts under the key prefix, e.g. data:idx:name:fido """
+        parts = [part.decode('utf-8') if isinstance(part, bytes) else str(part)
+                 for part in parts]
+        if Data.key_prefix:
+            parts.insert(0, Data.key_prefix)
+        return ':'.join(parts)
+
+    @staticmethod
+    def _key_pattern(pattern):
+        """ Returns a SCAN pattern matching pattern under the key prefix """
+        prefix = GLOB_SPECIAL.sub(r'\\\g<0>', Data.key_prefix or '')
+        return prefix + ':' + pattern if prefix else pattern
+
+    @staticmethod
+    def _id_of(key):
+        """ Returns the id of a Data from the key of its record """
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return int(key.rpartition(':')[2])
+
+######################################################################
+#  S E C O N D A R Y   I N D E X   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def _index_key(attribute, value):
+        """ Returns the key of the set holding the ids for attribute == value """
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        elif value is None:
+            value = ''
+        else:
+            value = ('%s' % value).lower()   # indexes are case insensitive
+        return Data._key(INDEX_PREFIX, attribute, value)
+
+    @staticmethod
+    def _index(pipe, record):
+        """ Queues the index entries for a serialized Data onto a pipeline """
+        for attribute in INDEXED_ATTRIBUTES:
+            pipe.sadd(Data._index_key(attribute, record[attribute]), record['id'])
+        members = Data._search_members(record)
+        if members:
+            pipe.zadd(Data._key(INDEX_PREFIX, SEARCH_KEY),
+                      dict((member, 0) for member in members))
+        for field in Data._counts_fields(record):
+            pipe.hincrby(Data._key(INDEX_PREFIX, STATS_KEY), field, 1)
+
+    @staticmethod
+    def _unindex(pipe, record):
+        """ Queues the removal of a serialized Data's index entries onto a pipeline """
+        for attribute in INDEXED_ATTRIBUTES:
+            pipe.srem(Data._index_key(attribute, record[attribute]), record['id'])
+        members = Data._search_members(record)
+        if members:
+            pipe.zrem(Data._key(INDEX_PREFIX, SEARCH_KEY), *members)
+        for field in Data._counts_fields(record):
+            pipe.hincrby(Data._key(INDEX_PREFIX, STATS_KEY), field, -1)
+
+    @staticmethod
+    def _counts_fields(record):
+        """ Returns the fields of the counts hash that a serialized Data adds to """
+        category = '%s' % record['category']
+        fields = ['total', 'total:' + category]
+        if record['available']:
+            fields.extend(['available', 'available:' + category])
+        return fields
+
+    @staticmethod
+    def _counts_result(counts):
+        """ Turns the counts hash into the dictionary returned by Data.counts
+
+        Categories are reported as they are stored, and those whose Datas
+        were all deleted are left out.
+        """
+        result = {'total': 0, 'available': 0, 'categories': {}}
+        for field, count in counts.items():
+            if isinstance(field, bytes):
+                field = field.decode('utf-8')
+            name, _, category = field.partition(':')
+            if category:
+                totals = result['categories'].setdefault(category, {'total': 0, 'available': 0})
+                totals[name] = int(count)
+            else:
+                result[name] = int(count)
+        result['categories'] = dict((category, totals)
+                                    for category, totals in result['categories'].items()
+                                    if totals['total'])
+        return result
+
+    @staticmethod
+    def _filter_keys(filters):
+        """ Returns the index keys of the attribute == value pairs of filters """
+        keys = []
+        for attribute, value in sorted(filters.items()):
+            if attribute not in INDEXED_ATTRIBUTES:
+                raise DataValidationError('Cannot filter on {}'.format(attribute))
+            if attribute == 'available' and not isinstance(value, bool):
+                value = str(value).lower() in ['true', '1', 't']
+            keys.append(Data._index_key(attribute, value))
+        return keys
+
+    @staticmethod
+    def _sort_datas(datas, sort=None):
+        """ Sorts Datas by the attribute named by sort, descending if it starts with -
+
+        Text is compared case insensitively, missing values come first and
+        ties keep their order.
+        """
+        if not sort:
+            return datas
+        attribute = sort.lstrip('-')
+        if attribute not in SORT_ATTRIBUTES:
+            raise DataValidationError('Cannot sort on {}'.format(attribute))
+
+        def key(data):
+            value = getattr(data, attribute)
+            return value is not None, value.lower() if hasattr(value, 'lower') else value
+        return sorted(datas, key=key, reverse=sort.startswith('-'))
+
+    @staticmethod
+    def _search_words(text):
+        """ Returns the distinct lower case words of text in order """
+        words = []
+        for word in TOKEN_PATTERN.findall(('%s' % text).lower()):
+            if word not in words:
+                words.append(word)
+        return words
+
+    @staticmethod
+    def _search_members(record):
+        """ Returns the search index members of a serialized Data """
+        members = set()
+        for attribute in SEARCH_WEIGHTS:
+            if record.get(attribute) is None:
+                continue
+            for word in Data._search_words(record[attribute]):
+                members.add(':'.join([word, attribute, str(record['id'])]))
+        return members
+
+    @staticmethod
+    def _queue_search(pipe, words):
+        """ Queues a ZRANGEBYLEX for the index entries starting with each word """
+        key = Data._key(INDEX_PREFIX, SEARCH_KEY)
+        for word in words:
+            word = word.encode('utf-8')
+            # no UTF-8 byte is 0xff, so this is above every word with the prefix
+            pipe.zrangebylex(key, b'[' + word, b'[' + word + b'\xff', 0, SEARCH_CANDIDATES)
+
+    @staticmethod
+    def _rank_search(words, replies):
+        """ Returns the ids that match every word, best match first
+
+        A word scores the weight of the attribute it matched in, doubled
+        when it is the whole word, and a Data scores the sum over the query
+        words. Ties are ordered by id. Only SEARCH_CANDIDATES entries are
+        read per word, the first in byte order, so a prefix so common that
+        it reaches the limit misses some of its matches.
+        """
+        scores = None
+        for word, members in zip(words, replies):
+            best = {}
+            for member in members:
+                if isinstance(member, bytes):
+                    member = member.decode('utf-8')
+                found, attribute, data_id = member.rsplit(':', 2)
+                score = SEARCH_WEIGHTS.get(attribute, 1) * (2 if found == word else 1)
+                data_id = int(data_id)
+                best[data_id] = max(best.get(data_id, 0), score)
+            if scores is None:
+                scores = best
+            else:
+                scores = dict((data_id, scores[data_id] + score)
+                              for data_id, score in best.items() if data_id in scores)
+        return sorted(scores, key=lambda data_id: (-scores[data_id], data_id))
+
+######################################################################
+#  C A C H E   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def init_cache(max_size=0, ttl=0):
+        """ Replaces the read-through cache used by Data.find
+
+        When the cache is enabled a background thread subscribes to the
+        invalidation channel, so writes made by other processes evict the
+        records they changed. A max_size of 0 disables the cache.
+        """
+        if Data.cache_listener:
+            Data.cache_listener.stop()
+            Data.cache_listener = None
+        Data.cache = DataCache(max_size, ttl)
+        if Data.cache.enabled and Data.redis:
+            pubsub = Data.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{Data._key(INVALIDATION_CHANNEL): Data._on_invalidate})
+            Data.cache_listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        Data.logger.info('Data cache size %d ttl %d', max_size, ttl)
+
+    @staticmethod
+    def init_write_behind(max_size=0, batch_size=DEFAULT_BATCH_SIZE, interval_ms=50,
+                          wait=False, timeout=5):
+        """ Replaces the write-behind queue of save, see WriteBehind
+
+        Whatever the previous queue holds is written first. A max_size of 0
+        turns write-behind off so every save is written before it returns.
+        """
+        Data.write_behind.close()
+        Data.write_behind = WriteBehind(Data.save_many, max_size, batch_size,
+                                        interval_ms / 1000.0, wait, timeout)
+        with Data.id_lock:
+            Data.id_block = [1, 0]
+        Data.logger.info('Data write-behind queue size %d batch %d every %d ms',
+                         max_size, batch_size, interval_ms)
+
+    @staticmethod
+    def _on_invalidate(message):
+        """ Evicts the ids published by a writer """
+        ids = message['data']
+        if isinstance(ids, bytes):
+            ids = ids.decode('utf-8')
+        if ids == INVALIDATE_ALL:
+            Data.cache.clear()
+        else:
+            Data.cache.invalidate([int(data_id) for data_id in ids.split(',')])
+
+    @staticmethod
+    def _invalidate(pipe, data_ids):
+        """ Evicts ids from this cache and queues a notice for other processes """
+        data_ids = [int(data_id) for data_id in data_ids]
+        Data.cache.invalidate(data_ids)
+        pipe.publish(Data._key(INVALIDATION_CHANNEL), ','.join(str(data_id) for data_id in data_ids))
+
+######################################################################
+#  C H A N G E   F E E D   M E T H O D S
+######################################################################
+
+    @staticmethod
+    @timed('changes')
+    def changes(since='0', count=DEFAULT_BATCH_SIZE, block_ms=0):
+        """ Returns up to count change events recorded after the event id since
+
+        since is '0' for every event still kept. When there is no event
+        yet, block_ms waits up to that long for one. Each event has its
+        event id, its op and, but for reset, the id of the Data.
+
+        Exception:
+        ----------
+          DataChangesExpiredError - events after since were already trimmed
+        """
+        key = Data._key(CHANGES_KEY)
+        pipe = Data.redis.pipeline(transaction=False)
+        Data._queue_changes(pipe, since, count)
+        length, first, reply = pipe.execute()
+        Data._check_since(since, length, first)
+        events = Data._changes_result(reply)
+        if not events and block_ms:
+            # a blocked read holds its connection, so it has a pool of its own
+            redis = Data.changes_redis or Data.redis
+            events = Data._changes_result(
+                redis.xread({key: since}, count=count, block=block_ms))
+        return events
+
+    @staticmethod
+    def last_change_id():
+        """ Returns the id of the latest change event, '0' when there is none """
+        entries = Data.redis.xrevrange(Data._key(CHANGES_KEY), count=1)
+        return Data._changes_result([(CHANGES_KEY, entries)])[0]['event'] if entries else '0'
+
+    @staticmethod
+    def _record_changes(pipe, changes):
+        """ Queues an event for each (op, id) pair of changes """
+        if not Data.changes_length:
+            return
+        for op, data_id in changes:
+            fields = {'op': op} if data_id is None else {'op': op, 'id': data_id}
+            pipe.xadd(Data._key(CHANGES_KEY), fields, maxlen=Data.changes_length,
+                      approximate=True)
+
+    @staticmethod
+    def _queue_changes(pipe, since, count):
+        """ Queues the reads of the stream length, its first event and the events after since """
+        key = Data._key(CHANGES_KEY)
+        pipe.xlen(key)
+        pipe.xrange(key, count=1)
+        pipe.xread({key: since}, count=count)
+
+    @staticmethod
+    def _check_since(since, length, first):
+        """ Raises DataChangesExpiredError if events after since may have been trimmed
+
+        The stream is only trimmed once it holds changes_length events, and
+        then an id older than the first event kept may have missed some.
+        """
+        if since == '0' or not first or length < Data.changes_length:
+            return
+        if Data._change_id(since) < Data._change_id(first[0][0]):
+            raise DataChangesExpiredError(
+                'The changes after {} are no longer kept, list the Datas again'.format(since))
+
+    @staticmethod
+    def _change_id(event_id):
+        """ Returns an event id as a (milliseconds, sequence) tuple that sorts like it """
+        if isinstance(event_id, bytes):
+            event_id = event_id.decode('utf-8')
+        milliseconds, _, sequence = event_id.partition('-')
+        return int(milliseconds), int(sequence or 0)
+
+    @staticmethod
+    def _changes_result(reply):
+        """ Turns an XREAD reply into a list of event dictionaries """
+        def text(value):
+            return value.decode('utf-8') if isinstance(value, bytes) else value
+
+        events = []
+        for _, entries in reply or []:
+            for event_id, fields in entries:
+                fields = dict((text(name), text(value)) for name, value in fields.items())
+                event = {'event': text(event_id), 'op': fields['op']}
+                if 'id' in fields:
+                    event['id'] = int(fields['id'])
+                events.append(event)
+        return events
+
 ######################################################################
 #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
 ######################################################################
 
+    @staticmethod
+    def pool_options():
+        """ Reads the Redis connection pool settings from the environment
+
+        REDIS_MAX_CONNECTIONS - connections shared by all threads (50)
+        REDIS_POOL_TIMEOUT - seconds a thread waits for a free connection (5)
+        REDIS_SOCKET_TIMEOUT - seconds to wait for a command reply (5)
+        REDIS_CONNECT_TIMEOUT - seconds to wait for a new connection (2)
+        REDIS_SOCKET_KEEPALIVE - enables TCP keepalive (True)
+        REDIS_RETRY_ON_TIMEOUT - retries a command once after a timeout (True)
+        REDIS_HEALTH_CHECK_INTERVAL - seconds before an idle connection is
+                                      pinged before it is reused (30)
+        """
+        return {
+            'max_connections': int(os.getenv('REDIS_MAX_CONNECTIONS', '50')),
+            'timeout': float(os.getenv('REDIS_POOL_TIMEOUT', '5')),
+            'socket_timeout': float(os.getenv('REDIS_SOCKET_TIMEOUT', '5')),
+            'socket_connect_timeout': float(os.getenv('REDIS_CONNECT_TIMEOUT', '2')),
+            'socket_keepalive': os.getenv('REDIS_SOCKET_KEEPALIVE', 'True') == 'True',
+            'retry_on_timeout': os.getenv('REDIS_RETRY_ON_TIMEOUT', 'True') == 'True',
+            'health_check_interval': int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+        }
+
+    @staticmethod
+    def changes_pool_options():
+        """ Reads the settings of the pool that follows the change feed
+
+        Each server-sent event stream holds a connection while it waits for
+        a change, so they get their own pool and cannot starve the requests.
+        It takes the settings of pool_options but for its size:
+
+        REDIS_CHANGES_MAX_CONNECTIONS - streams waiting at the same time (50)
+        """
+        options = Data.pool_options()
+        options['max_connections'] = int(os.getenv('REDIS_CHANGES_MAX_CONNECTIONS', '50'))
+        return options
+
+    @staticmethod
+    def pool_stats(pool=None):
+        """ Reports how many connections of a Redis pool are in use
+
+        The pool defaults to the one of the Data client.
+        """
+        pool = pool or Data.redis.connection_pool
+        # redis-py does not expose these counters, so read its bookkeeping
+        if isinstance(pool, BlockingConnectionPool):
+            created = len(pool._connections)
+            idle = len([conn for conn in list(pool.pool.queue) if conn is not None])
+        else:
+            idle = len(pool._available_connections)
+            created = idle + len(pool._in_use_connections)
+        in_use = created - idle
+        return {
+            'max_connections': pool.max_connections,
+            'created_connections': created,
+            'in_use_connections': in_use,
+            'idle_connections': idle,
+            'saturation': float(in_use) / pool.max_connections
+        }
+
     @staticmethod
     def connect_to_redis(hostname, port, password):
-        """ Connects to Redis and tests the connection """
+        """ Connects to Redis through a configured pool and tests the connection """
         Data.logger.info("Testing Connection to: %s:%s", hostname, port)
-        Data.redis = Redis(host=hostname, port=port, password=password)
+        pool = BlockingConnectionPool(host=hostname, port=port, password=password,
+                                      **Data.pool_options())
+        Data.redis = Redis(connection_pool=pool)
+        pool = BlockingConnectionPool(host=hostname, port=port, password=password,
+                                      **Data.changes_pool_options())
+        Data.changes_redis = Redis(connection_pool=pool)
         try:
             Data.redis.ping()
             Data.logger.info("Connection established")
         except ConnectionError:
             Data.logger.info("Connection Error from: %s:%s", hostname, port)
             Data.redis = None
+            Data.changes_redis = None
         return Data.redis
 
     @staticmethod
@@ -185,10 +1423,29 @@ class Data(object):
           3) With Redis --link in a Docker container called 'redis'
           4) Passing in your own Redis connection object
 
+        The record format is picked with the DATA_CODEC environment variable
+        (pickle, struct, msgpack or hash) and defaults to pickle, also when
+        a codec was picked by an earlier call. The cache
+        in front of find is sized with DATA_CACHE_SIZE (0, the default,
+        disables it) and DATA_CACHE_TTL in seconds. Saves are queued and
+        written in batches when DATA_WRITE_BEHIND_SIZE bounds the queue
+        (0, the default, disables it), see init_write_behind for the other
+        DATA_WRITE_BEHIND_* settings. Every key is stored under the
+        DATA_KEY_PREFIX namespace ('data'), an empty prefix keeps the bare
+        keys of earlier releases. The change feed keeps about
+        DATA_CHANGES_LENGTH events (10000), 0 turns it off. Its blocking
+        reads go through a pool of their own, see changes_pool_options,
+        except with your own Redis connection object, which serves both.
+
         Exception:
         ----------
           redis.ConnectionError - if ping() test fails
         """
+        Data.codec = get_codec(os.getenv('DATA_CODEC') or DEFAULT_CODEC)
+        Data.key_prefix = os.getenv('DATA_KEY_PREFIX', DEFAULT_KEY_PREFIX)
+        Data.changes_length = int(os.getenv('DATA_CHANGES_LENGTH', DEFAULT_CHANGES_LENGTH))
+        Data.changes_redis = None
+        Data.scripts.clear()    # registered with the client being replaced
         if redis:
             Data.logger.info("Using client connection...")
             Data.redis = redis
@@ -199,9 +1456,8 @@ class Data(object):
                 Data.logger.error("Client Connection Error!")
                 Data.redis = None
                 raise ConnectionError('Could not connect to the Redis Service')
-            return
-        # Get the credentials from the Bluemix environment
-        if 'VCAP_SERVICES' in os.environ:
+        elif 'VCAP_SERVICES' in os.environ:
+            # Get the credentials from the Bluemix environment
             Data.logger.info("Using VCAP_SERVICES...")
             vcap_services = os.environ['VCAP_SERVICES']
             services = json.loads(vcap_services)
@@ -219,3 +1475,15 @@ class Data(object):
             # if you end up here, redis instance is down.
             Data.logger.fatal('*** FATAL ERROR: Could not connect to the Redis Service')
             raise ConnectionError('Could not connect to the Redis Service')
+        instrument_redis(Data.redis)
+        Data.init_cache(int(os.getenv('DATA_CACHE_SIZE', '0')),
+                        int(os.getenv('DATA_CACHE_TTL', '30')))
+        Data.init_write_behind(int(os.getenv('DATA_WRITE_BEHIND_SIZE', '0')),
+                               int(os.getenv('DATA_WRITE_BEHIND_BATCH', str(DEFAULT_BATCH_SIZE))),
+                               int(os.getenv('DATA_WRITE_BEHIND_MS', '50')),
+                               os.getenv('DATA_WRITE_BEHIND_WAIT', 'False') == 'True',
+                               float(os.getenv('DATA_WRITE_BEHIND_TIMEOUT', '5')))
+
+
+# Write out the Datas still queued by write-behind saves before exiting
+atexit.register(lambda: Data.write_behind.close())
@@ -0,0 +1,334 @@
+######################################################################
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Outbound Proxy for Cloud Functions
+
+FunctionsProxy makes the calls of the /functions endpoint. It keeps one
+requests Session whose connection pool is reused across calls, bounds
+every call with connect and read timeouts, stops calling a host that
+keeps failing with a circuit breaker, and can cache responses for a
+short time. Upstream latencies are recorded per host for the first
+FUNCTIONS_MAX_HOSTS hosts called, and under OTHER_HOST for the rest, so a
+caller naming ever new hosts cannot grow the stats and metric labels.
+
+The proxy is configured from the environment, see proxy_options():
+  FUNCTIONS_POOL_HOSTS       - hosts with a pool of their own (10)
+  FUNCTIONS_POOL_SIZE        - connections kept per host (10)
+  FUNCTIONS_MAX_HOSTS        - hosts with stats of their own (100)
+  FUNCTIONS_CONNECT_TIMEOUT  - seconds to connect (2)
+  FUNCTIONS_READ_TIMEOUT     - seconds to wait for the response (10)
+  FUNCTIONS_VERIFY_TLS       - verify certificates (False, as before)
+  FUNCTIONS_BREAKER_FAILURES - consecutive failures that open a circuit (5)
+  FUNCTIONS_BREAKER_RESET    - seconds before an open circuit is retried (30)
+  FUNCTIONS_CACHE_SIZE       - responses cached, 0 disables the cache (0)
+  FUNCTIONS_CACHE_TTL        - seconds a response stays cached (30)
+"""
+
+import os
+import json
+import base64
+import hashlib
+import logging
+import threading
+from time import time
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from models import DataCache
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:     # Python 2
+    from urlparse import urlsplit
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The stats of the hosts past max_hosts are reported under this name
+OTHER_HOST = 'other'
+
+
+class ProxyError(Exception):
+    """ Base class of the errors raised instead of an upstream response """
+    pass
+
+class UpstreamTimeoutError(ProxyError):
+    """ Used when the upstream did not answer within the timeouts """
+    pass
+
+class UpstreamConnectionError(ProxyError):
+    """ Used when the upstream could not be reached """
+    pass
+
+class CircuitOpenError(ProxyError):
+    """ Used when calls to a host are suspended by its circuit breaker """
+
+    def __init__(self, message, retry_after):
+        ProxyError.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """ Stops calls to a host after consecutive failures
+
+    The circuit opens after failure_threshold consecutive failures and
+    refuses calls for reset_timeout seconds. It then lets one trial call
+    through (half open); a success closes the circuit and a failure opens
+    it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False
+        self.opened = 0     # times the circuit opened
+
+    def allow(self):
+        """ Returns True if a call may go through now """
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN:
+                if time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = CircuitBreaker.HALF_OPEN
+                self.trial = False
+            if self.trial:
+                return False    # another call is already the trial
+            self.trial = True
+            return True
+
+    def retry_after(self):
+        """ Returns the seconds until the circuit lets a call through """
+        with self.lock:
+            return max(0, int(self.opened_at + self.reset_timeout - time()) + 1)
+
+    def record_success(self):
+        """ Closes the circuit after a call succeeded """
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.trial = False
+
+    def record_failure(self):
+        """ Counts a failed call and opens the circuit when needed """
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.state == CircuitBreaker.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    self.opened += 1
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time()
+
+
+class LatencyStats(object):
+    """ Thread safe histogram of upstream call latencies """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, error=False):
+        """ Records one call that took seconds """
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if error:
+                self.errors += 1
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[position] += 1
+                    break
+
+    def stats(self):
+        """ Returns the counters and the cumulative histogram buckets """
+        with self.lock:
+            cumulative, buckets = 0, []
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets.append([bound, cumulative])
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'sum': self.total,
+                'max': self.max,
+                'buckets': buckets
+            }
+
+
+def proxy_options():
+    """ Returns the FunctionsProxy options set in the environment """
+    return {
+        'pool_hosts': int(os.getenv('FUNCTIONS_POOL_HOSTS', '10')),
+        'pool_size': int(os.getenv('FUNCTIONS_POOL_SIZE', '10')),
+        'max_hosts': int(os.getenv('FUNCTIONS_MAX_HOSTS', '100')),
+        'connect_timeout': float(os.getenv('FUNCTIONS_CONNECT_TIMEOUT', '2')),
+        'read_timeout': float(os.getenv('FUNCTIONS_READ_TIMEOUT', '10')),
+        'verify': os.getenv('FUNCTIONS_VERIFY_TLS', 'False') == 'True',
+        'failure_threshold': int(os.getenv('FUNCTIONS_BREAKER_FAILURES', '5')),
+        'reset_timeout': int(os.getenv('FUNCTIONS_BREAKER_RESET', '30')),
+        'cache_size': int(os.getenv('FUNCTIONS_CACHE_SIZE', '0')),
+        'cache_ttl': int(os.getenv('FUNCTIONS_CACHE_TTL', '30'))
+    }
+
+
+class FunctionsProxy(object):
+    """ Pooled, bounded and cached client for cloud function calls """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, pool_hosts=10, pool_size=10, max_hosts=100, connect_timeout=2,
+                 read_timeout=10, verify=False, failure_threshold=5, reset_timeout=30,
+                 cache_size=0, cache_ttl=30):
+        self.max_hosts = max_hosts
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        # pool_block makes callers wait for a free connection instead of
+        # opening (and then discarding) connections beyond pool_size
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size,
+                              pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = DataCache(cache_size, cache_ttl)
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.latencies = {}
+        # the hosts past max_hosts share one latency histogram and keep
+        # their circuit breakers only while they are among the most recent
+        self.other_breakers = OrderedDict()
+        self.other_latency = LatencyStats()
+
+    def call(self, url, name, api_key):
+        """ Invokes the function at url and returns its status and body
+
+        api_key is the user:password pair of the Basic authentication.
+
+        Exceptions:
+        -----------
+          CircuitOpenError - calls to the host are suspended
+          UpstreamTimeoutError - the upstream did not answer in time
+          UpstreamConnectionError - the upstream could not be reached
+        """
+        key = (url, name, hashlib.sha1(api_key.encode('utf-8')).hexdigest())
+        generation = self.cache.generation
+        if self.cache.enabled:
+            response = self.cache.get(key)
+            if response is not None:
+                return response
+
+        host = urlsplit(url).netloc
+        breaker, latency = self.__host(host)
+        if not breaker.allow():
+            raise CircuitOpenError('Calls to {} are suspended after repeated failures'.format(host),
+                                   breaker.retry_after())
+
+        auth = base64.b64encode(api_key.encode('utf-8')).decode('ascii')
+        started = time()
+        try:
+            upstream = self.session.post(
+                url, timeout=self.timeout, verify=self.verify,
+                headers={'Content-Type': 'application/json', 'Authorization': 'Basic ' + auth},
+                data=json.dumps({'name': name}))
+        except requests.exceptions.Timeout as error:
+            self.__failed(host, breaker, latency, started, error)
+            raise UpstreamTimeoutError('{} did not answer in time'.format(host))
+        except requests.exceptions.RequestException as error:
+            self.__failed(host, breaker, latency, started, error)
+            raise UpstreamConnectionError('{} could not be reached'.format(host))
+
+        failed = upstream.status_code >= 500
+        latency.observe(time() - started, failed)
+        if failed:
+            breaker.record_failure()
+            return upstream.status_code, upstream.text
+        breaker.record_success()
+        response = (upstream.status_code, upstream.text)
+        if upstream.status_code < 400:
+            self.cache.put(key, response, generation)
+        return response
+
+    def __host(self, host):
+        """ Returns the circuit breaker and latency stats of a host """
+        with self.lock:
+            if host not in self.breakers and len(self.breakers) < self.max_hosts:
+                self.breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.latencies[host] = LatencyStats()
+            if host in self.breakers:
+                return self.breakers[host], self.latencies[host]
+            breaker = self.other_breakers.pop(host, None) or \
+                CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            self.other_breakers[host] = breaker
+            if len(self.other_breakers) > self.max_hosts:
+                self.other_breakers.popitem(last=False)
+            return breaker, self.other_latency
+
+    def __failed(self, host, breaker, latency, started, error):
+        """ Records a call that raised instead of answering """
+        self.logger.warning('Call to %s failed: %s', host, error)
+        latency.observe(time() - started, True)
+        breaker.record_failure()
+
+    def reset(self):
+        """ Forgets the circuit breakers, latencies and cached responses """
+        with self.lock:
+            self.breakers.clear()
+            self.latencies.clear()
+            self.other_breakers.clear()
+            self.other_latency = LatencyStats()
+        self.cache.clear()
+
+    def stats(self):
+        """ Returns the cache counters and the circuit state and latency of every host
+
+        The hosts past max_hosts are added up under OTHER_HOST, whose
+        circuit is open while any of theirs is.
+        """
+        with self.lock:
+            hosts = [(host, breaker.state, breaker.opened, self.latencies[host])
+                     for host, breaker in self.breakers.items()]
+            if self.other_latency.count or self.other_breakers:
+                states = [breaker.state for breaker in self.other_breakers.values()]
+                closed = all(state == CircuitBreaker.CLOSED for state in states)
+                hosts.append((OTHER_HOST, CircuitBreaker.CLOSED if closed else CircuitBreaker.OPEN,
+                              sum(breaker.opened for breaker in self.other_breakers.values()),
+                              self.other_latency))
+        return {
+            'cache': self.cache.stats(),
+            'hosts': dict((host, {
+                'circuit': state,
+                'opened': opened,
+                'latency': latency.stats()
+            }) for host, state, opened, latency in hosts)
+        }
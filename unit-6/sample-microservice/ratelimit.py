@@ -0,0 +1,204 @@
+######################################################################
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Rate Limiting and Admission Control
+
+AdmissionControl decides whether the Data service takes a request. Each
+client has a token bucket per endpoint, kept in Redis and updated by a
+Lua script so that every worker and server shares it; a client that has
+used up its bucket is answered 429 Too Many Requests. Each process also
+caps the requests it serves at once and answers 503 Service Unavailable
+beyond it. Both answers carry a Retry-After header.
+
+Admission is configured from the environment, see admission_options():
+  RATE_LIMIT_DEFAULT      - rate:burst of every endpoint, e.g. 50:100 where
+                            rate is in requests per second (no limit)
+  RATE_LIMITS             - endpoint=rate:burst overrides separated by commas,
+                            e.g. list_data=1:5,search_data=5:20; off removes
+                            the limit of an endpoint
+  RATE_LIMIT_TRUST_PROXY  - identify clients by the first X-Forwarded-For
+                            address instead of the peer address (False)
+  MAX_CONCURRENT_REQUESTS - requests a process serves at once, 0 for no cap (0)
+
+Endpoints are named after their view functions, such as list_data and
+get_data, in both servers. health, metrics_text and static are not
+limited unless RATE_LIMITS names them.
+"""
+
+import os
+import math
+import logging
+import threading
+from time import time
+from redis.exceptions import ConnectionError, TimeoutError
+
+# Buckets are hashes holding the tokens left and when they were counted
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local stamp = tonumber(redis.call('HGET', KEYS[1], 'stamp'))
+if not tokens then
+    tokens = burst
+    stamp = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens))
+redis.call('HSET', KEYS[1], 'stamp', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+if allowed == 1 then
+    return {1, 0}
+end
+return {0, math.ceil((1 - tokens) / rate * 1000)}
+"""
+
+# Endpoints that monitoring must always reach
+EXEMPT_ENDPOINTS = ('health', 'metrics_text', 'static')
+
+
+def parse_limit(text):
+    """ Parses rate:burst into a (requests per second, burst) tuple
+
+    The burst defaults to the rate rounded up. Returns None for an empty
+    value or off.
+    """
+    text = (text or '').strip().lower()
+    if text in ('', 'off'):
+        return None
+    rate, _, burst = text.partition(':')
+    rate = float(rate)
+    burst = int(burst) if burst else int(math.ceil(rate))
+    if rate <= 0 or burst < 1:
+        raise ValueError('Invalid rate limit: {}'.format(text))
+    return rate, burst
+
+def parse_limits(text):
+    """ Parses endpoint=rate:burst pairs separated by commas into a dictionary """
+    limits = {}
+    for pair in (text or '').split(','):
+        if pair.strip():
+            endpoint, _, limit = pair.partition('=')
+            limits[endpoint.strip()] = parse_limit(limit)
+    return limits
+
+def admission_options():
+    """ Returns the AdmissionControl options set in the environment """
+    return {
+        'default': parse_limit(os.getenv('RATE_LIMIT_DEFAULT', '')),
+        'limits': parse_limits(os.getenv('RATE_LIMITS', '')),
+        'max_concurrent': int(os.getenv('MAX_CONCURRENT_REQUESTS', '0')),
+        'trust_proxy': os.getenv('RATE_LIMIT_TRUST_PROXY', 'False') == 'True'
+    }
+
+
+class AdmissionControl(object):
+    """ Rate limits every client per endpoint and caps the requests served at once """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, default=None, limits=None, max_concurrent=0, trust_proxy=False):
+        self.default = default
+        self.limits = dict((endpoint, None) for endpoint in EXEMPT_ENDPOINTS)
+        self.limits.update(limits or {})
+        self.max_concurrent = max_concurrent
+        self.trust_proxy = trust_proxy
+        # Seconds the buckets are filled by, tests freeze it
+        self.clock = time
+        self.lock = threading.Lock()
+        self.script = None
+        self.in_flight = 0
+        self.shed = 0
+        self.limited = {}
+
+    def enter(self):
+        """ Counts a request in, or returns False if the process is at its cap """
+        with self.lock:
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        """ Counts a request that enter() let in out """
+        with self.lock:
+            self.in_flight -= 1
+
+    def client_of(self, address, forwarded_for=None):
+        """ Returns the name of the client whose buckets a request uses """
+        if self.trust_proxy and forwarded_for:
+            return forwarded_for.split(',')[0].strip()
+        return address or 'unknown'
+
+    def bucket_args(self, endpoint, now=None):
+        """ Returns the arguments of the token bucket script, None if endpoint has no limit """
+        limit = self.limits.get(endpoint, self.default)
+        if limit is None:
+            return None
+        rate, burst = limit
+        return [rate, burst, self.clock() if now is None else now]
+
+    def bucket_script(self, redis):
+        """ Returns the token bucket script registered with a Redis client """
+        if self.script is None or self.script.registered_client is not redis:
+            self.script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+        return self.script
+
+    def retry_after(self, endpoint, reply):
+        """ Turns a reply of the token bucket script into the seconds to wait, 0 to go on """
+        if not reply or int(reply[0]):
+            return 0
+        with self.lock:
+            self.limited[endpoint] = self.limited.get(endpoint, 0) + 1
+        return max(1, int(math.ceil(int(reply[1]) / 1000.0)))
+
+    def allow(self, redis, key, endpoint, now=None):
+        """ Takes a token from the bucket at key and returns the seconds to wait
+
+        0 means the request may go on. When Redis cannot be reached the
+        request is let through, the Data calls will report the outage.
+        """
+        args = self.bucket_args(endpoint, now)
+        if args is None or redis is None:
+            return 0
+        try:
+            reply = self.bucket_script(redis)(keys=[key], args=args)
+        except (ConnectionError, TimeoutError) as error:
+            self.logger.warning('Rate limit of %s not checked: %s', endpoint, error)
+            return 0
+        return self.retry_after(endpoint, reply)
+
+    def reset(self):
+        """ Forgets the counters """
+        with self.lock:
+            self.shed = 0
+            self.limited.clear()
+
+    def stats(self):
+        """ Returns the requests in flight, shed and rate limited by endpoint """
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'max_concurrent': self.max_concurrent,
+                'shed': self.shed,
+                'limited': dict(self.limited)
+            }
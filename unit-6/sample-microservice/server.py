@@ -19,44 +19,116 @@ This modules provides a REST API for the Data Model
 
 Paths:
 -----
-GET /data - Lists all of the Datas
+GET /data - Lists all of the Datas (paginated with ?limit=&cursor=)
+GET /data?stream=1 - Streams all of the Datas as a JSON array (or NDJSON)
 GET /data/{id} - Retrieves a single Data with the specified id
 POST /data - Creates a new Data 
 PUT /data/{id} - Updates a single Data with the specified id
 DELETE /data/{id} - Deletes a single Data with the specified id
 POST /data/{id}/purchase - Action to purchase a Data
+POST /data/_bulk - Creates many Datas from a list
+PUT /data/_bulk - Updates many Datas from a list of Datas with ids
+DELETE /data/_bulk - Deletes many Datas from a list of ids
+Every Data and list response carries an ETag. GET requests answer a
+matching If-None-Match with 304, and PUT, DELETE and purchase requests
+with an If-Match that no longer matches fail with 412.
+
+GET /health - Checks the Redis connection and reports connection pool saturation
+              and the write-behind queue
+GET /cache - Reports the size and hit, miss and eviction counters of the Data cache
+POST /functions - Calls a cloud function through a pooled proxy with timeouts,
+                  a per host circuit breaker and an optional response cache
+GET /functions/stats - Reports the upstream latencies and circuit states of the proxy
+GET /metrics - Reports request, Redis, cache, pool and proxy metrics in the
+               Prometheus text format
 """
 
 import os
 import sys
+import hashlib
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
-from models import Data, DataValidationError
-import requests, json, base64
+from time import time
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, g
+from redis.exceptions import ConnectionError, TimeoutError
+from models import Data, DataValidationError, DataConflictError, DataVersionError, \
+    DataOverloadError, DataChangesExpiredError, CHANGE_ID_PATTERN, INDEXED_ATTRIBUTES, \
+    RATE_LIMIT_KEY, SORT_ATTRIBUTES
+from proxy import FunctionsProxy, CircuitOpenError, UpstreamConnectionError, \
+    UpstreamTimeoutError, proxy_options
+from ratelimit import AdmissionControl, admission_options
+import metrics
+import json
 
 # Create Flask application
 app = Flask(__name__)
 app.config['LOGGING_LEVEL'] = logging.INFO
 
+# Pooled client for the calls of the /functions endpoint
+proxy = FunctionsProxy(**proxy_options())
+
+# Rate limits and concurrency cap, see ratelimit.py
+admission = AdmissionControl(**admission_options())
+
+# Report the cache, pool and proxy counters with the other metrics
+metrics.REGISTRY.add_collector(lambda: metrics.cache_metrics(Data.cache.stats()))
+metrics.REGISTRY.add_collector(lambda: metrics.pool_metrics(Data.pool_stats())
+                               if Data.redis else [])
+metrics.REGISTRY.add_collector(lambda: metrics.proxy_metrics(proxy.stats()))
+metrics.REGISTRY.add_collector(lambda: metrics.write_behind_metrics(Data.write_behind.stats()))
+metrics.REGISTRY.add_collector(lambda: metrics.admission_metrics(admission.stats()))
+
 # Pull options from environment
 DEBUG = (os.getenv('DEBUG', 'False') == 'True')
 PORT = os.getenv('PORT', '5000')
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+MAX_BULK_SIZE = int(os.getenv('MAX_BULK_SIZE', '1000'))
+# Keep this below REDIS_SOCKET_TIMEOUT, an event stream waits this long on Redis
+CHANGES_POLL_MS = int(os.getenv('CHANGES_POLL_MS', '2000'))
 
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
+HTTP_410_GONE = 410
+HTTP_412_PRECONDITION_FAILED = 412
+HTTP_429_TOO_MANY_REQUESTS = 429
+HTTP_502_BAD_GATEWAY = 502
+HTTP_503_SERVICE_UNAVAILABLE = 503
+HTTP_504_GATEWAY_TIMEOUT = 504
+
+# Media Types
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+EVENT_STREAM = 'text/event-stream'
 
 ######################################################################
 # Error Handlers
 ######################################################################
-# @app.errorhandler(DataValidationError)
-# def request_validation_error(error):
-#     """ Handles Value Errors from bad data """
-#     return bad_request(error)
+@app.errorhandler(DataValidationError)
+def request_validation_error(error):
+    """ Handles Value Errors from bad data with 400_BAD_REQUEST """
+    message = str(error)
+    app.logger.info(message)
+    return jsonify(status=400, error='Bad Request', message=message), HTTP_400_BAD_REQUEST
+
+@app.errorhandler(DataOverloadError)
+def overloaded(error):
+    """ Handles a full write-behind queue or concurrency cap with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    app.logger.warning(message)
+    return make_response(jsonify(status=503, error='Service Unavailable', message=message),
+                         HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'})
+
+@app.errorhandler(DataChangesExpiredError)
+def changes_expired(error):
+    """ Handles change feed reads from before the oldest event kept with 410_GONE """
+    message = str(error)
+    app.logger.info(message)
+    return jsonify(status=410, error='Gone', message=message), HTTP_410_GONE
 
 @app.errorhandler(400)
 def bad_request(error):
@@ -79,6 +151,20 @@ def method_not_supported(error):
     app.logger.info(message)
     return jsonify(status=405, error='Method not Allowed', message=message), 405
 
+@app.errorhandler(409)
+def conflict(error):
+    """ Handles requests that conflict with the resource state with 409_CONFLICT """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=409, error='Conflict', message=message), 409
+
+@app.errorhandler(412)
+def precondition_failed(error):
+    """ Handles requests whose If-Match no longer matches with 412_PRECONDITION_FAILED """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=412, error='Precondition Failed', message=message), 412
+
 @app.errorhandler(415)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -93,6 +179,20 @@ def internal_server_error(error):
     app.logger.info(message)
     return jsonify(status=500, error='Internal Server Error', message=message), 500
 
+@app.errorhandler(502)
+def bad_gateway(error):
+    """ Handles upstreams that could not be reached with 502_BAD_GATEWAY """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=502, error='Bad Gateway', message=message), 502
+
+@app.errorhandler(504)
+def gateway_timeout(error):
+    """ Handles upstreams that did not answer in time with 504_GATEWAY_TIMEOUT """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=504, error='Gateway Timeout', message=message), 504
+
 
 ######################################################################
 # GET INDEX
@@ -107,41 +207,295 @@ def functions():
     if request.method == 'POST':
         params = request.get_json(silent=True) or request.form
 
-        # use api_key as a Basic authentication (already in the form of user:pass)
-        #api_key = str(base64.b64encode(str.encode(params['api_key'])), "utf-8") # python 3.x
-        api_key = str(base64.b64encode(params['api_key'].encode("utf-8"))) # python 2
-
-        r = requests.post(params['url'],
-                    headers={ 'Content-Type': 'application/json', 'Authorization': 'Basic ' + api_key },
-                    data=json.dumps({ 'name': params['name'] }),
-                    verify=False)
-
-        return jsonify(message=r.text), 200
+        # api_key is used as a Basic authentication (already in the form of user:pass)
+        try:
+            _, text = proxy.call(params['url'], params['name'], params['api_key'])
+        except CircuitOpenError as error:
+            return make_response(jsonify(status=HTTP_503_SERVICE_UNAVAILABLE,
+                                         error='Service Unavailable', message=str(error)),
+                                 HTTP_503_SERVICE_UNAVAILABLE,
+                                 {'Retry-After': str(error.retry_after)})
+        except UpstreamTimeoutError as error:
+            abort(HTTP_504_GATEWAY_TIMEOUT, str(error))
+        except UpstreamConnectionError as error:
+            abort(HTTP_502_BAD_GATEWAY, str(error))
+
+        return jsonify(message=text), 200
 
     """ Send back the home page """
     return app.send_static_file('functions.html')
 
+@app.route('/functions/stats', methods=['GET'])
+def functions_stats():
+    """ Returns the upstream latencies, circuit states and cache counters of the proxy """
+    return make_response(jsonify(proxy.stats()), HTTP_200_OK)
+
+######################################################################
+# HEALTH CHECK
+######################################################################
+@app.route('/health', methods=['GET'])
+def health():
+    """ Reports whether Redis answers and how busy the connection pool is """
+    try:
+        Data.redis.ping()
+    except (ConnectionError, TimeoutError) as error:
+        app.logger.error('Health check failed: %s', error)
+        return make_response(jsonify(status='DOWN', message=str(error)),
+                             HTTP_503_SERVICE_UNAVAILABLE)
+    return make_response(jsonify(status='OK', pool=Data.pool_stats(),
+                                 write_behind=Data.write_behind.stats()), HTTP_200_OK)
+
+######################################################################
+# CACHE STATISTICS
+######################################################################
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    """ Returns the counters of the Data cache """
+    return make_response(jsonify(Data.cache.stats()), HTTP_200_OK)
+
+######################################################################
+# METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    """ Returns the service metrics in the Prometheus text format """
+    return Response(metrics.REGISTRY.render(), status=HTTP_200_OK,
+                    content_type=metrics.CONTENT_TYPE)
+
+@app.before_request
+def start_timer():
+    """ Counts the request as in flight and notes when it started """
+    g.started = time()
+    metrics.HTTP_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request(response):
+    """ Records the count and latency of the request by route """
+    if 'started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(request.method, route, response.status_code, g.started)
+    return response
+
+@app.before_request
+def admit_request():
+    """ Refuses the request when the process is at its cap or the client over its rate
+
+    A stream of changes stays open as long as its client does, so it does
+    not count against the cap.
+    """
+    endpoint = request.endpoint or 'unmatched'
+    if not (endpoint == 'list_changes' and wants_event_stream()):
+        if not admission.enter():
+            raise DataOverloadError('The server is busy, retry shortly')
+        g.admitted = True
+    client = admission.client_of(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    retry_after = admission.allow(Data.redis, Data._key(RATE_LIMIT_KEY, endpoint, client),
+                                  endpoint)
+    if retry_after:
+        message = 'Too many requests to {}, retry in {} seconds'.format(endpoint, retry_after)
+        app.logger.info(message)
+        return make_response(jsonify(status=429, error='Too Many Requests', message=message),
+                             HTTP_429_TOO_MANY_REQUESTS, {'Retry-After': str(retry_after)})
+
+@app.after_request
+def hold_admission(response):
+    """ Keeps a streamed response counted against the cap until its body is sent
+
+    The request is torn down once the view returns, before a streamed body
+    is produced, so its slot is given back when the response is closed.
+    Files are passed straight to the WSGI server, which never calls the
+    close callbacks of their response, so they leave on teardown.
+    """
+    if g.get('admitted') and response.is_streamed and not response.direct_passthrough:
+        response.call_on_close(admission.leave)
+        g.admitted = False
+    return response
+
+@app.teardown_request
+def stop_timer(error=None):
+    """ Removes the request from the in flight requests """
+    if 'started' in g:
+        metrics.HTTP_IN_FLIGHT.dec()
+    if g.get('admitted'):
+        admission.leave()
+
 ######################################################################
 # LIST ALL DATA
 ######################################################################
 @app.route('/data', methods=['GET'])
 def list_data():
-    """ Returns all of the Datas """
-    datas = []
-    category = request.args.get('category')
-    name = request.args.get('name')
-    available = request.args.get('available')
-    if category:
-        datas = Data.find_by_category(category)
-    elif name:
-        datas = Data.find_by_name(name)
-    elif available:
-        datas = Data.find_by_availability(available)
+    """ Returns all of the Datas
+
+    The Datas can be filtered on any combination of name, category and
+    available, and sorted with sort=attribute or sort=-attribute.
+    """
+    etag = collection_etag()
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    filters = dict((attribute, request.args[attribute]) for attribute in INDEXED_ATTRIBUTES
+                   if request.args.get(attribute))
+    sort = request.args.get('sort')
+    if sort and sort.lstrip('-') not in SORT_ATTRIBUTES:
+        abort(HTTP_400_BAD_REQUEST, 'sort must be one of {}'.format(', '.join(SORT_ATTRIBUTES)))
+    if filters or sort:
+        datas = Data.query(filters, sort)
+    elif 'limit' in request.args or 'cursor' in request.args:
+        return list_data_page(etag)
+    else:
+        datas = Data.iter_all()
+
+    if request.args.get('stream') or wants_ndjson():
+        response = stream_data(datas)
     else:
-        datas = Data.all()
+        results = [data.serialize() for data in datas]
+        response = make_response(jsonify(results), HTTP_200_OK)
+    response.set_etag(etag)
+    return response
+
+def wants_ndjson():
+    """ Checks if the client prefers newline delimited JSON """
+    return request.accept_mimetypes.best_match([JSON, NDJSON]) == NDJSON
+
+def stream_data(datas):
+    """ Streams Datas one record at a time instead of building the whole body
+
+    The body is NDJSON when the client accepts it, otherwise a JSON array
+    that is written out incrementally.
+    """
+    if wants_ndjson():
+        def generate():
+            for data in datas:
+                yield json.dumps(data.serialize()) + '\n'
+        return Response(generate(), status=HTTP_200_OK, mimetype=NDJSON)
+
+    def generate():
+        separator = '['
+        for data in datas:
+            yield separator + json.dumps(data.serialize())
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+    return Response(generate(), status=HTTP_200_OK, mimetype=JSON)
+
+def list_data_page(etag):
+    """ Returns one page of Datas with a link to the next page """
+    try:
+        limit = int(request.args.get('limit', MAX_PAGE_SIZE))
+        cursor = int(request.args.get('cursor', 0))
+    except ValueError:
+        abort(HTTP_400_BAD_REQUEST, 'limit and cursor must be integers')
+    if limit < 1 or cursor < 0:
+        abort(HTTP_400_BAD_REQUEST, 'limit must be positive and cursor must not be negative')
+    cursor, datas = Data.page(cursor, min(limit, MAX_PAGE_SIZE))
+    results = [data.serialize() for data in datas]
+    headers = {'X-Next-Cursor': cursor}
+    if cursor:
+        next_url = url_for('list_data', limit=limit, cursor=cursor, _external=True)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    response = make_response(jsonify(results), HTTP_200_OK, headers)
+    response.set_etag(etag)
+    return response
+
+######################################################################
+# SEARCH DATA
+######################################################################
+@app.route('/data/search', methods=['GET'])
+def search_data():
+    """
+    Searches the Datas by name and category
 
+    Every word of q must start a word of the name or the category of a
+    Data. Results are ranked, see Data.search, and paged with limit and
+    offset; X-Total-Count gives the number of matches.
+    """
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', MAX_PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        abort(HTTP_400_BAD_REQUEST, 'limit and offset must be integers')
+    if limit < 1 or offset < 0:
+        abort(HTTP_400_BAD_REQUEST, 'limit must be positive and offset must not be negative')
+    if not Data._search_words(query):
+        abort(HTTP_400_BAD_REQUEST, 'q must contain a word to search for')
+    limit = min(limit, MAX_PAGE_SIZE)
+    total, datas = Data.search(query, offset, limit)
     results = [data.serialize() for data in datas]
-    return make_response(jsonify(results), HTTP_200_OK)
+    headers = {'X-Total-Count': total}
+    if offset + limit < total:
+        next_url = url_for('search_data', q=query, limit=limit, offset=offset + limit,
+                           _external=True)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return make_response(jsonify(results), HTTP_200_OK, headers)
+
+######################################################################
+# COUNT DATA
+######################################################################
+@app.route('/data/stats', methods=['GET'])
+def data_stats():
+    """ Returns the number of Datas and of available ones, overall and by category """
+    return make_response(jsonify(Data.counts()), HTTP_200_OK)
+
+######################################################################
+# FOLLOW DATA CHANGES
+######################################################################
+@app.route('/data/changes', methods=['GET'])
+def list_changes():
+    """
+    Returns the changes made to the Datas after an event
+
+    since, or the Last-Event-ID header, is the id of the last event the
+    client has seen; without it every event still kept is returned. A
+    client that accepts text/event-stream gets server-sent events that
+    go on as changes are made, from the next change without since.
+    """
+    since = request.args.get('since') or request.headers.get('Last-Event-ID')
+    if since and not CHANGE_ID_PATTERN.match(since):
+        abort(HTTP_400_BAD_REQUEST, 'since must be the id of an event')
+    try:
+        limit = int(request.args.get('limit', MAX_PAGE_SIZE))
+    except ValueError:
+        abort(HTTP_400_BAD_REQUEST, 'limit must be an integer')
+    if limit < 1:
+        abort(HTTP_400_BAD_REQUEST, 'limit must be positive')
+    limit = min(limit, MAX_PAGE_SIZE)
+    if wants_event_stream():
+        return stream_changes(since or Data.last_change_id(), limit)
+    events = Data.changes(since or '0', limit)
+    last = events[-1]['event'] if events else since or '0'
+    headers = {'X-Last-Event-ID': last}
+    if len(events) == limit:
+        next_url = url_for('list_changes', since=last, limit=limit, _external=True)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return make_response(jsonify(events), HTTP_200_OK, headers)
+
+def wants_event_stream():
+    """ Checks if the client asks for server-sent events """
+    return request.accept_mimetypes.best_match([JSON, EVENT_STREAM]) == EVENT_STREAM
+
+def stream_changes(since, limit):
+    """ Streams the changes after since as server-sent events
+
+    Each poll waits up to CHANGES_POLL_MS for a change and sends a comment
+    when there is none, which keeps proxies from closing the connection
+    and lets the server notice a client that went away.
+    """
+    events = Data.changes(since, limit)     # a 410 must be sent before the stream
+
+    def generate(events, since):
+        while True:
+            if not events:
+                yield ': keep-alive\n\n'
+            for event in events:
+                since = event['event']
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                    since, event['op'], json.dumps(event))
+            try:
+                events = Data.changes(since, limit, CHANGES_POLL_MS)
+            except DataChangesExpiredError as error:
+                yield 'event: expired\ndata: {}\n\n'.format(json.dumps({'message': str(error)}))
+                return
+    return Response(generate(events, since), status=HTTP_200_OK, mimetype=EVENT_STREAM,
+                    headers={'Cache-Control': 'no-cache'})
 
 ######################################################################
 # RETRIEVE A DATA
@@ -151,12 +505,22 @@ def get_data(data_id):
     """
     Retrieve a single Data 
 
-    This endpoint will return a Data based on it's id
+    This endpoint will return a Data based on it's id. A Data still queued
+    by a write-behind save has no version yet, so it is sent without an ETag.
     """
+    etag = None
+    if not Data.is_queued(data_id):
+        version = Data.version_of(data_id)
+        etag = data_etag(data_id, version)
+        if version and request.if_none_match.contains(etag):
+            return not_modified(etag)
     data = Data.find(data_id)
     if not data:
         abort(HTTP_404_NOT_FOUND, "Data with id '{}' was not found.".format(data_id))
-    return make_response(jsonify(data.serialize()), HTTP_200_OK)
+    response = make_response(jsonify(data.serialize()), HTTP_200_OK)
+    if etag and not Data.is_queued(data_id):   # not saved again meanwhile
+        response.set_etag(etag)
+    return response
 
 ######################################################################
 # ADD A NEW DATA
@@ -186,8 +550,10 @@ def create_data():
     data.deserialize(item)
     data.save()
     message = data.serialize()
-    return make_response(jsonify(message), HTTP_201_CREATED,
-                         {'Location': url_for('get_data', data_id=data.id, _external=True)})
+    response = make_response(jsonify(message), HTTP_201_CREATED,
+                             {'Location': url_for('get_data', data_id=data.id, _external=True)})
+    response.set_etag(data_etag(data.id, data.version))
+    return response
 
 ######################################################################
 # UPDATE AN EXISTING DATA
@@ -204,8 +570,13 @@ def update_data(data_id):
         abort(HTTP_404_NOT_FOUND, "Data with id '{}' was not found.".format(data_id))
     data.deserialize(request.get_json())
     data.id = data_id
-    data.save()
-    return make_response(jsonify(data.serialize()), HTTP_200_OK)
+    try:
+        data.save(if_match_versions(data_id))
+    except DataVersionError as error:
+        abort(HTTP_412_PRECONDITION_FAILED, str(error))
+    response = make_response(jsonify(data.serialize()), HTTP_200_OK)
+    response.set_etag(data_etag(data.id, data.version))
+    return response
 
 
 ######################################################################
@@ -220,29 +591,170 @@ def delete_data(data_id):
     """
     data = Data.find(data_id)
     if data:
-        data.delete()
+        try:
+            data.delete(if_match_versions(data_id))
+        except DataVersionError as error:
+            abort(HTTP_412_PRECONDITION_FAILED, str(error))
+    elif request.if_match:
+        abort(HTTP_412_PRECONDITION_FAILED, "Data with id '{}' was not found.".format(data_id))
     return make_response('', HTTP_204_NO_CONTENT)
 
+######################################################################
+# BULK CREATE, UPDATE AND DELETE
+######################################################################
+@app.route('/data/_bulk', methods=['POST'])
+def create_data_bulk():
+    """
+    Creates many Datas
+
+    The body is a list of Datas. Every valid Data is created in a single
+    transaction and the response reports a status for each item in order.
+    """
+    items = get_bulk_items()
+    results = [None] * len(items)
+    datas = []
+    for position, item in enumerate(items):
+        try:
+            datas.append((position, bulk_data(Data(), item)))
+        except DataValidationError as error:
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, error)
+    save_bulk(datas, results, HTTP_201_CREATED)
+    return make_response(jsonify(results=results), HTTP_200_OK)
+
+@app.route('/data/_bulk', methods=['PUT'])
+def update_data_bulk():
+    """
+    Updates many Datas
+
+    The body is a list of Datas that each carry the id to update. Every
+    Data that exists and is valid is updated in a single transaction.
+    """
+    items = get_bulk_items()
+    results = [None] * len(items)
+    ids = []
+    for position, item in enumerate(items):
+        try:
+            ids.append((position, int(item['id'])))
+        except (KeyError, TypeError, ValueError):
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, 'Invalid data: missing or bad id')
+    datas = []
+    found = Data.find_many([data_id for _, data_id in ids])
+    for (position, data_id), data in zip(ids, found):
+        if not data:
+            message = "Data with id '{}' was not found.".format(data_id)
+            results[position] = bulk_error(HTTP_404_NOT_FOUND, message)
+            continue
+        try:
+            datas.append((position, bulk_data(data, items[position])))
+        except DataValidationError as error:
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, error)
+    save_bulk(datas, results, HTTP_200_OK)
+    return make_response(jsonify(results=results), HTTP_200_OK)
+
+@app.route('/data/_bulk', methods=['DELETE'])
+def delete_data_bulk():
+    """
+    Deletes many Datas
+
+    The body is a list of ids. Like DELETE /data/{id}, ids that do not
+    exist are reported as deleted.
+    """
+    items = get_bulk_items()
+    results = [None] * len(items)
+    ids = []
+    for position, item in enumerate(items):
+        try:
+            ids.append(int(item))
+            results[position] = {'id': ids[-1], 'status': HTTP_204_NO_CONTENT}
+        except (TypeError, ValueError):
+            results[position] = bulk_error(HTTP_400_BAD_REQUEST, 'Invalid id: {}'.format(item))
+    Data.delete_many(ids)
+    return make_response(jsonify(results=results), HTTP_200_OK)
+
+def get_bulk_items():
+    """ Returns the list of items in the body of a bulk request """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(HTTP_400_BAD_REQUEST, 'The body of a bulk request must be a JSON list')
+    if len(items) > MAX_BULK_SIZE:
+        abort(HTTP_400_BAD_REQUEST, 'A bulk request is limited to {} items'.format(MAX_BULK_SIZE))
+    return items
+
+def save_bulk(datas, results, status):
+    """ Saves the (position, Data) pairs and records their results """
+    Data.save_many([data for _, data in datas])
+    for position, data in datas:
+        results[position] = {'id': data.id, 'status': status, 'data': data.serialize()}
+
+def bulk_data(data, item):
+    """ Deserializes a bulk item into data and checks the fields save_many requires
+
+    save_many refuses the whole batch over one invalid Data, so each item
+    is checked here and reported on its own instead.
+    """
+    data.deserialize(item)
+    if data.name is None:
+        raise DataValidationError('name attribute is not set')
+    return data
+
+def bulk_error(status, error):
+    """ Builds the result of a bulk item that failed """
+    return {'status': status, 'error': str(error)}
+
 ######################################################################
 # PURCHASE A DATA 
 ######################################################################
 @app.route('/data/<int:data_id>/purchase', methods=['PUT'])
 def purchase_data(data_id):
     """ Purchase a Data """
-    data = Data.find(data_id)
+    try:
+        data = Data.purchase(data_id, if_match_versions(data_id))
+    except DataConflictError as error:
+        abort(HTTP_409_CONFLICT, str(error))
+    except DataVersionError as error:
+        abort(HTTP_412_PRECONDITION_FAILED, str(error))
     if not data:
         abort(HTTP_404_NOT_FOUND, "Data with id '{}' was not found.".format(data_id))
-    if not data.available:
-        abort(HTTP_400_BAD_REQUEST, "Data with id '{}' is not available.".format(data_id))
-    data.available = False
-    data.save()
-    return make_response(jsonify(data.serialize()), HTTP_200_OK)
+    response = make_response(jsonify(data.serialize()), HTTP_200_OK)
+    response.set_etag(data_etag(data.id, data.version))
+    return response
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
+def data_etag(data_id, version):
+    """ Returns the strong ETag of a Data at a version """
+    return '{}-{}'.format(data_id, version)
+
+def collection_etag():
+    """ Returns the strong ETag of a list query at the current collection version
+
+    The query string and the media type are part of the tag so that every
+    distinct representation of the collection has its own.
+    """
+    query = request.query_string + (b'|ndjson' if wants_ndjson() else b'')
+    digest = hashlib.sha1(query).hexdigest()[:16]
+    return 'c{}-{}'.format(Data.collection_version(), digest)
+
+def if_match_versions(data_id):
+    """ Returns the versions of a Data accepted by If-Match, None for any """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = set()
+    for tag in request.if_match:
+        tag_id, _, version = tag.partition('-')
+        if tag_id == str(data_id) and version.isdigit():
+            versions.add(int(version))
+    return versions
+
+def not_modified(etag):
+    """ Builds a 304 response without serializing anything """
+    response = make_response('', HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
 @app.before_first_request
 def init_db(redis=None):
     """ Initlaize the model """
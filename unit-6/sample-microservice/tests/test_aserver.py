@@ -0,0 +1,143 @@
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asynchronous Data API Service Test Suite
+
+Runs every test of the Data API Service Test Suite against the ASGI
+server in aserver.py. It is skipped where aserver cannot be imported,
+which includes Python 2.
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+import test_server
+
+try:
+    from starlette.testclient import TestClient
+    import aserver
+except (ImportError, SyntaxError):
+    aserver = None
+
+
+class AsyncResponse(object):
+    """ Gives a TestClient response the attributes the tests read """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.data = response.content
+        self.mimetype = response.headers.get('Content-Type', '').split(';')[0]
+        self.is_streamed = 'content-length' not in response.headers
+
+    def get_data(self):
+        """ Returns the body like a Flask response """
+        return self.data
+
+
+class AsyncClient(object):
+    """ Calls the ASGI app with the arguments of the Flask test client """
+
+    def __init__(self, client):
+        self.client = client
+
+    def open(self, method, path, data=None, content_type=None, query_string=None,
+             headers=None):
+        """ Sends a request and wraps its response """
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+        if query_string:
+            path = path + '?' + query_string
+        return AsyncResponse(self.client.request(method, path, content=data, headers=headers))
+
+    def get(self, path, **kwargs):
+        return self.open('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open('DELETE', path, **kwargs)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+@unittest.skipIf(aserver is None, 'the async server needs Python 3 and Starlette')
+class TestAsyncDataServer(test_server.TestDataServer):
+    """ Async Data Service tests """
+
+    def setUp(self):
+        test_server.TestDataServer.setUp(self)
+        aserver.proxy.reset()
+        self.proxy = aserver.proxy
+        aserver.admission.reset()
+        self.admission = aserver.admission
+        self.client = TestClient(aserver.app)
+        self.client.__enter__()
+        self.app = AsyncClient(self.client)
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+    @unittest.skip('write-behind is not used by AsyncData')
+    def test_create_data_write_behind(self):
+        pass
+
+    @unittest.skip('write-behind is not used by AsyncData')
+    def test_create_data_write_behind_full(self):
+        pass
+
+    @unittest.skip('write-behind is not used by AsyncData')
+    def test_get_data_write_behind_etag(self):
+        pass
+
+    @unittest.skip('AdmissionMiddleware counts a request until its body is sent')
+    def test_get_data_list_streamed_admission(self):
+        pass
+
+    def test_change_feed_stream(self):
+        """ Stream the changes as server-sent events """
+        response = self.client.portal.call(aserver.stream_changes, '0', 10)
+        chunk = self.client.portal.call(response.body_iterator.__anext__)
+        self.client.portal.call(response.body_iterator.aclose)
+        self.assertEqual(response.media_type, 'text/event-stream')
+        self.assertTrue(chunk.startswith('id: '))
+        self.assertIn('event: reset', chunk)
+
+    def test_load_async(self):
+        """ Load and reset Data through the async model """
+        self.client.portal.call(aserver.data_load, {"name": "nemo", "category": "fish"})
+        self.assertEqual(self.get_data_count(), 3)
+        self.client.portal.call(aserver.data_reset)
+        self.assertEqual(self.get_data_count(), 0)
+
+
+class TestAsyncDataServerHashCodec(TestAsyncDataServer):
+    """ Async Data Service tests with the Datas stored as hashes """
+
+    codec = 'hash'
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Jinho Hwang. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Record Codec Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from codec import CODECS, FIELDS, HashCodec, get_codec
+
+RECORDS = [
+    {'id': 1, 'name': u'fido', 'category': u'dog', 'available': True},
+    {'id': 2, 'name': u'kitty', 'category': None, 'available': False},
+    {'id': 2 ** 40, 'name': u'Pépé 猫', 'category': u'', 'available': True},
+]
+
+
+def hmget_reply(mapping, fields=FIELDS):
+    """ Returns the values HMGET sends back for a hash written by HashCodec """
+    return [None if mapping.get(field) is None else (u'%s' % mapping[field]).encode('utf-8')
+            for field in fields]
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCodecs(unittest.TestCase):
+    """ Record codec tests """
+
+    def codecs(self):
+        """ Returns every codec that can be loaded here """
+        codecs = []
+        for name in sorted(CODECS):
+            try:
+                codecs.append(get_codec(name))
+            except ValueError:
+                pass    # msgpack is not installed
+        return codecs
+
+    def round_trip(self, codec, record):
+        """ Encodes a record and decodes it the way it is read back from Redis """
+        encoded = codec.encode(record)
+        if isinstance(codec, HashCodec):
+            return codec.decode(hmget_reply(encoded))
+        return codec.decode(encoded)
+
+    def test_round_trip(self):
+        """ Read back every record as it was written """
+        for codec in self.codecs():
+            for record in RECORDS:
+                self.assertEqual(self.round_trip(codec, record), record,
+                                 '{} changed {}'.format(codec.name, record))
+
+    def test_hash_partial_read(self):
+        """ Read only some fields of a hash """
+        codec = HashCodec()
+        fields = ('id', 'name', 'available')
+        record = codec.decode(hmget_reply(codec.encode(RECORDS[0]), fields), fields)
+        self.assertEqual(record, {'id': 1, 'name': u'fido', 'available': True})
+
+    def test_hash_missing(self):
+        """ Read a hash that does not exist """
+        self.assertIsNone(HashCodec().decode([None, None, None, None]))
+
+    def test_unknown_codec(self):
+        """ Ask for a codec that does not exist """
+        self.assertRaises(ValueError, get_codec, 'yaml')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
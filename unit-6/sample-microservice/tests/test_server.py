@@ -19,10 +19,19 @@ Test cases can be run with the following:
 nosetests -v --with-spec --spec-color
 """
 
+import os
 import unittest
 import logging
 import json
+import threading
+import requests
 import server
+from models import WriteBehind
+
+try:
+    from unittest import mock
+except ImportError:     # Python 2
+    import mock
 
 # Status Codes
 HTTP_200_OK = 200
@@ -32,6 +41,12 @@ HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_405_METHOD_NOT_ALLOWED = 405
 HTTP_409_CONFLICT = 409
+HTTP_410_GONE = 410
+HTTP_304_NOT_MODIFIED = 304
+HTTP_412_PRECONDITION_FAILED = 412
+HTTP_429_TOO_MANY_REQUESTS = 429
+HTTP_502_BAD_GATEWAY = 502
+HTTP_503_SERVICE_UNAVAILABLE = 503
 
 ######################################################################
 #  T E S T   C A S E S
@@ -39,19 +54,62 @@ HTTP_409_CONFLICT = 409
 class TestDataServer(unittest.TestCase):
     """ Data Service tests """
 
+    codec = None    # the one DATA_CODEC picks
+
     def setUp(self):
+        if self.codec:
+            environ = mock.patch.dict(os.environ, {'DATA_CODEC': self.codec})
+            environ.start()
+            self.addCleanup(environ.stop)
         self.app = server.app.test_client()
+        self.app.open = self.closing(self.app.open)
         server.initialize_logging(logging.CRITICAL)
         server.init_db()
+        server.proxy.reset()
+        self.proxy = server.proxy
+        server.admission.reset()
+        self.admission = server.admission
         server.data_reset()
         server.data_load({"name": "fido", "category": "dog", "available": True})
         server.data_load({"name": "kitty", "category": "cat", "available": True})
 
+    def closing(self, open_response):
+        """ Closes the responses after the test like a WSGI server does after sending them """
+        def open_and_close(*args, **kwargs):
+            response = open_response(*args, **kwargs)
+            self.addCleanup(response.close)
+            return response
+        return open_and_close
+
     def test_index(self):
         """ Test the index page """
         resp = self.app.get('/')
         self.assertEqual(resp.status_code, HTTP_200_OK)
-        self.assertIn('Data Demo REST API Service', resp.data)
+        self.assertIn(b'Data Demo REST API Service', resp.data)
+
+    def test_health(self):
+        """ Check the health of the service """
+        resp = self.app.get('/health')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['status'], 'OK')
+        self.assertIn('saturation', data['pool'])
+
+    def test_metrics(self):
+        """ Report the request, Redis and cache metrics """
+        self.app.get('/data/2')
+        self.app.get('/data', query_string='category=dog')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+        text = resp.data.decode('utf-8')
+        self.assertIn('http_requests_total{method="GET",route="/data/', text)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",route="/data"', text)
+        self.assertIn('http_requests_in_flight 1', text)
+        self.assertIn('redis_commands_total{command="SMEMBERS"}', text)
+        self.assertIn('data_operation_duration_seconds_count{operation="query"}', text)
+        self.assertIn('data_cache_misses_total', text)
+        self.assertIn('redis_pool_saturation', text)
 
     def test_get_data_list(self):
         """ Get a list of Data """
@@ -59,6 +117,59 @@ class TestDataServer(unittest.TestCase):
         self.assertEqual(resp.status_code, HTTP_200_OK)
         self.assertTrue(len(resp.data) > 0)
 
+    def test_get_data_list_paginated(self):
+        """ Page through the list of Data with a cursor """
+        for i in range(10):
+            server.data_load({"name": "pet%d" % i, "category": "fish"})
+        names = []
+        cursor = '0'
+        while True:
+            resp = self.app.get('/data', query_string='limit=3&cursor=' + cursor)
+            self.assertEqual(resp.status_code, HTTP_200_OK)
+            names.extend(item['name'] for item in json.loads(resp.data))
+            cursor = resp.headers['X-Next-Cursor']
+            if cursor == '0':
+                self.assertNotIn('Link', resp.headers)
+                break
+            self.assertIn('rel="next"', resp.headers['Link'])
+        self.assertEqual(len(set(names)), 12)
+
+    def test_get_data_list_bad_limit(self):
+        """ Page through the list of Data with a bad limit """
+        resp = self.app.get('/data', query_string='limit=zero')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_get_data_list_streamed(self):
+        """ Stream the list of Data as a JSON array """
+        resp = self.app.get('/data', query_string='stream=1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        names = sorted(item['name'] for item in json.loads(resp.data))
+        self.assertEqual(names, ['fido', 'kitty'])
+
+    def test_get_data_list_streamed_admission(self):
+        """ Count a streamed list against the cap until its body is sent """
+        resp = server.app.test_client().get('/data', query_string='stream=1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(self.admission.stats()['in_flight'], 1)
+        names = sorted(item['name'] for item in json.loads(resp.get_data()))
+        self.assertEqual(names, ['fido', 'kitty'])
+        resp.close()
+        self.assertEqual(self.admission.stats()['in_flight'], 0)
+        # files are handed to the WSGI server as they are and leave on teardown
+        resp = server.app.test_client().get('/')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(self.admission.stats()['in_flight'], 0)
+
+    def test_get_data_list_ndjson(self):
+        """ Stream a query of Data as NDJSON """
+        resp = self.app.get('/data', query_string='category=cat',
+                            headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['kitty'])
+
     def test_get_data(self):
         """ get a single Data """
         resp = self.app.get('/data/2')
@@ -74,6 +185,48 @@ class TestDataServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertIn('was not found', data['message'])
 
+    def test_get_data_not_modified(self):
+        """ Get a Data again with its ETag """
+        resp = self.app.get('/data/2')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/data/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        self.app.put('/data/2/purchase', content_type='application/json')
+        resp = self.app.get('/data/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_get_data_list_not_modified(self):
+        """ Get the list of Data again with its ETag """
+        resp = self.app.get('/data', query_string='category=dog')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/data', query_string='category=dog',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_304_NOT_MODIFIED)
+        resp = self.app.get('/data', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        server.data_load({"name": "rex", "category": "dog", "available": True})
+        resp = self.app.get('/data', query_string='category=dog',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+
+    def test_update_data_if_match(self):
+        """ Update a Data only while it has not changed """
+        etag = self.app.get('/data/2').headers['ETag']
+        new_kitty = json.dumps({'name': 'kitty', 'category': 'tabby', 'available': True})
+        resp = self.app.put('/data/2', data=new_kitty, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.put('/data/2', data=new_kitty, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put('/data/2/purchase', content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete('/data/2', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_412_PRECONDITION_FAILED)
+
     def test_create_data(self):
         """ Create a new Data """
         # save the current number of Data for later comparrison
@@ -108,6 +261,83 @@ class TestDataServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['category'], 'tabby')
 
+    def test_get_data_cached(self):
+        """ Get a Data through the cache and see updates invalidate it """
+        server.Data.init_cache(10, 60)
+        self.app.get('/data/2')
+        self.app.get('/data/2')
+        new_kitty = {'name': 'kitty', 'category': 'tabby', 'available': True}
+        resp = self.app.put('/data/2', data=json.dumps(new_kitty), content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/data/2')
+        self.assertEqual(json.loads(resp.data)['category'], 'tabby')
+        resp = self.app.get('/cache')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        stats = json.loads(resp.data)
+        self.assertEqual(stats['hits'], 2)    # the second GET and the PUT
+        self.assertEqual(stats['misses'], 2)
+        self.assertTrue(stats['invalidations'] >= 1)
+
+    def test_create_data_write_behind(self):
+        """ Create Data through the write-behind queue """
+        self.addCleanup(server.Data.init_write_behind)
+        server.Data.init_write_behind(10, 5, 20)
+        ids = []
+        for name in ('sammy', 'nemo', 'polly'):
+            new_data = {'name': name, 'category': 'pet', 'available': True}
+            resp = self.app.post('/data', data=json.dumps(new_data),
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_201_CREATED)
+            ids.append(json.loads(resp.data)['id'])
+        resp = self.app.get('/data/{}'.format(ids[-1]))
+        self.assertEqual(json.loads(resp.data)['name'], 'polly')
+        server.Data.flush()
+        self.assertEqual(server.Data.write_behind.stats()['written'], 3)
+        self.assertEqual(self.get_data_count(), 5)
+        resp = self.app.get('/data', query_string='category=pet')
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+    def test_get_data_write_behind_etag(self):
+        """ Get a Data whose update is still queued by write-behind """
+        resp = self.app.get('/data/2')
+        etag = resp.headers['ETag']
+        release = threading.Event()
+        queue = WriteBehind(lambda datas: release.wait() and server.Data.save_many(datas),
+                            max_size=10, batch_size=10, interval=0)
+        self.addCleanup(queue.close)
+        self.addCleanup(release.set)
+        self.addCleanup(setattr, server.Data, 'write_behind', server.Data.write_behind)
+        server.Data.write_behind = queue
+        new_kitty = {'name': 'tom', 'category': 'cat', 'available': True}
+        resp = self.app.put('/data/2', data=json.dumps(new_kitty), content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/data/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['name'], 'tom')
+        self.assertNotIn('ETag', resp.headers)
+        release.set()
+        queue.drain()
+        resp = self.app.get('/data/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_create_data_write_behind_full(self):
+        """ Refuse to create Data while the write-behind queue is full """
+        release = threading.Event()
+        queue = WriteBehind(lambda datas: release.wait(), max_size=1, batch_size=1,
+                            interval=0, timeout=0.5)
+        self.addCleanup(queue.close)
+        self.addCleanup(release.set)
+        self.addCleanup(setattr, server.Data, 'write_behind', server.Data.write_behind)
+        server.Data.write_behind = queue
+        new_data = json.dumps({'name': 'sammy', 'category': 'snake', 'available': True})
+        for _ in range(2):  # one being written and one queued
+            resp = self.app.post('/data', data=new_data, content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_201_CREATED)
+        resp = self.app.post('/data', data=new_data, content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn('Retry-After', resp.headers)
+
     def test_update_data_with_no_name(self):
         """ Update a Data without assigning a name """
         new_data = {'category': 'dog'}
@@ -140,6 +370,16 @@ class TestDataServer(unittest.TestCase):
         resp = self.app.post('/data', data=data, content_type='application/json')
         self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
 
+    def test_create_data_with_bad_types(self):
+        """ Create a Data whose fields have the wrong types """
+        for new_data in ({'name': 123, 'category': 'dog', 'available': True},
+                         {'name': 'fido', 'category': ['dog'], 'available': True},
+                         {'name': 'fido', 'category': 'dog', 'available': 'yes'}):
+            resp = self.app.post('/data', data=json.dumps(new_data),
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_data_count(), 2)
+
     def test_create_data_no_content_type(self):
         """ Create a Data with no Content-Type """
         new_data = {'category': 'dog'}
@@ -164,12 +404,372 @@ class TestDataServer(unittest.TestCase):
         resp = self.app.get('/data', query_string='category=dog')
         self.assertEqual(resp.status_code, HTTP_200_OK)
         self.assertTrue(len(resp.data) > 0)
-        self.assertIn('fido', resp.data)
-        self.assertNotIn('kitty', resp.data)
+        self.assertIn(b'fido', resp.data)
+        self.assertNotIn(b'kitty', resp.data)
         data = json.loads(resp.data)
         query_item = data[0]
         self.assertEqual(query_item['category'], 'dog')
 
+    def test_query_data_by_name(self):
+        """ Query Data by name is case insensitive """
+        resp = self.app.get('/data', query_string='name=KITTY')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['name'], 'kitty')
+
+    def test_query_data_by_availability(self):
+        """ Query Data by availability follows purchases """
+        resp = self.app.put('/data/2/purchase', content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/data', query_string='available=true')
+        data = json.loads(resp.data)
+        self.assertEqual([item['name'] for item in data], ['fido'])
+        resp = self.app.get('/data', query_string='available=false')
+        data = json.loads(resp.data)
+        self.assertEqual([item['name'] for item in data], ['kitty'])
+
+    def test_query_data_combined(self):
+        """ Query Data by category and availability together """
+        server.Data(0, 'rex', 'dog', False).save()
+        resp = self.app.get('/data', query_string='category=dog&available=true')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['fido'])
+        resp = self.app.get('/data', query_string='category=dog&available=false&name=REX')
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['rex'])
+        resp = self.app.get('/data', query_string='category=cat&available=false')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_query_data_sorted(self):
+        """ Query Data sorted by an attribute """
+        server.data_load({"name": "Bella", "category": "dog", "available": True})
+        resp = self.app.get('/data', query_string='category=dog&sort=name')
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['Bella', 'fido'])
+        resp = self.app.get('/data', query_string='sort=-id')
+        self.assertEqual([item['id'] for item in json.loads(resp.data)], [3, 2, 1])
+        server.Data(0, 'rex', None).save()
+        resp = self.app.get('/data', query_string='sort=category')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual([item['category'] for item in json.loads(resp.data)],
+                         [None, 'cat', 'dog', 'dog'])
+        resp = self.app.get('/data', query_string='sort=-category')
+        self.assertEqual(json.loads(resp.data)[-1]['category'], None)
+        resp = self.app.get('/data', query_string='sort=color')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_query_index_follows_update(self):
+        """ Query Data by category after the category changed """
+        new_kitty = {'name': 'kitty', 'category': 'tabby', 'available': True}
+        resp = self.app.put('/data/2', data=json.dumps(new_kitty), content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/data', query_string='category=cat')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/data', query_string='category=tabby')
+        self.assertEqual(len(json.loads(resp.data)), 1)
+
+    def test_search_data(self):
+        """ Search Data by the prefixes of the words of name and category """
+        server.data_load({"name": "Dogbert the Wise", "category": "cat", "available": True})
+        resp = self.app.get('/data/search', query_string='q=Do')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        # a match in the name ranks above a match in the category
+        self.assertEqual([item['name'] for item in json.loads(resp.data)],
+                         ['Dogbert the Wise', 'fido'])
+        self.assertEqual(resp.headers['X-Total-Count'], '2')
+        resp = self.app.get('/data/search', query_string='q=cat+wi')
+        self.assertEqual([item['id'] for item in json.loads(resp.data)], [3])
+        resp = self.app.get('/data/search', query_string='q=cat')
+        # an exact word ranks above a prefix and ties are ordered by id
+        self.assertEqual([item['id'] for item in json.loads(resp.data)], [2, 3])
+
+    def test_search_data_pages(self):
+        """ Search Data a page at a time """
+        server.data_load({"name": "dingo", "category": "dog", "available": True})
+        resp = self.app.get('/data/search', query_string='q=d&limit=1')
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['dingo'])
+        self.assertIn('offset=1', resp.headers['Link'])
+        resp = self.app.get('/data/search', query_string='q=d&limit=1&offset=1')
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['fido'])
+        self.assertNotIn('Link', resp.headers)
+        resp = self.app.get('/data/search', query_string='q=+')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/data/search', query_string='q=fido&offset=-1')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_search_follows_update_and_delete(self):
+        """ Search Data after it was renamed and deleted """
+        new_kitty = {'name': 'tom', 'category': 'cat', 'available': True}
+        resp = self.app.put('/data/2', data=json.dumps(new_kitty), content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/data/search', query_string='q=kit')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/data/search', query_string='q=to')
+        self.assertEqual([item['id'] for item in json.loads(resp.data)], [2])
+        resp = self.app.delete('/data/2', content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_204_NO_CONTENT)
+        resp = self.app.get('/data/search', query_string='q=to')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_data_stats(self):
+        """ Count Data by category and availability as it changes """
+        resp = self.app.get('/data/stats')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {
+            'total': 2, 'available': 2,
+            'categories': {'dog': {'total': 1, 'available': 1},
+                           'cat': {'total': 1, 'available': 1}}})
+        server.data_load({"name": "rex", "category": "dog"})
+        resp = self.app.put('/data/1/purchase', content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        new_kitty = {'name': 'kitty', 'category': 'tabby', 'available': False}
+        resp = self.app.put('/data/2', data=json.dumps(new_kitty), content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.delete('/data/3', content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_204_NO_CONTENT)
+        resp = self.app.get('/data/stats')
+        self.assertEqual(json.loads(resp.data), {
+            'total': 2, 'available': 0,
+            'categories': {'dog': {'total': 1, 'available': 0},
+                           'tabby': {'total': 1, 'available': 0}}})
+        server.Data.redis.delete(server.Data._key('idx', 'stats'))
+        server.Data.rebuild_indexes()
+        resp = self.app.get('/data/stats')
+        self.assertEqual(json.loads(resp.data)['categories']['dog'], {'total': 1, 'available': 0})
+
+    def test_change_feed(self):
+        """ Read the changes made to the Data after an event """
+        resp = self.app.get('/data/changes')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        events = json.loads(resp.data)
+        self.assertEqual([(event['op'], event.get('id')) for event in events],
+                         [('reset', None), ('create', 1), ('create', 2)])
+        self.assertEqual(resp.headers['X-Last-Event-ID'], events[-1]['event'])
+        since = events[-1]['event']
+        new_kitty = {'name': 'kitty', 'category': 'cat', 'available': True}
+        self.app.put('/data/2', data=json.dumps(new_kitty), content_type='application/json')
+        self.app.put('/data/1/purchase', content_type='application/json')
+        self.app.delete('/data/2', content_type='application/json')
+        resp = self.app.get('/data/changes', query_string='since={}&limit=2'.format(since))
+        events = json.loads(resp.data)
+        self.assertEqual([(event['op'], event['id']) for event in events],
+                         [('update', 2), ('purchase', 1)])
+        self.assertIn('since=', resp.headers['Link'])
+        resp = self.app.get('/data/changes', headers={'Last-Event-ID': events[-1]['event']})
+        self.assertEqual([event['op'] for event in json.loads(resp.data)], ['delete'])
+        resp = self.app.get('/data/changes', query_string='since=yesterday')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_change_feed_expired(self):
+        """ Read changes from before the oldest event kept """
+        length = server.Data.changes_length
+        server.Data.changes_length = 3
+        try:
+            resp = self.app.get('/data/changes', query_string='since=1-0')
+            self.assertEqual(resp.status_code, HTTP_410_GONE)
+        finally:
+            server.Data.changes_length = length
+
+    def test_change_feed_stream(self):
+        """ Stream the changes as server-sent events """
+        resp = self.app.get('/data/changes', query_string='since=0',
+                            headers={'Accept': 'text/event-stream'})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        chunk = next(iter(resp.response))
+        self.assertTrue(chunk.startswith(b'id: '))
+        self.assertIn(b'event: reset', chunk)
+        resp.close()
+
+    def test_rate_limit(self):
+        """ Refuse a client over the rate limit of an endpoint """
+        self.admission.limits['get_data'] = (1, 2)
+        try:
+            # the buckets only fill when the frozen clock moves on
+            with mock.patch.object(self.admission, 'clock', return_value=1000.0) as clock:
+                for _ in range(2):
+                    resp = self.app.get('/data/1')
+                    self.assertEqual(resp.status_code, HTTP_200_OK)
+                resp = self.app.get('/data/1')
+                self.assertEqual(resp.status_code, HTTP_429_TOO_MANY_REQUESTS)
+                self.assertEqual(resp.headers['Retry-After'], '1')
+                # every endpoint has a bucket of its own
+                resp = self.app.get('/data')
+                self.assertEqual(resp.status_code, HTTP_200_OK)
+                self.assertEqual(self.admission.stats()['limited'], {'get_data': 1})
+                clock.return_value = 1001.0
+                resp = self.app.get('/data/1')
+                self.assertEqual(resp.status_code, HTTP_200_OK)
+                resp = self.app.get('/data/1')
+                self.assertEqual(resp.status_code, HTTP_429_TOO_MANY_REQUESTS)
+        finally:
+            del self.admission.limits['get_data']
+
+    def test_concurrency_cap(self):
+        """ Shed requests over the concurrency cap """
+        self.admission.max_concurrent = 1
+        self.admission.enter()      # a request already being served
+        try:
+            resp = self.app.get('/data/1')
+            self.assertEqual(resp.status_code, HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+        finally:
+            self.admission.leave()
+            self.admission.max_concurrent = 0
+        resp = self.app.get('/data/1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(self.admission.stats()['shed'], 1)
+
+    def test_concurrency_cap_skips_streams(self):
+        """ Admit streams of changes over the concurrency cap """
+        self.admission.max_concurrent = 1
+        self.admission.enter()
+        try:
+            # the view runs and turns the bad id down instead of the cap
+            resp = self.app.get('/data/changes', query_string='since=bad',
+                                headers={'Accept': 'text/event-stream'})
+            self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+            resp = self.app.get('/data/changes', query_string='since=bad')
+            self.assertEqual(resp.status_code, HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            self.admission.leave()
+            self.admission.max_concurrent = 0
+        self.assertEqual(self.admission.stats()['in_flight'], 0)
+
+    def test_rebuild_indexes(self):
+        """ Rebuild the secondary indexes from the stored Data """
+        server.Data.redis.delete(server.Data._index_key('category', 'dog'))
+        self.assertEqual(server.Data.rebuild_indexes(), 2)
+        resp = self.app.get('/data', query_string='category=dog')
+        self.assertEqual(len(json.loads(resp.data)), 1)
+        stats = json.loads(self.app.get('/data/stats').data)
+        # one Data per batch
+        self.assertEqual(server.Data.rebuild_indexes(batch_size=1), 2)
+        self.assertEqual(json.loads(self.app.get('/data/stats').data), stats)
+        resp = self.app.get('/data', query_string='available=true')
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_reset_keeps_other_keys(self):
+        """ Reset only removes the keys under the key prefix """
+        if not server.Data.key_prefix:
+            self.skipTest('the bare key layout has no prefix to keep other keys out')
+        server.Data.redis.set('other:1', 'kept')
+        self.assertTrue(server.Data.redis.exists(server.Data._key(1)))
+        server.data_reset()
+        self.assertEqual(self.get_data_count(), 0)
+        self.assertFalse(server.Data.redis.exists(server.Data._key(1)))
+        self.assertEqual(server.Data.redis.get('other:1'), b'kept')
+        server.Data.redis.delete('other:1')
+
+    def test_reset_keeps_etags_unique(self):
+        """ Never send an ETag again for other content after a reset """
+        resp = self.app.get('/data/1')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/data')
+        list_etag = resp.headers['ETag']
+        resp = self.app.delete('/data/1', content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_204_NO_CONTENT)
+        server.data_reset()
+        resp = self.app.get('/data/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+        server.data_load({"name": "rex", "category": "dog", "available": True})
+        resp = self.app.get('/data/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['name'], 'rex')
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.get('/data', headers={'If-None-Match': list_etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+
+    def test_create_data_bulk(self):
+        """ Create many Data in one request """
+        new_data = [{'name': 'sammy', 'category': 'snake', 'available': True},
+                    {'category': 'dog'},
+                    {'name': 'nemo', 'category': 'fish', 'available': True}]
+        resp = self.app.post('/data/_bulk', data=json.dumps(new_data),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        results = json.loads(resp.data)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_201_CREATED])
+        self.assertEqual(results[2]['id'], results[0]['id'] + 1)
+        self.assertEqual(self.get_data_count(), 4)
+        resp = self.app.get('/data', query_string='category=fish')
+        self.assertEqual(json.loads(resp.data)[0]['name'], 'nemo')
+
+    def test_update_data_bulk(self):
+        """ Update many Data in one request """
+        updates = [{'id': 1, 'name': 'fido', 'category': 'hound', 'available': False},
+                   {'id': 7, 'name': 'ghost', 'category': 'dog', 'available': True},
+                   {'name': 'noid', 'category': 'dog', 'available': True}]
+        resp = self.app.put('/data/_bulk', data=json.dumps(updates),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        results = json.loads(resp.data)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_400_BAD_REQUEST])
+        resp = self.app.get('/data/1')
+        self.assertEqual(json.loads(resp.data)['category'], 'hound')
+        resp = self.app.get('/data', query_string='category=dog')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_bulk_reports_invalid_items(self):
+        """ Create and update many Data where some have no name """
+        new_data = [{'name': 'sammy', 'category': 'snake', 'available': True},
+                    {'name': None, 'category': 'dog', 'available': True}]
+        resp = self.app.post('/data/_bulk', data=json.dumps(new_data),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        results = json.loads(resp.data)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [HTTP_201_CREATED, HTTP_400_BAD_REQUEST])
+        self.assertIn('name', results[1]['error'])
+        updates = [{'id': 1, 'name': None, 'category': 'dog', 'available': True},
+                   {'id': 2, 'name': 'tom', 'category': 'cat', 'available': True}]
+        resp = self.app.put('/data/_bulk', data=json.dumps(updates),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        results = json.loads(resp.data)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [HTTP_400_BAD_REQUEST, HTTP_200_OK])
+        resp = self.app.get('/data/1')
+        self.assertEqual(json.loads(resp.data)['name'], 'fido')
+        self.assertEqual(self.get_data_count(), 3)
+
+    def test_delete_data_bulk(self):
+        """ Delete many Data in one request """
+        resp = self.app.delete('/data/_bulk', data=json.dumps([1, 2, 'x']),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        results = json.loads(resp.data)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [HTTP_204_NO_CONTENT, HTTP_204_NO_CONTENT, HTTP_400_BAD_REQUEST])
+        self.assertEqual(self.get_data_count(), 0)
+
+    def test_bulk_duplicate_ids(self):
+        """ Keep the stats right when a bulk request names an id twice """
+        updates = [{'id': 1, 'name': 'fido', 'category': 'hound', 'available': True},
+                   {'id': 1, 'name': 'fido', 'category': 'wolf', 'available': False}]
+        resp = self.app.put('/data/_bulk', data=json.dumps(updates),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/data/stats')
+        self.assertEqual(json.loads(resp.data), {
+            'total': 2, 'available': 1,
+            'categories': {'wolf': {'total': 1, 'available': 0},
+                           'cat': {'total': 1, 'available': 1}}})
+        resp = self.app.delete('/data/_bulk', data=json.dumps([2, 2]),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/data/stats')
+        self.assertEqual(json.loads(resp.data), {
+            'total': 1, 'available': 0,
+            'categories': {'wolf': {'total': 1, 'available': 0}}})
+
+    def test_bulk_needs_a_list(self):
+        """ Call a bulk endpoint without a list """
+        resp = self.app.post('/data/_bulk', data=json.dumps({'name': 'sammy'}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
     def test_purchase_a_data(self):
         """ Purchase a Data """
         resp = self.app.put('/data/2/purchase', content_type='application/json')
@@ -179,15 +779,84 @@ class TestDataServer(unittest.TestCase):
         data_data = json.loads(resp.data)
         self.assertEqual(data_data['available'], False)
 
+    def test_purchase_data_without_category(self):
+        """ Purchase a Data that has no category """
+        data = server.Data(0, 'rex', None)
+        data.save()
+        resp = self.app.put('/data/{}/purchase'.format(data.id), content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['available'], False)
+        resp = self.app.get('/data/stats')
+        stats = json.loads(resp.data)
+        self.assertEqual(stats['available'], 2)
+        self.assertEqual(stats['categories']['None'], {'total': 1, 'available': 0})
+
     def test_purchase_not_available(self):
         """ Purchase a data that is not available """
         resp = self.app.put('/data/2/purchase', content_type='application/json')
         self.assertEqual(resp.status_code, HTTP_200_OK)
         resp = self.app.put('/data/2/purchase', content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.status_code, HTTP_409_CONFLICT)
         resp_json = json.loads(resp.get_data())
         self.assertIn('not available', resp_json['message'])
 
+    def test_purchase_data_not_found(self):
+        """ Purchase a Data that doesn't exist """
+        resp = self.app.put('/data/0/purchase', content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+
+    @mock.patch('requests.Session.request')
+    def test_call_function(self, upstream):
+        """ Call a cloud function through the proxy """
+        upstream.return_value = mock.Mock(status_code=200, text='{"greeting": "Hello fido"}')
+        function = {'url': 'https://functions.example.com/hello', 'name': 'fido',
+                    'api_key': 'user:pass'}
+        resp = self.app.post('/functions', data=json.dumps(function),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertIn('Hello fido', json.loads(resp.data)['message'])
+        kwargs = upstream.call_args[1]
+        self.assertEqual(kwargs['headers']['Authorization'], 'Basic dXNlcjpwYXNz')
+        self.assertEqual(len(kwargs['timeout']), 2)
+        resp = self.app.get('/functions/stats')
+        stats = json.loads(resp.data)['hosts']['functions.example.com']
+        self.assertEqual(stats['circuit'], 'closed')
+        self.assertEqual(stats['latency']['count'], 1)
+
+    @mock.patch('requests.Session.request')
+    def test_call_function_circuit_breaker(self, upstream):
+        """ Stop calling a cloud function that keeps failing """
+        upstream.side_effect = requests.exceptions.ConnectionError('refused')
+        function = json.dumps({'url': 'https://down.example.com/hello', 'name': 'fido',
+                               'api_key': 'user:pass'})
+        for _ in range(5):
+            resp = self.app.post('/functions', data=function, content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_502_BAD_GATEWAY)
+        resp = self.app.post('/functions', data=function, content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn('Retry-After', resp.headers)
+        self.assertEqual(upstream.call_count, 5)
+
+    @mock.patch('requests.Session.request')
+    def test_call_function_many_hosts(self, upstream):
+        """ Report the hosts past the cap as one """
+        upstream.return_value = mock.Mock(status_code=200, text='{}')
+        self.proxy.max_hosts = 2
+        try:
+            for host in range(4):
+                function = {'url': 'https://fn{}.example.com/hello'.format(host),
+                            'name': 'fido', 'api_key': 'user:pass'}
+                resp = self.app.post('/functions', data=json.dumps(function),
+                                     content_type='application/json')
+                self.assertEqual(resp.status_code, HTTP_200_OK)
+        finally:
+            self.proxy.max_hosts = 100
+        resp = self.app.get('/functions/stats')
+        hosts = json.loads(resp.data)['hosts']
+        self.assertEqual(sorted(hosts), ['fn0.example.com', 'fn1.example.com', 'other'])
+        self.assertEqual(hosts['other']['latency']['count'], 2)
+        self.assertEqual(hosts['other']['circuit'], 'closed')
+
 
 ######################################################################
 # Utility functions
@@ -201,6 +870,12 @@ class TestDataServer(unittest.TestCase):
         return len(data)
 
 
+class TestDataServerHashCodec(TestDataServer):
+    """ Data Service tests with the Datas stored as hashes """
+
+    codec = 'hash'
+
+
 ######################################################################
 #   M A I N
 ######################################################################
@@ -0,0 +1,142 @@
+"""
+Chain Validation Benchmark
+
+Builds a long chain at the lowest difficulty, so that mining it is quick,
+and times the consensus checks on it: the full validation as it was before
+block hashes were cached, printing every block (to os.devnull), the full
+valid_chain, and replace_chain with a longer chain from a peer that either
+extends ours or forks from it some blocks back. The peer chain goes through
+JSON like a /chain response does.
+
+Run it from the blockchain directory with:
+python benchmarks/bench_chain.py --blocks 100000
+"""
+
+import os
+import sys
+import json
+import contextlib
+from time import perf_counter
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from blockchain import Blockchain  # noqa: E402
+
+
+def new_node():
+    """
+    A node mining at one zero bit that never retargets
+    """
+
+    return Blockchain(difficulty=1, retarget_interval=sys.maxsize)
+
+
+def mine(blockchain, blocks):
+    """
+    Adds blocks holding a reward transaction each the way /mine does
+    """
+
+    for _ in range(blocks):
+        last_block = blockchain.last_block
+        proof = blockchain.proof_of_work(last_block)
+        blockchain.new_transaction(sender="0", recipient='benchmark', amount=1)
+        blockchain.new_block(proof, blockchain.block_hash(last_block))
+
+
+def peer_of(blockchain, shared, blocks):
+    """
+    Returns the chain of a peer that shares the first blocks of ours and mined more
+
+    :param shared: <int> Blocks of our chain the peer has
+    :param blocks: <int> Blocks the peer mined on top of them
+    """
+
+    peer = new_node()
+    peer.chain = json.loads(json.dumps(blockchain.chain[:shared]))
+    peer.hashes = blockchain.hashes[:shared]
+    mine(peer, blocks)
+    return json.loads(json.dumps(peer.chain))
+
+
+def reference_valid_chain(blockchain, chain):
+    """
+    valid_chain before block hashes were cached
+    """
+
+    last_block = chain[0]
+    current_index = 1
+
+    while current_index < len(chain):
+        block = chain[current_index]
+        print(f'{last_block}')
+        print(f'{block}')
+        print("\n-----------\n")
+        last_block_hash = blockchain.hash(last_block)
+        if block['previous_hash'] != last_block_hash:
+            return False
+
+        difficulty = blockchain.next_difficulty(chain, current_index)
+        if block.get('difficulty') != difficulty:
+            return False
+
+        if not blockchain.valid_proof(last_block['proof'], block['proof'], last_block_hash,
+                                      difficulty):
+            return False
+
+        last_block = block
+        current_index += 1
+
+    return True
+
+
+def timed(function, *args):
+    started = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - started
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the validation of long chains')
+    parser.add_argument('-b', '--blocks', type=int, default=100000, help='blocks in our chain')
+    parser.add_argument('-f', '--fork', type=int, default=100,
+                        help='blocks back from our tip the forked peer chain leaves ours')
+    parser.add_argument('-n', '--new-blocks', type=int, default=10,
+                        help='blocks the peer chain has beyond our tip')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    ours = new_node()
+    _, build = timed(mine, ours, args.blocks - 1)
+    length = len(ours.chain)
+    extending = peer_of(ours, length, args.new_blocks)
+    forked = peer_of(ours, length - args.fork, args.fork + args.new_blocks)
+    results = []
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        valid, elapsed = timed(reference_valid_chain, ours, extending)
+    assert valid
+    results.append({'check': 'full validation, printing', 'seconds': elapsed})
+
+    valid, elapsed = timed(ours.valid_chain, extending)
+    assert valid
+    results.append({'check': 'full validation', 'seconds': elapsed})
+
+    for name, chain in (('extending peer', extending), ('forked peer', forked)):
+        node = new_node()
+        node.chain, node.hashes = list(ours.chain), list(ours.hashes)
+        replaced, elapsed = timed(node.replace_chain, chain)
+        assert replaced and node.hashes == [node.hash(block) for block in chain]
+        results.append({'check': f'replace_chain, {name}', 'seconds': elapsed})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{length} blocks mined in {build:.1f}s, peers have {args.new_blocks} more, '
+          f'the forked one from {args.fork} back')
+    print(f'{"check":<32} {"seconds":>10}')
+    for result in results:
+        print(f'{result["check"]:<32} {result["seconds"]:>10.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Proof of Work Benchmark
+
+Mines the same sequence of blocks with the original per nonce check, the
+sequential search and a ParallelMiner of each size, checks that every miner
+finds the same proofs and reports hashes per second against the number of
+cores. The hashes counted are the nonces the sequential search tries, so
+the parallel work thrown away after the answer is found does not count.
+
+Run it from the blockchain directory with:
+python benchmarks/bench_miner.py --blocks 20 --workers 1,2,4,8
+"""
+
+import os
+import sys
+import json
+import hashlib
+import multiprocessing
+from time import perf_counter
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from miner import CHUNK_SIZE, ParallelMiner, search  # noqa: E402
+
+
+def mine_blocks(proof_of_work, blocks):
+    """
+    Mines blocks on top of each other the way /mine does
+
+    :param proof_of_work: <callable> Takes the last proof and hash, returns the proof
+    :param blocks: <int> Number of blocks
+    :return: <list> The proofs and the seconds taken
+    """
+
+    last_proof, last_hash = 100, hashlib.sha256(b'genesis').hexdigest()
+    proofs = []
+    started = perf_counter()
+    for _ in range(blocks):
+        proof = proof_of_work(last_proof, last_hash)
+        proofs.append(proof)
+        last_hash = hashlib.sha256(f'{last_proof}{proof}{last_hash}'.encode()).hexdigest()
+        last_proof = proof
+    return proofs, perf_counter() - started
+
+
+def reference(last_proof, last_hash):
+    """
+    The search before the mining kernel: one f-string and hex digest per nonce
+    """
+
+    proof = 0
+    while hashlib.sha256(f'{last_proof}{proof}{last_hash}'.encode()).hexdigest()[:4] != "0000":
+        proof += 1
+    return proof
+
+
+def sequential(last_proof, last_hash):
+    """
+    The search of Blockchain.proof_of_work without a miner
+    """
+
+    return search(last_proof, last_hash, 0, sys.maxsize)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the parallel proof of work')
+    parser.add_argument('-b', '--blocks', type=int, default=20, help='blocks to mine')
+    parser.add_argument('-w', '--workers', default=None,
+                        help='comma separated pool sizes, powers of two up to the cores by default')
+    parser.add_argument('-c', '--chunk-size', type=int, default=CHUNK_SIZE, help='nonces per task')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    if args.workers:
+        sizes = [int(size) for size in args.workers.split(',')]
+    else:
+        cores = multiprocessing.cpu_count()
+        sizes = sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+
+    expected, elapsed = mine_blocks(reference, args.blocks)
+    hashes = sum(proof + 1 for proof in expected)
+    results = [{'miner': 'reference', 'workers': 1, 'seconds': elapsed,
+                'hashes_per_second': hashes / elapsed}]
+
+    proofs, elapsed = mine_blocks(sequential, args.blocks)
+    assert proofs == expected, 'the mining kernel found other proofs'
+    results.append({'miner': 'sequential', 'workers': 1, 'seconds': elapsed,
+                    'hashes_per_second': hashes / elapsed})
+
+    for size in sizes:
+        miner = ParallelMiner(size, args.chunk_size)
+        try:
+            miner.proof_of_work(100, '')    # start the worker processes
+            proofs, elapsed = mine_blocks(miner.proof_of_work, args.blocks)
+        finally:
+            miner.close()
+        assert proofs == expected, 'the parallel miner found other proofs'
+        results.append({'miner': 'parallel', 'workers': size, 'seconds': elapsed,
+                        'hashes_per_second': hashes / elapsed})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.blocks} blocks, {hashes} hashes')
+    print(f'{"miner":<12} {"workers":>8} {"seconds":>10} {"hashes/s":>12} {"speedup":>8}')
+    for result in results:
+        speedup = result['hashes_per_second'] / results[0]['hashes_per_second']
+        print(f'{result["miner"]:<12} {result["workers"]:>8} {result["seconds"]:>10.2f} '
+              f'{result["hashes_per_second"]:>12.0f} {speedup:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,69 @@
 import hashlib
 import json
+import logging
+import math
+import sys
+import threading
+from collections import OrderedDict, deque
 from time import time
 from urllib.parse import urlparse
 from uuid import uuid4
 
 import requests
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, url_for
+
+import miner
+from miner import DIFFICULTY_BITS, ParallelMiner
+
+# Seconds the retargeting aims to keep between blocks
+TARGET_BLOCK_TIME = 10
+
+# Blocks between two changes of difficulty
+RETARGET_INTERVAL = 10
+
+# Most leading zero bits a retarget adds or removes, each bit doubles the work
+MAX_RETARGET_BITS = 2
+
+# Range of the difficulty of a block, in leading zero bits of its SHA-256 hash
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 255
+
+# Seconds a block may be dated ahead of our clock
+MAX_FUTURE_DRIFT = 2 * 60 * 60
+
+# Finished mining jobs kept for their status
+MAX_JOBS = 100
+
+# Mining jobs waiting for the mining thread, /mine turns down more
+MAX_QUEUED_JOBS = 10
+
+logger = logging.getLogger(__name__)
 
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, miner=None, difficulty=DIFFICULTY_BITS,
+                 target_block_time=TARGET_BLOCK_TIME, retarget_interval=RETARGET_INTERVAL):
         self.current_transactions = []
         self.chain = []
         self.nodes = set()
 
+        # The hash of every block of the chain, computed once when it is added
+        self.hashes = []
+
+        # Held while the chain or the transactions change, the mining worker runs beside requests
+        self.lock = threading.RLock()
+
+        # Searches proofs with several cores when set, see miner.py
+        self.miner = miner
+
+        # Every node of the network must use the same difficulty settings
+        self.difficulty = difficulty
+        self.target_block_time = target_block_time
+        self.retarget_interval = retarget_interval
+
+        # Hashes per second of the last proof of work
+        self.hash_rate = 0.0
+
         # Create the genesis block
         self.new_block(previous_hash='1', proof=100)
 
@@ -42,61 +92,183 @@ class Blockchain:
         :return: True if valid, False if not
         """
 
-        last_block = chain[0]
-        current_index = 1
+        if chain[0].get('difficulty', DIFFICULTY_BITS) != self.difficulty:
+            return False
+
+        return self.verify_blocks(chain, 1, self.hash(chain[0])) is not None
+
+    def verify_blocks(self, chain, start, last_block_hash):
+        """
+        Checks the blocks of a chain from an index on, the blocks before it are trusted
+
+        :param chain: A blockchain
+        :param start: <int> Index of the first block to check
+        :param last_block_hash: <str> The hash of the block before it
+        :return: <list> The hashes of the blocks checked, None if one is invalid
+        """
+
+        debug = logger.isEnabledFor(logging.DEBUG)
+        latest = time() + MAX_FUTURE_DRIFT
+        last_block = chain[start - 1]
+        hashes = []
 
-        while current_index < len(chain):
+        for current_index in range(start, len(chain)):
             block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-----------\n")
+            if debug:
+                logger.debug('Checking block %s after %s', block, last_block)
+
             # Check that the hash of the block is correct
-            last_block_hash = self.hash(last_block)
             if block['previous_hash'] != last_block_hash:
-                return False
+                return None
+
+            # Check that time goes forward, the difficulty is retargeted on the timestamps
+            if not last_block['timestamp'] <= block['timestamp'] <= latest:
+                return None
+
+            # Check that the block was mined at the difficulty the chain before it sets
+            difficulty = self.next_difficulty(chain, current_index)
+            if block.get('difficulty', DIFFICULTY_BITS) != difficulty:
+                return None
 
             # Check that the Proof of Work is correct
-            if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash):
-                return False
+            if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash,
+                                    difficulty):
+                return None
 
             last_block = block
-            current_index += 1
+            last_block_hash = self.hash(block)
+            hashes.append(last_block_hash)
+
+        return hashes
+
+    @staticmethod
+    def fork_point(chain, hashes):
+        """
+        Count the leading blocks a chain shares with ours
+
+        Every block holds the hash of the block before it, so the chains
+        share the blocks up to the last one whose previous_hash is one of our
+        hashes. It is found by bisection, the usual longer chain that extends
+        ours with one look. No block follows the last block of the chain, so
+        that one is hashed.
+
+        :param chain: A blockchain
+        :param hashes: <list> The hashes of the blocks of our chain
+        :return: <int> Number of blocks shared, 0 if the genesis blocks differ
+        """
+
+        def shared(length):
+            if length == len(chain):
+                return Blockchain.hash(chain[-1]) == hashes[length - 1]
+            return chain[length]['previous_hash'] == hashes[length - 1]
+
+        low, high = 0, min(len(hashes), len(chain))
+        if high > 0 and shared(high):
+            return high
+
+        while low < high:
+            middle = (low + high + 1) // 2
+            if shared(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    @staticmethod
+    def chain_work(chain):
+        """
+        Hashes it took on average to mine a chain
 
+        Each valid proof takes 2 ** difficulty hashes, so a short chain of
+        hard blocks can hold more work than a long chain of easy ones.
+
+        :param chain: A blockchain
+        :return: <int>
+        """
+
+        return sum(2 ** block.get('difficulty', DIFFICULTY_BITS) for block in chain)
+
+    @staticmethod
+    def valid_difficulties(chain):
+        """
+        Check that every block of a chain states a difficulty we can weigh
+
+        Peers send any JSON, a difficulty that is a float, a string or a huge
+        number would make chain_work raise or take forever.
+
+        :param chain: A blockchain
+        :return: True if every difficulty is an int within the retarget range
+        """
+
+        for block in chain:
+            difficulty = block.get('difficulty', DIFFICULTY_BITS)
+            if type(difficulty) is not int or not MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY:
+                return False
+        return True
+
+    def replace_chain(self, chain):
+        """
+        Replace our chain with one that holds more work if it is valid
+
+        Only the blocks after the fork point are checked, the ones before
+        it are taken from our chain along with their hashes.
+
+        :param chain: A blockchain
+        :return: True if our chain was replaced, False if not
+        """
+
+        with self.lock:
+            ours, hashes = list(self.chain), list(self.hashes)
+        if not self.valid_difficulties(chain):
+            return False
+        if self.chain_work(chain) <= self.chain_work(ours):
+            return False
+
+        fork = self.fork_point(chain, hashes)
+        if fork == 0:
+            if chain[0].get('difficulty', DIFFICULTY_BITS) != self.difficulty:
+                return False
+            new_chain, new_hashes = chain, [self.hash(chain[0])]
+            fork = 1
+        else:
+            new_chain, new_hashes = ours[:fork] + chain[fork:], hashes[:fork]
+
+        checked = self.verify_blocks(new_chain, fork, new_hashes[-1])
+        if checked is None:
+            return False
+        logger.info('Checked %d blocks of a chain of %d from the fork point',
+                    len(checked), len(new_chain))
+
+        with self.lock:
+            if self.chain_work(new_chain) <= self.chain_work(self.chain):
+                return False
+            self.chain = new_chain
+            self.hashes = new_hashes + checked
         return True
 
     def resolve_conflicts(self):
         """
         This is our consensus algorithm, it resolves conflicts
-        by replacing our chain with the longest one in the network.
+        by replacing our chain with the one in the network that holds the most work.
 
         :return: True if our chain was replaced, False if not
         """
 
         neighbours = self.nodes
-        new_chain = None
-
-        # We're only looking for chains longer than ours
-        max_length = len(self.chain)
+        replaced = False
 
         # Grab and verify the chains from all the nodes in our network
         for node in neighbours:
             response = requests.get(f'http://{node}/chain')
 
             if response.status_code == 200:
-                length = response.json()['length']
                 chain = response.json()['chain']
 
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-
-        # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            self.chain = new_chain
-            return True
+                # We're only looking for chains that took more work than ours
+                if self.replace_chain(chain):
+                    replaced = True
 
-        return False
+        return replaced
 
     def new_block(self, proof, previous_hash):
         """
@@ -107,18 +279,21 @@ class Blockchain:
         :return: New Block
         """
 
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
-
-        # Reset the current list of transactions
-        self.current_transactions = []
-
-        self.chain.append(block)
+        with self.lock:
+            block = {
+                'index': len(self.chain) + 1,
+                'timestamp': time(),
+                'transactions': self.current_transactions,
+                'proof': proof,
+                'previous_hash': previous_hash or self.hashes[-1],
+                'difficulty': self.next_difficulty(self.chain, len(self.chain)),
+            }
+
+            # Reset the current list of transactions
+            self.current_transactions = []
+
+            self.chain.append(block)
+            self.hashes.append(self.hash(block))
         return block
 
     def new_transaction(self, sender, recipient, amount):
@@ -130,18 +305,75 @@ class Blockchain:
         :param amount: Amount
         :return: The index of the Block that will hold this transaction
         """
-        self.current_transactions.append({
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-        })
+        with self.lock:
+            self.current_transactions.append({
+                'sender': sender,
+                'recipient': recipient,
+                'amount': amount,
+            })
 
-        return self.last_block['index'] + 1
+            return self.last_block['index'] + 1
 
     @property
     def last_block(self):
         return self.chain[-1]
 
+    def next_difficulty(self, chain, length):
+        """
+        Determine the difficulty of the block that follows the first blocks of a chain
+
+        Every retarget_interval blocks the difficulty moves by the number of
+        bits that brings the average time between the last blocks back to
+        target_block_time, at most MAX_RETARGET_BITS at once. In between it
+        stays that of the previous block.
+
+        :param chain: A blockchain
+        :param length: <int> Number of blocks before the new one
+        :return: <int> Leading zero bits the proof of the new block needs
+        """
+
+        if length == 0:
+            return self.difficulty
+
+        last_block = chain[length - 1]
+        difficulty = last_block.get('difficulty', DIFFICULTY_BITS)
+        if length % self.retarget_interval != 0 or length == 1:
+            return difficulty
+
+        first_index = max(0, length - 1 - self.retarget_interval)
+        expected = self.target_block_time * (length - 1 - first_index)
+        actual = max(last_block['timestamp'] - chain[first_index]['timestamp'], 1e-3)
+
+        change = round(math.log2(expected / actual))
+        change = max(-MAX_RETARGET_BITS, min(MAX_RETARGET_BITS, change))
+        return max(MIN_DIFFICULTY, min(MAX_DIFFICULTY, difficulty + change))
+
+    def block_time(self):
+        """
+        Average seconds between the blocks of the last retarget interval
+
+        :return: <float> or None while the chain has a single block
+        """
+
+        first_index = max(0, len(self.chain) - 1 - self.retarget_interval)
+        blocks = len(self.chain) - 1 - first_index
+        if blocks == 0:
+            return None
+        return (self.last_block['timestamp'] - self.chain[first_index]['timestamp']) / blocks
+
+    def block_hash(self, block):
+        """
+        Returns the hash of a Block, the cached one if it is in our chain
+
+        :param block: Block
+        """
+
+        index = block['index'] - 1
+        with self.lock:
+            if index < len(self.chain) and self.chain[index] is block:
+                return self.hashes[index]
+        return self.hash(block)
+
     @staticmethod
     def hash(block):
         """
@@ -154,41 +386,180 @@ class Blockchain:
         block_string = json.dumps(block, sort_keys=True).encode()
         return hashlib.sha256(block_string).hexdigest()
 
-    def proof_of_work(self, last_block):
+    def proof_of_work(self, last_block, abandon=None):
         """
         Simple Proof of Work Algorithm:
 
-         - Find a number p' such that hash(pp') contains leading 4 zeroes
+         - Find a number p' such that hash(pp') starts with as many zero bits as the difficulty
          - Where p is the previous proof, and p' is the new proof
          
         :param last_block: <dict> last Block
-        :return: <int>
+        :param abandon: <callable> Asked now and then, the search gives up when it returns True
+        :return: <int> or None if the search was abandoned
         """
 
         last_proof = last_block['proof']
-        last_hash = self.hash(last_block)
+        last_hash = self.block_hash(last_block)
+        difficulty = self.next_difficulty(self.chain, last_block['index'])
 
-        proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
-            proof += 1
+        started = time()
+        if self.miner is not None:
+            proof = self.miner.proof_of_work(last_proof, last_hash, difficulty, abandon)
+        else:
+            proof = miner.search(last_proof, last_hash, 0, sys.maxsize, abandon, difficulty)
 
+        # The nonces up to the proof are the work a single search does
+        if proof is not None:
+            self.hash_rate = (proof + 1) / max(time() - started, 1e-6)
         return proof
 
     @staticmethod
-    def valid_proof(last_proof, proof, last_hash):
+    def valid_proof(last_proof, proof, last_hash, difficulty=DIFFICULTY_BITS):
         """
         Validates the Proof
 
         :param last_proof: <int> Previous Proof
         :param proof: <int> Current Proof
         :param last_hash: <str> The hash of the Previous Block
+        :param difficulty: <int> Leading zero bits the hash needs
         :return: <bool> True if correct, False if not.
 
         """
 
-        guess = f'{last_proof}{proof}{last_hash}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return miner.valid_proof(last_proof, proof, last_hash, difficulty)
+
+
+class MiningWorker:
+    def __init__(self, blockchain, node_identifier, continuous=False):
+        """
+        Mines blocks on a thread of its own so that no request waits for a proof
+
+        :param blockchain: <Blockchain> The chain to mine on
+        :param node_identifier: <str> Address the mining rewards go to
+        :param continuous: <bool> Mine block after block even when no job is queued
+        """
+
+        self.blockchain = blockchain
+        self.node_identifier = node_identifier
+        self.continuous = continuous
+        self.jobs = OrderedDict()
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the mining thread unless it runs already, or again if it died
+        """
+
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='miner', daemon=True)
+                self.thread.start()
+
+    def submit(self):
+        """
+        Queues a job that mines the next block
+
+        :return: <dict> The job, or None if MAX_QUEUED_JOBS are queued already
+        """
+
+        with self.condition:
+            if len(self.queue) >= MAX_QUEUED_JOBS:
+                return None
+            job = self.new_job()
+            self.queue.append(job)
+            self.condition.notify()
+        self.start()
+        return dict(job)
+
+    def job(self, job_id):
+        """
+        Returns a copy of a job, or None if it is unknown or was forgotten
+
+        :param job_id: <str> Id of the job
+        """
+
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def new_job(self):
+        """
+        Adds a queued job and forgets the oldest finished ones beyond MAX_JOBS
+        """
+
+        job = {'id': uuid4().hex, 'status': 'queued', 'restarts': 0, 'block': None,
+               'error': None}
+        self.jobs[job['id']] = job
+        while len(self.jobs) > MAX_JOBS:
+            oldest = next(iter(self.jobs.values()))
+            if oldest['status'] not in ('done', 'failed'):
+                break
+            del self.jobs[oldest['id']]
+        return job
+
+    def run(self):
+        """
+        Mines the queued jobs one after the other
+
+        A job whose mining raises is marked failed with the error, and the
+        thread goes on with the next one.
+        """
+
+        while True:
+            with self.condition:
+                while not self.queue and not self.continuous:
+                    self.condition.wait()
+                job = self.queue.popleft() if self.queue else self.new_job()
+                job['status'] = 'mining'
+
+            try:
+                block = self.mine_block(job)
+            except Exception as error:
+                logger.exception('Mining job %s failed', job['id'])
+                with self.condition:
+                    job['status'] = 'failed'
+                    job['error'] = str(error)
+                continue
+
+            with self.condition:
+                job['status'] = 'done'
+                job['block'] = block
+
+    def mine_block(self, job):
+        """
+        Forges a block on the tip of the chain
+
+        The search starts over on the new tip whenever a block is added or
+        resolve_conflicts replaces the chain before the proof is found.
+
+        :param job: <dict> The job the block is mined for
+        :return: <dict> The new Block
+        """
+
+        blockchain = self.blockchain
+        while True:
+            last_block = blockchain.last_block
+            proof = blockchain.proof_of_work(
+                last_block, abandon=lambda: blockchain.last_block is not last_block)
+
+            with blockchain.lock:
+                if proof is not None and blockchain.last_block is last_block:
+                    # We must receive a reward for finding the proof.
+                    # The sender is "0" to signify that this node has mined a new coin.
+                    blockchain.new_transaction(
+                        sender="0",
+                        recipient=self.node_identifier,
+                        amount=1,
+                    )
+
+                    # Forge the new Block by adding it to the chain
+                    previous_hash = blockchain.block_hash(last_block)
+                    return blockchain.new_block(proof, previous_hash)
+
+            with self.condition:
+                job['restarts'] += 1
 
 
 # Instantiate the Node
@@ -200,32 +571,51 @@ node_identifier = str(uuid4()).replace('-', '')
 # Instantiate the Blockchain
 blockchain = Blockchain()
 
+# Mines in the background, started by the first job
+mining = MiningWorker(blockchain, node_identifier)
 
-@app.route('/mine', methods=['GET'])
-def mine():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
-
-    # We must receive a reward for finding the proof.
-    # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction(
-        sender="0",
-        recipient=node_identifier,
-        amount=1,
-    )
-
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
 
+def job_response(job):
     response = {
-        'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
+        'job': job['id'],
+        'status': job['status'],
+        'restarts': job['restarts'],
     }
+    if job['error'] is not None:
+        response['error'] = job['error']
+
+    block = job['block']
+    if block is not None:
+        response.update({
+            'message': "New Block Forged",
+            'index': block['index'],
+            'transactions': block['transactions'],
+            'proof': block['proof'],
+            'previous_hash': block['previous_hash'],
+            'difficulty': block['difficulty'],
+        })
+    return response
+
+
+@app.route('/mine', methods=['GET', 'POST'])
+def mine():
+    # The proof of work runs on the mining worker, poll the job for the new block
+    job = mining.submit()
+    if job is None:
+        retry_after = math.ceil(blockchain.block_time() or blockchain.target_block_time)
+        return 'Error: Too many mining jobs queued', 503, {'Retry-After': str(max(1, retry_after))}
+
+    response = job_response(job)
+    return jsonify(response), 202, {'Location': url_for('mining_job', job_id=job['id'])}
+
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def mining_job(job_id):
+    job = mining.job(job_id)
+    if job is None:
+        return 'Error: Unknown mining job', 404
+
+    response = job_response(job)
     return jsonify(response), 200
 
 
@@ -247,9 +637,30 @@ def new_transaction():
 
 @app.route('/chain', methods=['GET'])
 def full_chain():
+    with blockchain.lock:
+        chain = list(blockchain.chain)
+
     response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain),
+        'chain': chain,
+        'length': len(chain),
+    }
+    return jsonify(response), 200
+
+
+@app.route('/difficulty', methods=['GET'])
+def difficulty():
+    block_time = blockchain.block_time()
+    next_difficulty = blockchain.next_difficulty(blockchain.chain, len(blockchain.chain))
+
+    response = {
+        'difficulty': next_difficulty,
+        'target_block_time': blockchain.target_block_time,
+        'retarget_interval': blockchain.retarget_interval,
+        'block_time': block_time,
+        # Each valid proof takes 2 ** difficulty hashes on average
+        'network_hash_rate': 2 ** blockchain.last_block['difficulty'] / block_time
+        if block_time else None,
+        'hash_rate': blockchain.hash_rate,
     }
     return jsonify(response), 200
 
@@ -295,7 +706,31 @@ if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='processes mining in parallel, 0 for one per core')
+    parser.add_argument('-d', '--difficulty', default=DIFFICULTY_BITS, type=int,
+                        help='leading zero bits of the first proofs')
+    parser.add_argument('--block-time', default=TARGET_BLOCK_TIME, type=float,
+                        help='seconds between blocks the difficulty aims for')
+    parser.add_argument('--retarget-interval', default=RETARGET_INTERVAL, type=int,
+                        help='blocks between changes of difficulty')
+    parser.add_argument('--continuous', action='store_true',
+                        help='mine block after block without waiting for /mine')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every block checked')
     args = parser.parse_args()
     port = args.port
 
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    blockchain = Blockchain(
+        miner=ParallelMiner(args.workers or None) if args.workers != 1 else None,
+        difficulty=args.difficulty,
+        target_block_time=args.block_time,
+        retarget_interval=args.retarget_interval,
+    )
+    mining = MiningWorker(blockchain, node_identifier, continuous=args.continuous)
+    if args.continuous:
+        mining.start()
+
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,192 @@
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+# A proof hashes to leading zero bits, 16 is the four leading hex zeros
+DIFFICULTY_BITS = 16
+
+# Nonces each task tries before the pool hands out the next range
+CHUNK_SIZE = 20000
+
+# How often a worker checks whether a lower nonce was already found
+CHECK_EVERY = 1000
+
+# Stands for "no proof found yet" in the shared lowest proof
+NOT_FOUND = 2 ** 63 - 1
+
+# Shared with the workers by init_worker()
+_generation = None
+_lowest = None
+
+
+@lru_cache(maxsize=None)
+def proof_target(zero_bits):
+    """
+    Returns the largest digest that starts with zero_bits zero bits
+
+    Digests are compared to it as bytes, which orders them like the numbers
+    they stand for, so no hex string is made.
+
+    :param zero_bits: <int> Leading zero bits of a valid proof
+    :return: <bytes>
+    """
+
+    return ((1 << (256 - zero_bits)) - 1).to_bytes(32, 'big')
+
+
+def valid_proof(last_proof, proof, last_hash, zero_bits=DIFFICULTY_BITS):
+    """
+    Validates the Proof
+
+    :param last_proof: <int> Previous Proof
+    :param proof: <int> Current Proof
+    :param last_hash: <str> The hash of the Previous Block
+    :param zero_bits: <int> Leading zero bits of a valid proof
+    :return: <bool> True if correct, False if not.
+    """
+
+    guess = f'{last_proof}{proof}{last_hash}'.encode()
+    return hashlib.sha256(guess).digest() <= proof_target(zero_bits)
+
+
+def search(last_proof, last_hash, start, stop, abandon=None, zero_bits=DIFFICULTY_BITS):
+    """
+    Finds the smallest valid proof in range(start, stop)
+
+    The guess of every nonce begins with the same last proof, so its hash
+    state is computed once and copied; only the nonce and the last hash are
+    hashed per try, and the raw digest is compared with the target.
+
+    :param last_proof: <int> Previous Proof
+    :param last_hash: <str> The hash of the Previous Block
+    :param start: <int> First nonce to try
+    :param stop: <int> Nonce to stop before
+    :param abandon: <callable> Asked every CHECK_EVERY nonces, the search gives up when it returns True
+    :param zero_bits: <int> Leading zero bits of a valid proof
+    :return: <int> The proof, or None if the range has none or the search was abandoned
+    """
+
+    target = proof_target(zero_bits)
+    copy = hashlib.sha256(f'{last_proof}'.encode()).copy
+    suffix = last_hash.encode()
+    step = CHECK_EVERY if abandon is not None else max(1, stop - start)
+
+    for first in range(start, stop, step):
+        if abandon is not None and abandon():
+            return None
+        for proof in range(first, min(first + step, stop)):
+            guess = copy()
+            guess.update(b'%d%s' % (proof, suffix))
+            if guess.digest() <= target:
+                return proof
+    return None
+
+
+def init_worker(generation, lowest):
+    """
+    Keeps the values shared by the pool in the worker process
+
+    :param generation: <multiprocessing.Value> Number of the search the pool works on
+    :param lowest: <multiprocessing.Value> Lowest proof found by that search
+    """
+
+    global _generation, _lowest
+    _generation = generation
+    _lowest = lowest
+
+
+def search_chunk(generation, last_proof, last_hash, start, stop, zero_bits):
+    """
+    Searches one range of nonces in a worker of the pool
+
+    The range is abandoned once its search is over or a proof lower than
+    its start was found, as none of its nonces can be the answer anymore.
+
+    :return: <int> The proof, or None
+    """
+
+    def abandon():
+        return _generation.value != generation or _lowest.value < start
+
+    proof = search(last_proof, last_hash, start, stop, abandon, zero_bits)
+    if proof is not None:
+        with _lowest.get_lock():
+            if _generation.value == generation and proof < _lowest.value:
+                _lowest.value = proof
+    return proof
+
+
+class ParallelMiner:
+    def __init__(self, workers=None, chunk_size=CHUNK_SIZE):
+        """
+        Searches proofs with a pool of processes
+
+        :param workers: <int> Number of processes, one per core by default
+        :param chunk_size: <int> Nonces per task
+        """
+
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.generation = multiprocessing.Value('q', 0)
+        self.lowest = multiprocessing.Value('q', NOT_FOUND)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_worker,
+            initargs=(self.generation, self.lowest),
+        )
+
+    def proof_of_work(self, last_proof, last_hash, zero_bits=DIFFICULTY_BITS, abandon=None):
+        """
+        Finds the smallest valid proof, the one the sequential search finds
+
+        The nonces are split into consecutive chunks that the workers take
+        in order. Chunks are read back in order too, so the first chunk with
+        a proof holds the smallest one; the chunks after it are then
+        cancelled or abandoned.
+
+        :param last_proof: <int> Previous Proof
+        :param last_hash: <str> The hash of the Previous Block
+        :param zero_bits: <int> Leading zero bits of a valid proof
+        :param abandon: <callable> Asked before each chunk is read, the search gives up when it returns True
+        :return: <int> The proof, or None if the search was abandoned
+        """
+
+        with self.generation.get_lock():
+            self.generation.value += 1
+            generation = self.generation.value
+            self.lowest.value = NOT_FOUND
+
+        pending = deque()
+        start = 0
+        try:
+            while True:
+                # Keep every worker busy with the next chunk queued behind it
+                while len(pending) < 2 * self.workers:
+                    pending.append(self.pool.submit(
+                        search_chunk, generation, last_proof, last_hash,
+                        start, start + self.chunk_size, zero_bits))
+                    start += self.chunk_size
+
+                if abandon is not None and abandon():
+                    return None
+                proof = pending.popleft().result()
+                if proof is not None:
+                    return proof
+        finally:
+            # Stop the chunks still running and drop the queued ones
+            with self.generation.get_lock():
+                self.generation.value += 1
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """
+        Stops the worker processes
+
+        Chunks left queued by the last search are cancelled, waiting for
+        them can hang the shutdown of the pool.
+        """
+
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,301 @@
+"""
+Blockchain Test Suite
+
+Run it from the blockchain directory with:
+python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import threading
+import unittest
+from time import sleep
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blockchain  # noqa: E402
+from blockchain import MAX_FUTURE_DRIFT, Blockchain, MiningWorker  # noqa: E402
+
+
+def new_node(difficulty=1, retarget_interval=sys.maxsize):
+    """
+    A node that mines quickly, it never retargets unless told to
+    """
+
+    return Blockchain(difficulty=difficulty, retarget_interval=retarget_interval)
+
+
+def mine(node, timestamps):
+    """
+    Adds a block dated at each timestamp, seconds after the genesis block
+    """
+
+    genesis = node.chain[0]['timestamp']
+    for timestamp in timestamps:
+        with mock.patch('blockchain.time', return_value=genesis + timestamp):
+            last_block = node.last_block
+            proof = node.proof_of_work(last_block)
+            node.new_block(proof, node.block_hash(last_block))
+
+
+def peer_of(node):
+    """
+    Returns a node that shares the genesis block of ours
+    """
+
+    peer = new_node(node.difficulty, node.retarget_interval)
+    peer.chain, peer.hashes = list(node.chain[:1]), list(node.hashes[:1])
+    return peer
+
+
+def over_the_wire(chain):
+    """
+    Returns a chain the way a /chain response carries it
+    """
+
+    return json.loads(json.dumps(chain))
+
+
+class TestChainValidation(unittest.TestCase):
+    """ Checks of the chains received from peers """
+
+    def test_valid_chain(self):
+        """ Accept a chain mined by the rules """
+        node = new_node()
+        mine(node, [1, 2, 3])
+        self.assertTrue(node.valid_chain(over_the_wire(node.chain)))
+
+    def test_timestamp_backwards(self):
+        """ Reject a block dated before the one it follows """
+        node = new_node()
+        mine(node, [10, 5])
+        self.assertFalse(node.valid_chain(over_the_wire(node.chain)))
+
+    def test_timestamp_in_the_future(self):
+        """ Reject a block dated too far ahead of our clock """
+        node = new_node()
+        mine(node, [1, MAX_FUTURE_DRIFT + 60])
+        self.assertFalse(node.valid_chain(over_the_wire(node.chain)))
+
+        node = new_node()
+        mine(node, [1, MAX_FUTURE_DRIFT - 60])
+        self.assertTrue(node.valid_chain(over_the_wire(node.chain)))
+
+
+class TestConsensus(unittest.TestCase):
+    """ Choice between our chain and the chains of peers """
+
+    def setUp(self):
+        # Blocks a second apart double the difficulty twice at each retarget,
+        # blocks 40 seconds apart halve it twice
+        self.node = new_node(difficulty=4, retarget_interval=2)
+        self.fast = peer_of(self.node)
+        mine(self.fast, [1, 2, 3])
+        self.slow = peer_of(self.node)
+        mine(self.slow, [40, 80, 120, 160, 200, 240])
+
+    def test_chain_work(self):
+        """ Weigh a chain by the hashes its proofs take """
+        self.assertEqual([block['difficulty'] for block in self.fast.chain], [4, 4, 6, 6])
+        self.assertEqual(Blockchain.chain_work(self.fast.chain), 160)
+        self.assertLess(Blockchain.chain_work(self.slow.chain),
+                        Blockchain.chain_work(self.fast.chain))
+
+    def test_replace_with_more_work(self):
+        """ Take a shorter chain that holds more work """
+        mine(self.node, [40, 80, 120, 160, 200, 240])
+        self.assertTrue(self.node.replace_chain(over_the_wire(self.fast.chain)))
+        self.assertEqual(len(self.node.chain), 4)
+        self.assertEqual(self.node.hashes, [Blockchain.hash(block) for block in self.node.chain])
+
+    def test_keep_more_work(self):
+        """ Keep our chain over a longer one that holds less work """
+        mine(self.node, [1, 2, 3])
+        self.assertFalse(self.node.replace_chain(over_the_wire(self.slow.chain)))
+        self.assertEqual(len(self.node.chain), 4)
+
+    def test_malformed_difficulty(self):
+        """ Turn down a peer chain whose difficulties cannot be weighed """
+        for difficulty in (10 ** 9, 1e308, 'x', True, 0):
+            chain = over_the_wire(self.fast.chain)
+            chain[-1]['difficulty'] = difficulty
+            self.assertFalse(self.node.replace_chain(chain))
+        self.assertEqual(len(self.node.chain), 1)
+
+        chain = over_the_wire(self.fast.chain)
+        chain[-1]['difficulty'] = 'x'
+        self.node.register_node('http://bad:5000')
+        response = mock.Mock(status_code=200, json=lambda: {'chain': chain, 'length': len(chain)})
+        with mock.patch('blockchain.requests.get', return_value=response):
+            self.assertFalse(self.node.resolve_conflicts())
+
+    def test_resolve_conflicts(self):
+        """ Adopt the chain of the neighbour that holds the most work """
+        self.node.register_node('http://slow:5000')
+        self.node.register_node('http://fast:5000')
+        chains = {'slow:5000': self.slow.chain, 'fast:5000': self.fast.chain}
+
+        def get(url):
+            chain = over_the_wire(chains[url.split('/')[2]])
+            return mock.Mock(status_code=200, json=lambda: {'chain': chain, 'length': len(chain)})
+
+        with mock.patch('blockchain.requests.get', side_effect=get):
+            self.assertTrue(self.node.resolve_conflicts())
+        self.assertEqual(self.node.chain, over_the_wire(self.fast.chain))
+
+
+class TestForkPoint(unittest.TestCase):
+    """ Replacing our chain from the block where a peer chain leaves it """
+
+    def setUp(self):
+        self.node = new_node()
+        mine(self.node, [1, 2, 3])
+
+    def fork(self, length, timestamps):
+        """
+        Returns a chain that shares the first blocks of ours and goes on with new ones
+        """
+
+        peer = peer_of(self.node)
+        peer.chain, peer.hashes = list(self.node.chain[:length]), list(self.node.hashes[:length])
+        mine(peer, timestamps)
+        return over_the_wire(peer.chain)
+
+    def test_shared_prefix(self):
+        """ Check only the blocks after the fork point """
+        chain = self.fork(2, [5, 6, 7])
+        self.assertEqual(Blockchain.fork_point(chain, self.node.hashes), 2)
+
+        with mock.patch.object(self.node, 'verify_blocks', wraps=self.node.verify_blocks) as verify:
+            self.assertTrue(self.node.replace_chain(chain))
+        self.assertEqual(verify.call_args[0][1], 2)
+        self.assertEqual(self.node.chain, chain)
+        self.assertEqual(self.node.hashes, [Blockchain.hash(block) for block in chain])
+
+    def test_different_genesis(self):
+        """ Check the whole chain when even the genesis blocks differ """
+        peer = new_node()
+        peer.chain[0]['timestamp'] -= 1
+        peer.hashes = [Blockchain.hash(peer.chain[0])]
+        mine(peer, [1, 2, 3, 4])
+        chain = over_the_wire(peer.chain)
+        self.assertEqual(Blockchain.fork_point(chain, self.node.hashes), 0)
+
+        self.assertTrue(self.node.replace_chain(chain))
+        self.assertEqual(self.node.chain, chain)
+        self.assertEqual(self.node.hashes, [Blockchain.hash(block) for block in chain])
+
+    def test_identical_chain(self):
+        """ Keep our chain when a peer sends it back """
+        chain = over_the_wire(self.node.chain)
+        self.assertEqual(Blockchain.fork_point(chain, self.node.hashes), len(chain))
+        self.assertFalse(self.node.replace_chain(chain))
+        self.assertEqual(self.node.chain, chain)
+
+    def test_invalid_after_fork(self):
+        """ Turn down a chain whose only bad block comes after the fork point """
+        ours = over_the_wire(self.node.chain)
+        chain = self.fork(2, [5, 6, 7])
+        chain[-1]['timestamp'] = chain[-2]['timestamp'] - 1
+        self.assertEqual(Blockchain.fork_point(chain, self.node.hashes), 2)
+
+        self.assertFalse(self.node.replace_chain(chain))
+        self.assertEqual(self.node.chain, ours)
+        self.assertEqual(self.node.hashes, [Blockchain.hash(block) for block in ours])
+
+
+class TestMiningJobs(unittest.TestCase):
+    """ The /mine job API """
+
+    def setUp(self):
+        blockchain.blockchain = new_node()
+        blockchain.mining = MiningWorker(blockchain.blockchain, 'test')
+        self.app = blockchain.app.test_client()
+
+    def finished_job(self):
+        """
+        Submits a job and polls it until it is no longer queued or mining
+        """
+
+        response = self.app.post('/mine')
+        self.assertEqual(response.status_code, 202)
+        location = response.headers['Location']
+        for _ in range(500):
+            job = self.app.get(location).get_json()
+            if job['status'] not in ('queued', 'mining'):
+                return job
+            sleep(0.01)
+        self.fail('the mining job did not finish')
+
+    def test_mine(self):
+        """ Mine a block through a job """
+        job = self.finished_job()
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['index'], 2)
+        self.assertNotIn('error', job)
+
+    def test_unknown_job(self):
+        """ Poll a job that does not exist """
+        self.assertEqual(self.app.get('/mine/nope').status_code, 404)
+
+    def test_failed_job(self):
+        """ Report a job whose mining raised and go on with the next one """
+        with mock.patch.object(blockchain.blockchain, 'proof_of_work',
+                               side_effect=RuntimeError('pool is broken')), \
+                self.assertLogs('blockchain', 'ERROR'):
+            job = self.finished_job()
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error'], 'pool is broken')
+        self.assertTrue(blockchain.mining.thread.is_alive())
+
+        job = self.finished_job()
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['index'], 2)
+
+    def test_queue_full(self):
+        """ Turn down jobs beyond MAX_QUEUED_JOBS while the miner is busy """
+        release = threading.Event()
+        self.addCleanup(release.set)
+        proof_of_work = blockchain.blockchain.proof_of_work
+
+        def blocked(last_block, abandon=None):
+            release.wait(10)
+            return proof_of_work(last_block, abandon)
+
+        with mock.patch.object(blockchain.blockchain, 'proof_of_work', side_effect=blocked):
+            location = self.app.post('/mine').headers['Location']
+            for _ in range(500):
+                if self.app.get(location).get_json()['status'] == 'mining':
+                    break
+                sleep(0.01)
+
+            for _ in range(blockchain.MAX_QUEUED_JOBS):
+                self.assertEqual(self.app.post('/mine').status_code, 202)
+            response = self.app.post('/mine')
+            self.assertEqual(response.status_code, 503)
+            self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+            self.assertEqual(len(blockchain.mining.queue), blockchain.MAX_QUEUED_JOBS)
+
+            release.set()
+            for _ in range(500):
+                if not blockchain.mining.queue:
+                    break
+                sleep(0.01)
+            job = self.finished_job()
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['index'], blockchain.MAX_QUEUED_JOBS + 3)
+
+    def test_restart_thread(self):
+        """ Start the mining thread again when it died """
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        blockchain.mining.thread = dead
+        job = self.finished_job()
+        self.assertEqual(job['status'], 'done')
+        self.assertIsNot(blockchain.mining.thread, dead)
+
+
+if __name__ == '__main__':
+    unittest.main()
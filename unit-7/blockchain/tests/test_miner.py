@@ -0,0 +1,88 @@
+"""
+Miner Test Suite
+
+Run it from the blockchain directory with:
+python -m unittest discover tests
+"""
+
+import os
+import sys
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from miner import DIFFICULTY_BITS, ParallelMiner, proof_target, search, valid_proof  # noqa: E402
+
+LAST_HASH = 'c3f1a9b2' * 8
+
+
+def hex_rule(last_proof, proof, last_hash):
+    """
+    The check proofs had before digests were compared with proof_target
+    """
+
+    guess = f'{last_proof}{proof}{last_hash}'.encode()
+    return hashlib.sha256(guess).hexdigest()[:4] == '0000'
+
+
+class TestProofTarget(unittest.TestCase):
+    """ The digest check against the four leading hex zeros it replaced """
+
+    def test_boundary_digests(self):
+        """ Accept the highest digest with four hex zeros and nothing above """
+        target = proof_target(DIFFICULTY_BITS)
+        for digest, valid in (('00' * 32, True),
+                              ('0000' + 'ff' * 30, True),
+                              ('0000' + '80' + '00' * 29, True),
+                              ('0001' + '00' * 30, False),
+                              ('00ff' + 'ff' * 30, False),
+                              ('ff' * 32, False)):
+            self.assertEqual(bytes.fromhex(digest) <= target, valid, digest)
+            self.assertEqual(digest[:4] == '0000', valid, digest)
+
+    def test_same_proofs_as_hex_rule(self):
+        """ Accept exactly the proofs the hex rule accepts """
+        stop = 200000
+        expected = [proof for proof in range(stop) if hex_rule(100, proof, LAST_HASH)]
+        self.assertGreater(len(expected), 0)
+        self.assertEqual([proof for proof in range(stop) if valid_proof(100, proof, LAST_HASH)],
+                         expected)
+
+        found, start = [], 0
+        while True:
+            proof = search(100, LAST_HASH, start, stop)
+            if proof is None:
+                break
+            found.append(proof)
+            start = proof + 1
+        self.assertEqual(found, expected)
+
+
+class TestParallelMiner(unittest.TestCase):
+    """ The search of proofs with a pool of processes """
+
+    def setUp(self):
+        # Chunks far smaller than the gap between proofs, so most proofs
+        # are found by a later chunk than the first
+        self.miner = ParallelMiner(workers=2, chunk_size=16)
+        self.addCleanup(self.miner.close)
+
+    def test_same_proof_as_search(self):
+        """ Find the smallest proof, the one the sequential search finds """
+        for last_proof in range(10):
+            expected = search(last_proof, LAST_HASH, 0, 1 << 20, zero_bits=8)
+            self.assertIsNotNone(expected)
+            self.assertEqual(self.miner.proof_of_work(last_proof, LAST_HASH, 8), expected)
+
+    def test_abandon(self):
+        """ Give up when asked to """
+        proof = self.miner.proof_of_work(100, LAST_HASH, 8, abandon=lambda: True)
+        self.assertIsNone(proof)
+
+        # The pool goes on with the next search
+        expected = search(100, LAST_HASH, 0, 1 << 20, zero_bits=8)
+        self.assertEqual(self.miner.proof_of_work(100, LAST_HASH, 8), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()